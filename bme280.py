@@ -1,21 +1,71 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import smbus
 from collections import namedtuple
 
+import calibration
+import i2c_bus
+
 BME280Result = namedtuple("BME280Result", ("sensor_name", "is_valid", "temp", "hum", "pres"))
+# Raw mode: ADC counts and the calibration reference, see compensate.py
+BME280RawResult = namedtuple("BME280RawResult", ("sensor_name", "is_valid", "temp_raw", "hum_raw", "pres_raw", "cal"))
+
+def parse_calibration(raw_data):
+	"""Temperature, pressure and humidity coefficients from the 32 calibration registers"""
+	calibration_t = []
+	calibration_p = []
+	calibration_h = []
+	calibration_t.append((raw_data[1] << 8) | raw_data[0])
+	calibration_t.append((raw_data[3] << 8) | raw_data[2])
+	calibration_t.append((raw_data[5] << 8) | raw_data[4])
+	calibration_p.append((raw_data[7] << 8) | raw_data[6])
+	calibration_p.append((raw_data[9] << 8) | raw_data[8])
+	calibration_p.append((raw_data[11] << 8) | raw_data[10])
+	calibration_p.append((raw_data[13] << 8) | raw_data[12])
+	calibration_p.append((raw_data[15] << 8) | raw_data[14])
+	calibration_p.append((raw_data[17] << 8) | raw_data[16])
+	calibration_p.append((raw_data[19] << 8) | raw_data[18])
+	calibration_p.append((raw_data[21] << 8) | raw_data[20])
+	calibration_p.append((raw_data[23] << 8) | raw_data[22])
+	calibration_h.append(raw_data[24])
+	calibration_h.append((raw_data[26] << 8) | raw_data[25])
+	calibration_h.append(raw_data[27])
+	calibration_h.append((raw_data[28] << 4) | (0x0F & raw_data[29]))
+	calibration_h.append((raw_data[30] << 4) | ((raw_data[29] >> 4) & 0x0F))
+	calibration_h.append(raw_data[31])
+
+	for i in range(1, 2):
+		if calibration_t[i] & 0x8000:
+			calibration_t[i] = (-calibration_t[i] ^ 0xFFFF) + 1
+
+	for i in range(1, 8):
+		if calibration_p[i] & 0x8000:
+			calibration_p[i] = (-calibration_p[i] ^ 0xFFFF) + 1
+
+	for i in range(0, 6):
+		if calibration_h[i] & 0x8000:
+			calibration_h[i] = (-calibration_h[i] ^ 0xFFFF) + 1
+
+	return calibration_t, calibration_p, calibration_h
 
 class BME280(object):
-	def __init__(self, i2c_bus_number, i2c_address):
+	def __init__(self, i2c_bus_number, i2c_address, raw=False):
 		self.i2c_address = i2c_address
 		self.i2c_bus_number = i2c_bus_number
-		self.i2c_bus = smbus.SMBus(self.i2c_bus_number)
+		self.i2c_bus = i2c_bus.get_bus(self.i2c_bus_number).smbus()
+		self.raw = raw
+		self.calibration_regs = []
 		self.calibration_h = []
 		self.calibration_p = []
 		self.calibration_t = []
 		self.t_fine = 0.0
-		
+		self._calibration_ref = None
+		self.configure()
+		self.populate_calibration_data()
+		i2c_bus.get_bus(self.i2c_bus_number).add_recovery_listener(self.configure)
+
+	def configure(self):
+		"""Write the measurement settings, also after a bus recovery"""
 		osrs_t = 1  # Temperature oversampling x 1
 		osrs_p = 1  # Pressure oversampling x 1
 		osrs_h = 1  # Humidity oversampling x 1
@@ -31,8 +81,6 @@ class BME280(object):
 		self.write_byte_data(0xF2, ctrl_hum_reg)
 		self.write_byte_data(0xF4, ctrl_meas_reg)
 		self.write_byte_data(0xF5, config_reg)
-
-		self.populate_calibration_data()
 	
 	def read_byte_data(self, cmd, bus=None, i2c_address=None):
 		if bus is None:
@@ -63,37 +111,16 @@ class BME280(object):
 		for i in range(0xE1, 0xE1 + 7):
 			raw_data.append(self.read_byte_data(i))
 
-		self.calibration_t.append((raw_data[1] << 8) | raw_data[0])
-		self.calibration_t.append((raw_data[3] << 8) | raw_data[2])
-		self.calibration_t.append((raw_data[5] << 8) | raw_data[4])
-		self.calibration_p.append((raw_data[7] << 8) | raw_data[6])
-		self.calibration_p.append((raw_data[9] << 8) | raw_data[8])
-		self.calibration_p.append((raw_data[11] << 8) | raw_data[10])
-		self.calibration_p.append((raw_data[13] << 8) | raw_data[12])
-		self.calibration_p.append((raw_data[15] << 8) | raw_data[14])
-		self.calibration_p.append((raw_data[17] << 8) | raw_data[16])
-		self.calibration_p.append((raw_data[19] << 8) | raw_data[18])
-		self.calibration_p.append((raw_data[21] << 8) | raw_data[20])
-		self.calibration_p.append((raw_data[23] << 8) | raw_data[22])
-		self.calibration_h.append(raw_data[24])
-		self.calibration_h.append((raw_data[26] << 8) | raw_data[25])
-		self.calibration_h.append(raw_data[27])
-		self.calibration_h.append((raw_data[28] << 4) | (0x0F & raw_data[29]))
-		self.calibration_h.append((raw_data[30] << 4) | ((raw_data[29] >> 4) & 0x0F))
-		self.calibration_h.append(raw_data[31])
-
-		for i in range(1, 2):
-			if self.calibration_t[i] & 0x8000:
-				self.calibration_t[i] = (-self.calibration_t[i] ^ 0xFFFF) + 1
-
-		for i in range(1, 8):
-			if self.calibration_p[i] & 0x8000:
-				self.calibration_p[i] = (-self.calibration_p[i] ^ 0xFFFF) + 1
-
-		for i in range(0, 6):
-			if self.calibration_h[i] & 0x8000:
-				self.calibration_h[i] = (-self.calibration_h[i] ^ 0xFFFF) + 1
-				
+		self.calibration_regs = raw_data
+		self.calibration_t, self.calibration_p, self.calibration_h = parse_calibration(raw_data)
+		self._calibration_ref = None
+
+	def calibration_ref(self):
+		"""Reference of the calibration blob in the calibration store"""
+		if self._calibration_ref is None:
+			self._calibration_ref = calibration.get_store().register({"type": "BME280", "regs": self.calibration_regs})
+		return self._calibration_ref
+
 	def compensate_pressure(self, adc_p):
 		v1 = (self.t_fine / 2.0) - 64000.0
 		v2 = (((v1 / 4.0) * (v1 / 4.0)) / 2048) * self.calibration_p[5]
@@ -143,8 +170,10 @@ class BME280(object):
 				
 	def read_adc(self):
 		data = []
-		for i in range(0xF7, 0xF7 + 8):
-			data.append(self.read_byte_data(i))
+		# Hold the bus, so the registers are read in one go
+		with self.i2c_bus.lock():
+			for i in range(0xF7, 0xF7 + 8):
+				data.append(self.read_byte_data(i))
 		pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
 		temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
 		hum_raw = (data[6] << 8) | data[7]
@@ -175,10 +204,28 @@ class BME280(object):
 		
 	def read(self):
 		data = self.read_adc()
+		if self.raw:
+			return BME280RawResult(self.get_sensor_name(), True, data.temp, data.hum, data.pres, self.calibration_ref())
 		return BME280Result(self.get_sensor_name(), True,
 			self.read_temperature(data),
 			self.read_humidity(data),
 			self.read_pressure(data))
+
+	def read_into(self, row, mask, offset):
+		"""Write a reading into row from offset on, see SensorMonitor.read_row"""
+		data = self.read_adc()
+		if self.raw:
+			row[offset] = data.temp
+			row[offset + 1] = data.hum
+			row[offset + 2] = data.pres
+			row[offset + 3] = self.calibration_ref()
+		else:
+			row[offset] = self.compensate_temperature(data.temp)
+			row[offset + 1] = self.compensate_humidity(data.hum)
+			row[offset + 2] = self.compensate_pressure(data.pres)
+		for column in range(offset, offset + (4 if self.raw else 3)):
+			mask[column] = 1
+		return True
 		
 	def get_sensor_type_name(self):
 		return "BME280"
@@ -187,10 +234,12 @@ class BME280(object):
 		return "BME280_i2c-%i_0x%02x" % (self.i2c_bus_number, self.i2c_address)
 
 	def get_sensor_fields(self):
+		if self.raw:
+			return ["temp_raw", "hum_raw", "pres_raw", "cal"]
 		return ["temp", "hum", "pres"]
 		
 	def get_sensor_options(self):
-		return (self.i2c_bus_number, self.i2c_address)
+		return (self.i2c_bus_number, self.i2c_address, self.raw)
 		
 	@staticmethod
 	def detect_sensors():
@@ -208,10 +257,14 @@ if __name__ == '__main__':
 
 	parser.add_argument('--i2c-bus', default='1')
 	parser.add_argument('--i2c-address', default='0x76')
+	parser.add_argument('--raw', action='store_true', help='Print the ADC counts and the calibration reference.')
 	args = parser.parse_args()
 	
-	bme280 = BME280(int(args.i2c_bus), int(args.i2c_address, 0))
+	bme280 = BME280(int(args.i2c_bus), int(args.i2c_address, 0), args.raw)
 
 	res = bme280.read()
 
-	print("is_valid:%r temperature:%.2f huminidty:%.2f pressure:%.2f" % (res.is_valid, res.temp, res.hum, res.pres))
+	if args.raw:
+		print("is_valid:%r temp_raw:%i hum_raw:%i pres_raw:%i cal:%i" % (res.is_valid, res.temp_raw, res.hum_raw, res.pres_raw, res.cal))
+	else:
+		print("is_valid:%r temperature:%.2f huminidty:%.2f pressure:%.2f" % (res.is_valid, res.temp, res.hum, res.pres))
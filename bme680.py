@@ -1,30 +1,118 @@
 #!/usr/bin/env python3
 
-import smbus
+import calibration
+import i2c_bus
 import bme680
+import os
 from os.path import join, exists
 from collections import namedtuple
+import json
 
-BME680Result = namedtuple("BME680Result", ("sensor_name", "is_valid", "temp", "hum", "pres", "gas"))
+BME680Result = namedtuple("BME680Result", ("sensor_name", "is_valid", "temp", "hum", "pres", "gas", "iaq"))
+# Raw mode: ADC counts, gas range, status bits and the calibration reference, see compensate.py
+BME680RawResult = namedtuple("BME680RawResult", ("sensor_name", "is_valid", "temp_raw", "hum_raw", "pres_raw",
+	"gas_raw", "gas_range_raw", "status_raw", "cal"))
 
 from constants_bme680 import *
 import math
 import time
 
+class IAQEstimator(object):
+	"""Online air quality index from gas resistance and humidity.
+	The clean-air gas resistance baseline is tracked with an asymmetric
+	exponential average: it follows rising resistance quickly and falling
+	resistance slowly, so it settles on the cleanest air seen recently.
+	State is a few numbers per sensor, no history is kept or rescanned.
+	The baseline is saved to state_path every save_every samples and loaded
+	again on start, so the burn-in period is only needed once.
+	The index runs from 0 (clean air) to 500 (heavily polluted).
+	:param state_path: JSON file to persist the baseline in, None to disable
+	:param burn_in: Number of samples before an index is reported
+	"""
+	hum_baseline = 40.0
+	hum_weighting = 0.25
+
+	def __init__(self, state_path=None, burn_in=50, rise=0.1, decay=0.001, save_every=30):
+		self.state_path = state_path
+		self.burn_in = burn_in
+		self.rise = rise
+		self.decay = decay
+		self.save_every = save_every
+		self.baseline = None
+		self.samples = 0
+		self.load()
+
+	def load(self):
+		"""Load a previously saved baseline, if there is one"""
+		if self.state_path is None or not exists(self.state_path):
+			return
+		try:
+			with open(self.state_path) as fp:
+				state = json.load(fp)
+			baseline = float(state["baseline"])
+			samples = int(state["samples"])
+		except (OSError, ValueError, KeyError, TypeError):
+			return
+		if baseline > 0:
+			self.baseline = baseline
+			self.samples = samples
+
+	def save(self):
+		"""Write the baseline to state_path"""
+		if self.state_path is None or self.baseline is None:
+			return
+		tmp_path = self.state_path + ".tmp"
+		try:
+			with open(tmp_path, "w") as fp:
+				json.dump({"baseline": self.baseline, "samples": self.samples}, fp)
+			os.replace(tmp_path, self.state_path)
+		except OSError:
+			pass
+
+	def update(self, gas_resistance, humidity):
+		"""Feed one sample, returns the index or None during burn-in"""
+		if self.baseline is None:
+			self.baseline = gas_resistance
+		elif gas_resistance > self.baseline:
+			self.baseline += self.rise * (gas_resistance - self.baseline)
+		else:
+			self.baseline += self.decay * (gas_resistance - self.baseline)
+		self.samples += 1
+		if self.samples % self.save_every == 0:
+			self.save()
+		if self.samples < self.burn_in:
+			return None
+		return self.index(gas_resistance, humidity)
+
+	def index(self, gas_resistance, humidity):
+		"""Calculate the index for one sample against the current baseline"""
+		hum_offset = humidity - self.hum_baseline
+		if hum_offset > 0:
+			hum_score = (100.0 - self.hum_baseline - hum_offset) / (100.0 - self.hum_baseline)
+		else:
+			hum_score = (self.hum_baseline + hum_offset) / self.hum_baseline
+		hum_score = min(max(hum_score, 0.0), 1.0) * self.hum_weighting
+
+		gas_score = min(gas_resistance / self.baseline, 1.0) * (1.0 - self.hum_weighting)
+
+		return (1.0 - (hum_score + gas_score)) * 500.0
+
 class BME680(BME680Data):
 	"""BOSCH BME680
 	Gas, pressure, temperature and humidity sensor.
 	:param i2c_addr: One of I2C_ADDR_PRIMARY (0x76) or I2C_ADDR_SECONDARY (0x77)
 	:param i2c_device: Optional smbus or compatible instance for facilitating i2c communications.
+	:param raw: Report the ADC counts instead of compensated values
 	"""
-	def __init__(self, i2c_addr=I2C_ADDR_PRIMARY, i2c_device=None):
+	def __init__(self, i2c_addr=I2C_ADDR_PRIMARY, i2c_device=None, iaq_state_path=None, raw=False):
 		BME680Data.__init__(self)
 
+		self.raw = False
+		self._calibration_ref = None
 		self.i2c_addr = i2c_addr
 		self._i2c = i2c_device
 		if self._i2c is None:
-			import smbus
-			self._i2c = smbus.SMBus(1)
+			self._i2c = i2c_bus.get_bus(1).smbus()
 
 		self.chip_id = self._get_regs(CHIP_ID_ADDR, 1)
 		if self.chip_id != CHIP_ID:
@@ -41,7 +129,30 @@ class BME680(BME680Data):
 		self.set_filter(FILTER_SIZE_3)
 		self.set_gas_status(ENABLE_GAS_MEAS)
 		self.set_temp_offset(0)
+		# A compensated reading, the heater calculation needs the ambient temperature
 		self.get_sensor_data()
+		self.raw = raw
+		if isinstance(self._i2c, i2c_bus.LockedSMBus):
+			self._i2c.bus.add_recovery_listener(self.reinitialize)
+
+		if iaq_state_path is None:
+			iaq_state_path = join(os.getcwd(), "%s_iaq.json" % (self.get_sensor_name(),))
+		self.iaq = IAQEstimator(iaq_state_path)
+
+	def reinitialize(self):
+		"""Reset the sensor and restore the current settings, e.g. after a bus recovery"""
+		self.soft_reset()
+		self.set_power_mode(SLEEP_MODE)
+		self.set_humidity_oversample(self.tph_settings.os_hum)
+		self.set_pressure_oversample(self.tph_settings.os_pres)
+		self.set_temperature_oversample(self.tph_settings.os_temp)
+		self.set_filter(self.tph_settings.filter)
+		nb_profile = self.gas_settings.nb_conv
+		if nb_profile is not None:
+			if self.gas_settings.heatr_temp is not None and self.gas_settings.heatr_dur is not None:
+				self.set_gas_heater_profile(self.gas_settings.heatr_temp, self.gas_settings.heatr_dur, nb_profile)
+			self.select_gas_heater_profile(nb_profile)
+		self.set_gas_status(self.gas_settings.run_gas)
 
 	def _get_calibration_data(self):
 		"""Retrieves the sensor calibration data and stores it in .calibration_data"""
@@ -54,6 +165,15 @@ class BME680(BME680Data):
 
 		self.calibration_data.set_from_array(calibration)
 		self.calibration_data.set_other(heat_range, heat_value, sw_error)
+		self.calibration_regs = {"coeff": list(calibration), "heat_range": heat_range, "heat_value": heat_value, "sw_error": sw_error}
+		self._calibration_ref = None
+
+	def calibration_ref(self):
+		"""Reference of the calibration blob in the calibration store"""
+		if self._calibration_ref is None:
+			blob = dict(self.calibration_regs, type="BME680", temp_offset=self.offset_temp_in_t_fine)
+			self._calibration_ref = calibration.get_store().register(blob)
+		return self._calibration_ref
 
 	def soft_reset(self):
 		"""Initiate a soft reset"""
@@ -69,6 +189,7 @@ class BME680(BME680Data):
 			self.offset_temp_in_t_fine = 0
 		else:
 			self.offset_temp_in_t_fine = int(math.copysign((((int(abs(value) * 100)) << 8) - 128) / 5, value))
+		self._calibration_ref = None
 
 	def set_humidity_oversample(self, value):
 		"""Set humidity oversampling
@@ -208,12 +329,27 @@ class BME680(BME680Data):
 		self.power_mode = self._get_regs(CONF_T_P_MODE_ADDR, 1)
 		return self.power_mode
 
+	def get_measurement_duration(self):
+		"""Get the duration of a forced mode measurement in seconds"""
+		os_to_meas_cycles = (0, 1, 2, 4, 8, 16)
+		meas_cycles = (os_to_meas_cycles[self.tph_settings.os_temp]
+			+ os_to_meas_cycles[self.tph_settings.os_pres]
+			+ os_to_meas_cycles[self.tph_settings.os_hum])
+		# TPH switching, gas measurement and wake up durations in microseconds
+		duration = meas_cycles * 1963 + 477 * 4 + 477 * 5 + 1000
+		if self.gas_settings.run_gas and self.gas_settings.heatr_dur:
+			duration += self.gas_settings.heatr_dur * 1000
+		return duration / 1000000.0
+
 	def get_sensor_data(self):
 		"""Get sensor data.
 		Stores data in .data and returns True upon success.
 		"""
 		self.set_power_mode(FORCED_MODE)
+		return self._fetch_sensor_data()
 
+	def _fetch_sensor_data(self):
+		"""Poll for new data of a triggered measurement and store it in .data"""
 		for attempt in range(10):
 			status = self._get_regs(FIELD0_ADDR, 1)
 
@@ -239,6 +375,11 @@ class BME680(BME680Data):
 
 			self.data.heat_stable = (self.data.status & HEAT_STAB_MSK) > 0
 
+			if self.raw:
+				# Compensated offline by compensate.py
+				self.data.raw = (adc_temp, adc_hum, adc_pres, adc_gas_res, gas_range, self.data.status)
+				return True
+
 			temperature = self._calc_temperature(adc_temp)
 			self.data.temperature = temperature / 100.0
 			self.ambient_temperature = temperature # Saved for heater calc
@@ -372,20 +513,54 @@ class BME680(BME680Data):
 		return "BME680_i2c-%i_0x%02x" % (0, self.i2c_addr)
 
 	def get_sensor_fields(self):
-		return ["temp", "hum", "pres", "gas"]
+		if self.raw:
+			return list(BME680RawResult._fields[2:])
+		return ["temp", "hum", "pres", "gas", "iaq"]
 
-	def read(self):
+	def read(self, sensor_name=None):
 		if self.get_sensor_data():
-			return BME680Result(self.get_sensor_name(), True, self.data.temperature, self.data.humidity, self.data.pressure, self.data.gas_comp)
+			return self.make_result(sensor_name)
+
+	def start_measurement(self):
+		"""Trigger a forced mode measurement without waiting for it
+		Returns the time in seconds until the result should be ready.
+		"""
+		self.set_power_mode(FORCED_MODE, blocking=False)
+		return self.get_measurement_duration()
+
+	def collect(self, sensor_name=None):
+		"""Fetch the result of a measurement started with start_measurement"""
+		if self._fetch_sensor_data():
+			return self.make_result(sensor_name)
+
+	def raw_result(self, sensor_name):
+		"""The raw counts of the last measurement as BME680RawResult"""
+		return BME680RawResult(sensor_name, True, *self.data.raw, self.calibration_ref())
+
+	def make_result(self, sensor_name=None):
+		"""The result of the last measurement, fed to the IAQ estimator"""
+		if sensor_name is None:
+			sensor_name = self.get_sensor_name()
+		if self.raw:
+			return self.raw_result(sensor_name)
+		iaq = None
+		if self.data.heat_stable:
+			iaq = self.iaq.update(self.data.gas_resistance, self.data.humidity)
+		return BME680Result(sensor_name, True, self.data.temperature, self.data.humidity, self.data.pressure, self.data.gas_comp, iaq)
 
 
 class myBME680(object):
-	def __init__(self, i2c_bus_number, i2c_address):
+	def __init__(self, i2c_bus_number, i2c_address, iaq_state_path=None, raw=False):
 		self.i2c_address = i2c_address
 		self.i2c_bus_number = i2c_bus_number
-		self.i2c_bus = smbus.SMBus(self.i2c_bus_number)
-
-		self.sensor = bme680.BME680()
+		self.i2c_bus = i2c_bus.get_bus(self.i2c_bus_number).smbus()
+		self.iaq_state_path = iaq_state_path
+		self.raw = raw
+
+		# The IAQ baseline is kept by the wrapped sensor, under this name
+		if iaq_state_path is None:
+			iaq_state_path = join(os.getcwd(), "%s_iaq.json" % (self.get_sensor_name(),))
+		self.sensor = bme680.BME680(self.i2c_address, self.i2c_bus, iaq_state_path=iaq_state_path, raw=raw)
 		self.sensor.set_humidity_oversample(bme680.OS_2X)
 		self.sensor.set_pressure_oversample(bme680.OS_4X)
 		self.sensor.set_temperature_oversample(bme680.OS_8X)
@@ -393,8 +568,13 @@ class myBME680(object):
 		self.sensor.set_gas_status(bme680.ENABLE_GAS_MEAS)
 
 	def read(self):
-		if bme680.BME680().get_sensor_data():
-			return BME680Result(self.get_sensor_name(), True, self.sensor.data.temperature, self.sensor.data.humidity, self.sensor.data.pressure, self.sensor.data.gas_comp)
+		return self.sensor.read(self.get_sensor_name())
+
+	def start_measurement(self):
+		return self.sensor.start_measurement()
+
+	def collect(self):
+		return self.sensor.collect(self.get_sensor_name())
 		
 	def get_sensor_type_name(self):
 		return "BME680"
@@ -403,10 +583,12 @@ class myBME680(object):
 		return "BME680_i2c-%i_0x%02x" % (self.i2c_bus_number, self.i2c_address)
 
 	def get_sensor_fields(self):
-		return ["temp", "hum", "pres", "gas"]
+		if self.raw:
+			return list(BME680RawResult._fields[2:])
+		return ["temp", "hum", "pres", "gas", "iaq"]
 		
 	def get_sensor_options(self):
-		return (self.i2c_bus_number, self.i2c_address)
+		return (self.i2c_bus_number, self.i2c_address, self.iaq_state_path, self.raw)
 
 	@staticmethod
 	def detect_sensors():
@@ -425,9 +607,13 @@ if __name__ == "__main__":
 
 	parser.add_argument('--i2c-bus', default='1')
 	parser.add_argument('--i2c-address', default='0x77')
+	parser.add_argument('--raw', action='store_true', help='Print the ADC counts and the calibration reference.')
 	args = parser.parse_args()
 	
-	mydevice = myBME680(int(args.i2c_bus), int(args.i2c_address, 0))
+	mydevice = myBME680(int(args.i2c_bus), int(args.i2c_address, 0), raw=args.raw)
 
 	result = mydevice.read()
-	print("is_valid:%r temperature:%.2f huminidty:%.2f pressure:%.2f gas:%.2f" % (result.is_valid, result.temp, result.hum, result.pres, result.gas))
+	if args.raw:
+		print(" ".join("%s:%r" % item for item in result._asdict().items()))
+	else:
+		print("is_valid:%r temperature:%.2f huminidty:%.2f pressure:%.2f gas:%.2f" % (result.is_valid, result.temp, result.hum, result.pres, result.gas))
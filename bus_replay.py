@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Recording and replay of the hardware access of the drivers
+
+A Recorder is put between a driver and the object it talks to: the
+SMBus and /dev/i2c-N handles of i2c_bus (BME280, BME680, SHT21), the
+transport of SHT75, the GPIO lines of DHT11 and the W1Sysfs of the w1
+sensors. It passes every method call on and adds it with its result or
+exception to a Session. A Replayer stands in for the object later and
+answers the calls from the session, so the drivers run without hardware.
+Calls are matched per object by method and arguments, in the recorded
+order, and a call that was not recorded raises a ReplayError.
+
+Sessions are saved as gzip compressed JSON lines: a header with the
+sensors, the readings of each cycle and the objects, then one line per
+call. Replays run under a VirtualClock, so the drivers do not wait for
+conversions, and compare the readings with the recorded ones:
+
+	python3 bus_replay.py record config.json session.gz --cycles 20
+	python3 bus_replay.py replay session.gz --repeat 10
+
+The sensors are given as a sensor_monitor JSON config, with options.
+"""
+
+import array
+import builtins
+import contextlib
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+
+import i2c_bus
+
+_perf_counter = time.perf_counter
+
+
+class ReplayError(Exception):
+	pass
+
+
+def encode(value):
+	"""value as JSON, bytes, arrays, tuples and dicts are tagged"""
+	if isinstance(value, (bytes, bytearray)):
+		return {"b": bytes(value).hex()}
+	if isinstance(value, array.array):
+		return {"a": value.typecode, "v": value.tolist()}
+	if isinstance(value, tuple):
+		return {"t": [encode(item) for item in value]}
+	if isinstance(value, list):
+		return [encode(item) for item in value]
+	if isinstance(value, dict):
+		return {"d": [[encode(key), encode(item)] for key, item in value.items()]}
+	return value
+
+
+def decode(value):
+	if isinstance(value, list):
+		return [decode(item) for item in value]
+	if isinstance(value, dict):
+		if "b" in value:
+			return bytes.fromhex(value["b"])
+		if "a" in value:
+			return array.array(value["a"], value["v"])
+		if "t" in value:
+			return tuple(decode(item) for item in value["t"])
+		return dict((decode(key), decode(item)) for key, item in value["d"])
+	return value
+
+
+def _encode_error(error):
+	if isinstance(error, OSError):
+		return ["OSError", error.errno, error.strerror]
+	return [type(error).__name__] + [str(arg) for arg in error.args]
+
+
+def _decode_error(error):
+	if error[0] == "OSError":
+		# OSError picks the subclass of the errno, e.g. FileNotFoundError
+		return OSError(error[1], error[2])
+	error_class = getattr(builtins, error[0], None)
+	if not isinstance(error_class, type) or not issubclass(error_class, Exception):
+		return ReplayError(*error)
+	return error_class(*error[1:])
+
+
+class Session(object):
+	"""The recorded calls of all objects and the readings of one run"""
+
+	def __init__(self, sensors=None, interval=0.0):
+		self.sensors = sensors or list()
+		self.interval = interval
+		self.readings = list()
+		self.channels = list()
+		self.attributes = dict()
+		self.events = list()
+		self._queues = None
+		self._lock = threading.Lock()
+
+	def recorder(self, target, channel, attributes=()):
+		"""A Recorder of the calls on target under the name channel
+
+		attributes are plain attributes of target the replayer needs.
+		"""
+		self.attributes[channel] = dict((name, encode(getattr(target, name))) for name in attributes)
+		return Recorder(self, target, channel)
+
+	def replayer(self, channel):
+		return Replayer(self, channel)
+
+	def add(self, channel, method, args, kws, result=None, error=None):
+		with self._lock:
+			if channel not in self.channels:
+				self.channels.append(channel)
+			self.events.append([self.channels.index(channel), method, encode(list(args)), encode(kws) if kws else None,
+				encode(result), None if error is None else _encode_error(error)])
+
+	def replay(self, channel, method, args, kws):
+		"""The recorded result of a call, raises the recorded exception"""
+		args = encode(list(args))
+		kws = encode(kws) if kws else None
+		with self._lock:
+			if self._queues is None:
+				self._queues = dict((index, list()) for index in range(len(self.channels)))
+				for event in self.events:
+					self._queues[event[0]].append(event)
+			queue = self._queues.get(self.channels.index(channel) if channel in self.channels else None, [])
+			for index, event in enumerate(queue):
+				if event[1] == method and event[2] == args and event[3] == kws:
+					del queue[index]
+					break
+			else:
+				raise ReplayError("Call not recorded.", channel, method, args)
+		if event[5] is not None:
+			raise _decode_error(event[5])
+		return decode(event[4])
+
+	def unused_events(self):
+		"""Number of recorded calls the replay did not make"""
+		if self._queues is None:
+			return len(self.events)
+		return sum(len(queue) for queue in self._queues.values())
+
+	def save(self, path):
+		with gzip.open(path, "wt") as fp:
+			header = {"version": 1, "sensors": self.sensors, "interval": self.interval, "readings": self.readings,
+				"channels": self.channels, "attributes": self.attributes}
+			fp.write(json.dumps(header) + "\n")
+			for event in self.events:
+				fp.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+	@staticmethod
+	def load(path):
+		with gzip.open(path, "rt") as fp:
+			header = json.loads(fp.readline())
+			session = Session(header["sensors"], header["interval"])
+			session.readings = header["readings"]
+			session.channels = header["channels"]
+			session.attributes = header["attributes"]
+			session.events = [json.loads(line) for line in fp]
+		return session
+
+
+class Recorder(object):
+	"""Proxy adding the method calls on target to a session"""
+
+	def __init__(self, session, target, channel):
+		self._session = session
+		self._target = target
+		self._channel = channel
+
+	def __getattr__(self, name):
+		value = getattr(self._target, name)
+		if name.startswith("_") or not callable(value):
+			return value
+
+		def record(*args, **kws):
+			try:
+				result = value(*args, **kws)
+			except Exception as e:
+				self._session.add(self._channel, name, args, kws, error=e)
+				raise
+			self._session.add(self._channel, name, args, kws, result)
+			return result
+		return record
+
+
+class Replayer(object):
+	"""Stand-in for a recorded object, answering its calls from the session"""
+
+	def __init__(self, session, channel):
+		self._session = session
+		self._channel = channel
+		for name, value in session.attributes.get(channel, {}).items():
+			setattr(self, name, decode(value))
+
+	def __getattr__(self, name):
+		if name.startswith("_"):
+			raise AttributeError(name)
+
+		def replay(*args, **kws):
+			return self._session.replay(self._channel, name, args, kws)
+		return replay
+
+
+class RecordingBackend(object):
+	"""i2c_bus backend recording the SMBus and /dev/i2c-N transfers"""
+
+	def __init__(self, session, backend=None):
+		self.session = session
+		self.backend = i2c_bus.OSBackend() if backend is None else backend
+
+	def open_smbus(self, number):
+		return self.session.recorder(self.backend.open_smbus(number), "smbus-%i" % number)
+
+	def open_device(self, number, address):
+		return self.session.recorder(self.backend.open_device(number, address), "i2c-%i-0x%02x" % (number, address))
+
+
+class ReplayBackend(object):
+	"""i2c_bus backend answering the transfers from a session"""
+
+	def __init__(self, session):
+		self.session = session
+
+	def open_smbus(self, number):
+		return self.session.replayer("smbus-%i" % number)
+
+	def open_device(self, number, address):
+		return self.session.replayer("i2c-%i-0x%02x" % (number, address))
+
+
+class VirtualClock(object):
+	"""Context manager in which time.sleep returns at once
+
+	The clocks of the time module are moved forward by the time slept
+	instead, so timeouts and intervals of the drivers still work out.
+	"""
+
+	_clocks = ("time", "monotonic", "perf_counter")
+
+	def __init__(self):
+		self.offset = 0.0
+		self._saved = None
+		self._lock = threading.Lock()
+
+	def sleep(self, seconds):
+		if seconds < 0:
+			raise ValueError("sleep length must be non-negative")
+		with self._lock:
+			self.offset += seconds
+		# Let threads the sleeping one waits for get on, e.g. the w1 workers
+		self._saved["sleep"](0)
+
+	def __enter__(self):
+		self._saved = dict((name, getattr(time, name)) for name in self._clocks + tuple(name + "_ns" for name in self._clocks) + ("sleep",))
+		for name in self._clocks:
+			clock, clock_ns = self._saved[name], self._saved[name + "_ns"]
+			setattr(time, name, lambda clock=clock: clock() + self.offset)
+			setattr(time, name + "_ns", lambda clock_ns=clock_ns: clock_ns() + int(self.offset * 1e9))
+		time.sleep = self.sleep
+		return self
+
+	def __exit__(self, *exc):
+		for name, value in self._saved.items():
+			setattr(time, name, value)
+		return False
+
+
+def open_sensors(sensors, wrap):
+	"""The sensors of a sensor_monitor config
+
+	wrap(factory, channel, attributes) returns the object the sensor talks
+	to: a Recorder of factory() or a Replayer. I2C sensors talk to the
+	i2c_bus backend.
+	"""
+	import gpio_cdev
+	import sht75
+	import w1_temp
+	from sensor_monitor import SensorMonitor
+
+	opened = list()
+	for type_name, options in sensors:
+		if options is None:
+			raise ValueError("Sensors need their options to be recorded.", type_name)
+		sensor_class = SensorMonitor.KNOWN_SENSORS[type_name][0]
+		if type_name == "SHT75":
+			pins = options[:2]
+			transport = wrap(lambda: sht75.CdevTransport(pins) if gpio_cdev.available() else sht75.SysfsTransport(),
+				"sht75-%i-%i" % tuple(pins), ("edge_events",))
+			opened.append(sensor_class(*options, transport=transport))
+		elif type_name == "DHT11":
+			lines = wrap(lambda: gpio_cdev.Lines(options[:1]), "dht11-%i" % options[0], ())
+			opened.append(sensor_class(*options, lines=lines))
+		elif type_name == "W1Temp":
+			opened.append(sensor_class(*options, sysfs=wrap(w1_temp.W1Sysfs, "w1", ())))
+		else:
+			opened.append(sensor_class(*options))
+	return opened
+
+
+@contextlib.contextmanager
+def _temporary_directory():
+	"""Run in an empty directory, so the state files of the drivers (IAQ
+	baseline, calibration store, DHT11 pins) do not carry over"""
+	cwd = os.getcwd()
+	with tempfile.TemporaryDirectory() as directory:
+		os.chdir(directory)
+		try:
+			yield directory
+		finally:
+			os.chdir(cwd)
+
+
+def _run(sensors, wrap, cycles, interval):
+	import w1_temp
+	from sensor_monitor import SensorMonitor
+
+	# Bulk conversions triggered by an earlier run must not be reused
+	w1_temp._bulk_triggers.clear()
+	monitor = SensorMonitor()
+	for sensor in open_sensors(sensors, wrap):
+		monitor.add_sensor(sensor)
+	readings = list()
+	for cycle in range(cycles):
+		if cycle > 0:
+			time.sleep(interval)
+		# As JSON, like the recorded readings
+		readings.append(json.loads(json.dumps(monitor.get_readings())))
+	return readings
+
+
+def record(sensors, cycles=10, interval=2.0, backend=None):
+	"""Read the sensors for cycles monitor cycles, returns the Session"""
+	session = Session(sensors, interval)
+	wrappers = dict()
+
+	def wrap(factory, channel, attributes):
+		if channel not in wrappers:
+			wrappers[channel] = session.recorder(factory(), channel, attributes)
+		return wrappers[channel]
+
+	previous = i2c_bus.set_backend(RecordingBackend(session, backend))
+	try:
+		with _temporary_directory():
+			session.readings = _run(sensors, wrap, cycles, interval)
+	finally:
+		i2c_bus.set_backend(previous)
+	return session
+
+
+def replay(session):
+	"""Run the drivers on the recorded calls at full speed
+
+	Returns the readings, the seconds it took and the seconds the drivers
+	waited (virtually) for the hardware.
+	"""
+	previous = i2c_bus.set_backend(ReplayBackend(session))
+	try:
+		with _temporary_directory(), VirtualClock() as clock:
+			start = _perf_counter()
+			readings = _run(session.sensors, lambda factory, channel, attributes: session.replayer(channel),
+				len(session.readings), session.interval)
+			duration = _perf_counter() - start
+	finally:
+		i2c_bus.set_backend(previous)
+	return readings, duration, clock.offset
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Record the hardware access of the drivers or replay it.")
+	commands = parser.add_subparsers(dest="command")
+	record_parser = commands.add_parser("record", help="Read the sensors of a config and record the session.")
+	record_parser.add_argument("config", help="sensor_monitor JSON config, the sensors need their options.")
+	record_parser.add_argument("output", help="Session file to write.")
+	record_parser.add_argument("--cycles", type=int, default=10, help="Monitor cycles to record. Default: 10")
+	record_parser.add_argument("--interval", type=float, default=2.0, help="Seconds between the cycles. Default: 2")
+	replay_parser = commands.add_parser("replay", help="Replay a session and compare the readings.")
+	replay_parser.add_argument("session", help="Session file to replay.")
+	replay_parser.add_argument("--repeat", type=int, default=1, help="Number of replays, for benchmarks. Default: 1")
+	args = parser.parse_args()
+
+	if args.command == "record":
+		with open(args.config) as fp:
+			config = json.load(fp)
+		session = record(config["sensors"], args.cycles, args.interval)
+		session.save(args.output)
+		print("Recorded %i cycles, %i calls." % (len(session.readings), len(session.events)))
+	elif args.command == "replay":
+		failed = False
+		for run in range(args.repeat):
+			session = Session.load(args.session)
+			readings, duration, waited = replay(session)
+			mismatches = [cycle for cycle, (expected, got) in enumerate(zip(session.readings, readings)) if expected != got]
+			print("%i cycles in %.3fs (%.2fms per cycle, %.1fs waiting for the hardware), %i readings differ, %i calls left"
+				% (len(readings), duration, duration / max(1, len(readings)) * 1000, waited, len(mismatches), session.unused_events()))
+			if mismatches:
+				failed = True
+				print("cycle %i: recorded %r, replayed %r" % (mismatches[0], session.readings[mismatches[0]], readings[mismatches[0]]))
+		if failed:
+			raise SystemExit(1)
+	else:
+		parser.print_help()
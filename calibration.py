@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Calibration data of sensors running in raw mode
+
+In raw mode a driver reports the ADC counts of its sensor and a "cal"
+field instead of compensated values. "cal" is the CRC-32 reference of
+the calibration blob of the sensor, a JSON object with a "type" key and
+everything compensate.py needs to calculate the values from the counts.
+The blobs are kept in a JSON file, by default calibration.json in the
+current directory, next to the log.
+"""
+
+import json
+import os
+import threading
+import zlib
+
+CALIBRATION_PATH = "calibration.json"
+
+_stores = dict()
+_stores_lock = threading.Lock()
+
+
+def reference(blob):
+	"""The CRC-32 of the blob, independent of the order of its keys"""
+	return zlib.crc32(json.dumps(blob, sort_keys=True, separators=(",", ":")).encode("ascii"))
+
+
+def get_store(path=CALIBRATION_PATH):
+	"""The shared CalibrationStore of the file at path"""
+	path = os.path.abspath(path)
+	with _stores_lock:
+		store = _stores.get(path)
+		if store is None:
+			store = CalibrationStore(path)
+			_stores[path] = store
+		return store
+
+
+class CalibrationStore(object):
+	def __init__(self, path=CALIBRATION_PATH):
+		self.path = path
+		self.blobs = dict()
+		self._lock = threading.Lock()
+		self.load()
+
+	def load(self):
+		"""Read the blobs saved so far, also by other processes"""
+		if not os.path.exists(self.path):
+			return
+		with open(self.path) as fp:
+			blobs = json.load(fp)
+		for ref, blob in blobs.items():
+			self.blobs[int(ref)] = blob
+
+	def save(self):
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, "w") as fp:
+			json.dump(dict((str(ref), blob) for ref, blob in self.blobs.items()), fp, indent=1, sort_keys=True)
+		os.replace(tmp_path, self.path)
+
+	def register(self, blob):
+		"""Add blob to the store, returns its reference"""
+		ref = reference(blob)
+		with self._lock:
+			if ref not in self.blobs:
+				self.load()
+				self.blobs[ref] = blob
+				self.save()
+		return ref
+
+	def get(self, ref):
+		"""The blob of ref, KeyError if it is unknown"""
+		ref = int(ref)
+		if ref not in self.blobs:
+			with self._lock:
+				self.load()
+		return self.blobs[ref]
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Offline compensation of logs written by drivers in raw mode
+
+Drivers in raw mode (BME280, BME680, SHT75 with raw=True) log the ADC
+counts of their sensors as <sensor>_<field>_raw columns and the CRC-32
+reference of their calibration blob as <sensor>_cal (see calibration.py).
+This tool replaces these columns with the compensated values the driver
+would have logged, <sensor>_temp, <sensor>_hum etc., so graph.py can read
+the result. The values are calculated with numpy for all rows of a
+calibration at once.
+
+The BME680 air quality index needs the history of the gas resistance, it
+is calculated row by row with the baseline starting at the beginning of
+the log.
+
+Run with --check to compare the results with the drivers on synthetic
+data.
+"""
+
+import sys
+
+import numpy as np
+
+import bme280
+import calibration
+from bme680 import IAQEstimator
+from constants_bme680 import CalibrationData, HEAT_STAB_MSK, lookupTable1, lookupTable2
+
+
+def compensate_bme280(blob, raw):
+	"""Floating point compensation of the BME280 datasheet, as in bme280.BME280"""
+	cal_t, cal_p, cal_h = bme280.parse_calibration(blob["regs"])
+	adc_t, adc_h, adc_p = raw["temp"], raw["hum"], raw["pres"]
+
+	v1 = (adc_t / 16384.0 - cal_t[0] / 1024.0) * cal_t[1]
+	v2 = (adc_t / 131072.0 - cal_t[0] / 8192.0) * (adc_t / 131072.0 - cal_t[0] / 8192.0) * cal_t[2]
+	t_fine = v1 + v2
+	temperature = t_fine / 5120.0
+
+	v1 = (t_fine / 2.0) - 64000.0
+	v2 = (((v1 / 4.0) * (v1 / 4.0)) / 2048) * cal_p[5]
+	v2 += ((v1 * cal_p[4]) * 2.0)
+	v2 = (v2 / 4.0) + (cal_p[3] * 65536.0)
+	v1 = (((cal_p[2] * (((v1 / 4.0) * (v1 / 4.0)) / 8192)) / 8) + ((cal_p[1] * v1) / 2.0)) / 262144
+	v1 = ((32768 + v1) * cal_p[0]) / 32768
+	valid_p = v1 != 0
+	v1 = np.where(valid_p, v1, 1.0)
+	pressure = ((1048576 - adc_p) - (v2 / 4096)) * 3125
+	pressure = (pressure * 2.0) / v1
+	v1 = (cal_p[8] * (((pressure / 8.0) * (pressure / 8.0)) / 8192.0)) / 4096
+	v2 = ((pressure / 4.0) * cal_p[7]) / 8192.0
+	pressure += ((v1 + v2 + cal_p[6]) / 16.0)
+	pressure = np.where(valid_p, pressure / 100, 0.0)
+
+	var_h = t_fine - 76800.0
+	humidity = (adc_h - (cal_h[3] * 64.0 + cal_h[4] / 16384.0 * var_h)) * (
+		cal_h[1] / 65536.0 * (1.0 + cal_h[5] / 67108864.0 * var_h * (
+			1.0 + cal_h[2] / 67108864.0 * var_h)))
+	humidity *= (1.0 - cal_h[0] * humidity / 524288.0)
+	humidity = np.where(var_h == 0, 0.0, np.clip(humidity, 0.0, 100.0))
+
+	return {"temp": temperature, "hum": humidity, "pres": pressure}
+
+
+def compensate_bme680(blob, raw):
+	"""Integer pipelines of the BME680 driver in 64 bit arithmetic
+
+	Besides the logged fields, returns the gas resistance and the heat
+	stable flag for the air quality index.
+	"""
+	cal = CalibrationData()
+	cal.set_from_array(blob["coeff"])
+	cal.set_other(blob["heat_range"], blob["heat_value"], blob["sw_error"])
+	adc_temp = raw["temp"].astype(np.int64)
+	adc_pres = raw["pres"].astype(np.int64)
+	adc_hum = raw["hum"].astype(np.int64)
+	adc_gas_res = raw["gas"].astype(np.int64)
+	gas_range = raw["gas_range"].astype(np.int64)
+
+	var1 = (adc_temp >> 3) - (cal.par_t1 << 1)
+	var2 = (var1 * cal.par_t2) >> 11
+	var3 = ((var1 >> 1) * (var1 >> 1)) >> 12
+	var3 = ((var3) * (cal.par_t3 << 4)) >> 14
+	t_fine = (var2 + var3) + blob["temp_offset"]
+	temperature = (((t_fine * 5) + 128) >> 8)
+
+	var1 = ((t_fine) >> 1) - 64000
+	var2 = ((((var1 >> 2) * (var1 >> 2)) >> 11) * cal.par_p6) >> 2
+	var2 = var2 + ((var1 * cal.par_p5) << 1)
+	var2 = (var2 >> 2) + (cal.par_p4 << 16)
+	var1 = (((((var1 >> 2) * (var1 >> 2)) >> 13) * ((cal.par_p3 << 5)) >> 3) + ((cal.par_p2 * var1) >> 1))
+	var1 = var1 >> 18
+	var1 = ((32768 + var1) * cal.par_p1) >> 15
+	calc_pressure = 1048576 - adc_pres
+	calc_pressure = ((calc_pressure - (var2 >> 12)) * (3125))
+	calc_pressure = np.where(calc_pressure >= (1 << 31), (calc_pressure // var1) << 1, (calc_pressure << 1) // var1)
+	var1 = (cal.par_p9 * (((calc_pressure >> 3) * (calc_pressure >> 3)) >> 13)) >> 12
+	var2 = ((calc_pressure >> 2) * cal.par_p8) >> 13
+	var3 = ((calc_pressure >> 8) * (calc_pressure >> 8) * (calc_pressure >> 8) * cal.par_p10) >> 17
+	calc_pressure = (calc_pressure) + ((var1 + var2 + var3 + (cal.par_p7 << 7)) >> 4)
+
+	temp_scaled = ((t_fine * 5) + 128) >> 8
+	var1 = (adc_hum - ((cal.par_h1 * 16))) - (((temp_scaled * cal.par_h3) // (100)) >> 1)
+	var2 = (cal.par_h2
+		* (((temp_scaled * cal.par_h4) // (100))
+		+ (((temp_scaled * ((temp_scaled * cal.par_h5) // (100))) >> 6)
+		// (100)) + (1 * 16384))) >> 10
+	var3 = var1 * var2
+	var4 = cal.par_h6 << 7
+	var4 = ((var4) + ((temp_scaled * cal.par_h7) // (100))) >> 4
+	var5 = ((var3 >> 14) * (var3 >> 14)) >> 10
+	var6 = (var4 * var5) >> 1
+	calc_hum = np.clip((((var3 + var6) >> 10) * (1000)) >> 12, 0, 100000)
+
+	var1 = ((1340 + (5 * cal.range_sw_err)) * np.array(lookupTable1, dtype=np.int64)[gas_range]) >> 16
+	var2 = (((adc_gas_res << 15) - (16777216)) + var1)
+	var3 = ((np.array(lookupTable2, dtype=np.int64)[gas_range] * var1) >> 9)
+	gas_resistance = ((var3 + (var2 >> 1)) / var2)
+	gas_resistance = np.where(gas_resistance < 0, (1 << 32) + gas_resistance, gas_resistance)
+
+	humidity = calc_hum / 1000.0
+	return {"temp": temperature / 100.0, "hum": humidity, "pres": calc_pressure / 100.0,
+		"gas": np.log(gas_resistance) + 0.04 * humidity,
+		"gas_resistance": gas_resistance, "heat_stable": (raw["status"].astype(np.int64) & HEAT_STAB_MSK) > 0}
+
+
+def compensate_sht75(blob, raw):
+	"""Conversion of the SHT7x datasheet, ch 4.1, 4.2 and 4.3"""
+	t = raw["temp"] * blob["d2"] + blob["d1"]
+	rh_raw = raw["hum"]
+	rh_linear = blob["c1"] + blob["c2"] * rh_raw + blob["c3"] * rh_raw**2
+	return {"temp": t, "hum": (t - 25.0) * (blob["t1"] + blob["t2"] * rh_raw) + rh_linear}
+
+
+# Compensation function and logged fields per sensor type of the blobs
+COMPENSATIONS = {
+	"BME280": (compensate_bme280, ["temp", "hum", "pres"]),
+	"BME680": (compensate_bme680, ["temp", "hum", "pres", "gas", "iaq"]),
+	"SHT75": (compensate_sht75, ["temp", "hum"]),
+}
+
+
+def read_log(path):
+	"""The sections of a log, (keys, rows) for each "#" header line"""
+	sections = list()
+	rows = None
+	with open(path) as fp:
+		for line in fp:
+			line = line.rstrip("\n")
+			if len(line) == 0:
+				continue
+			if line[0] == "#":
+				keys = line[1:].split(" ")
+				rows = list()
+				sections.append((keys, rows))
+			elif rows is not None:
+				rows.append(line.split(" "))
+	return sections
+
+
+def _column(table, index):
+	strings = table[:, index]
+	values = np.full(len(strings), np.nan)
+	present = strings != ""
+	values[present] = strings[present].astype(float)
+	return values
+
+
+def _format(values):
+	strings = np.char.mod("%.2f", np.where(np.isnan(values), 0.0, values))
+	return np.where(np.isnan(values), "", strings)
+
+
+def compensate_section(keys, rows, store, estimators=None, keep_raw=False):
+	"""Compensate the raw columns of one log section
+
+	Returns the new keys and rows. estimators keeps the IAQEstimator of
+	each BME680 across sections.
+	"""
+	if estimators is None:
+		estimators = dict()
+	table = np.array([(row + [""] * len(keys))[:len(keys)] for row in rows], dtype=str).reshape(len(rows), len(keys))
+	columns = [table[:, i] for i in range(len(keys))]
+	new_keys = list(keys)
+
+	for cal_key in [key for key in keys if key.endswith("_cal")]:
+		sensor = cal_key[:-len("_cal")]
+		raw_keys = [key for key in keys if key.startswith(sensor + "_") and key.endswith("_raw")]
+		raw = dict((key[len(sensor) + 1:-len("_raw")], _column(table, keys.index(key))) for key in raw_keys)
+		refs = _column(table, keys.index(cal_key))
+
+		results = dict()
+		fields = list()
+		for ref in np.unique(refs[~np.isnan(refs)]):
+			selected = refs == ref
+			blob = store.get(int(ref))
+			function, blob_fields = COMPENSATIONS[blob["type"]]
+			fields.extend(field for field in blob_fields if field not in fields)
+			for field, values in function(blob, dict((name, column[selected]) for name, column in raw.items())).items():
+				results.setdefault(field, np.full(len(refs), np.nan))[selected] = values
+
+		if "gas_resistance" in results:
+			# The air quality index depends on the previous rows
+			estimator = estimators.setdefault(sensor, IAQEstimator())
+			iaq = np.full(len(refs), np.nan)
+			for row in np.nonzero(results["heat_stable"] == 1)[0]:
+				index = estimator.update(results["gas_resistance"][row], results["hum"][row])
+				if index is not None:
+					iaq[row] = index
+			results["iaq"] = iaq
+
+		# The compensated columns take the place of the raw ones
+		position = new_keys.index(raw_keys[0] if raw_keys else cal_key)
+		for field in fields:
+			new_keys.insert(position, "%s_%s" % (sensor, field))
+			columns.insert(position, _format(results[field]))
+			position += 1
+		if not keep_raw:
+			for key in raw_keys + [cal_key]:
+				index = new_keys.index(key)
+				del new_keys[index]
+				del columns[index]
+
+	if len(rows) == 0:
+		return new_keys, []
+	lines = np.array(columns).T
+	return new_keys, [" ".join(line).rstrip(" ") for line in lines]
+
+
+def compensate_log(path, output, calibration_path=calibration.CALIBRATION_PATH, keep_raw=False):
+	"""Write the compensated log of path to the file object output"""
+	store = calibration.CalibrationStore(calibration_path)
+	estimators = dict()
+	for keys, rows in read_log(path):
+		keys, lines = compensate_section(keys, rows, store, estimators, keep_raw)
+		output.write("#%s\n" % (" ".join(keys),))
+		for line in lines:
+			output.write(line + "\n")
+
+
+def _bme280_blob():
+	"""Calibration registers with the example coefficients of the datasheet"""
+	t = [27504, 26435, -1000]
+	p = [36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000]
+	regs = list()
+	for value in t + p:
+		regs += [value & 0xFF, (value >> 8) & 0xFF]
+	h1, h2, h3, h4, h5, h6 = 75, 362, 0, 313, 50, 30
+	regs += [h1, h2 & 0xFF, h2 >> 8, h3, h4 >> 4, (h4 & 0x0F) | ((h5 & 0x0F) << 4), h5 >> 4, h6]
+	return {"type": "BME280", "regs": regs}
+
+
+def _bme680_blob():
+	"""Calibration registers with typical coefficients"""
+	from constants_bme680 import (T1_LSB_REG, T1_MSB_REG, T2_LSB_REG, T2_MSB_REG, T3_REG, P1_LSB_REG, P1_MSB_REG,
+		P2_LSB_REG, P2_MSB_REG, P3_REG, P4_LSB_REG, P4_MSB_REG, P5_LSB_REG, P5_MSB_REG, P6_REG, P7_REG,
+		P8_LSB_REG, P8_MSB_REG, P9_LSB_REG, P9_MSB_REG, P10_REG, H1_LSB_REG, H1_MSB_REG, H2_MSB_REG,
+		H3_REG, H4_REG, H5_REG, H6_REG, H7_REG, GH1_REG, GH2_LSB_REG, GH2_MSB_REG, GH3_REG, COEFF_SIZE)
+	coeff = [0] * COEFF_SIZE
+	for lsb, msb, value in ((T1_LSB_REG, T1_MSB_REG, 26041), (T2_LSB_REG, T2_MSB_REG, 26350),
+			(P1_LSB_REG, P1_MSB_REG, 37093), (P2_LSB_REG, P2_MSB_REG, -10304), (P4_LSB_REG, P4_MSB_REG, 7015),
+			(P5_LSB_REG, P5_MSB_REG, -188), (P8_LSB_REG, P8_MSB_REG, -2784), (P9_LSB_REG, P9_MSB_REG, -1785),
+			(GH2_LSB_REG, GH2_MSB_REG, -12456)):
+		coeff[lsb] = value & 0xFF
+		coeff[msb] = (value >> 8) & 0xFF
+	for reg, value in ((T3_REG, 3), (P3_REG, 88), (P6_REG, 30), (P7_REG, 38), (P10_REG, 30), (H3_REG, 0),
+			(H4_REG, 45), (H5_REG, 20), (H6_REG, 120), (H7_REG, -100), (GH1_REG, -30), (GH3_REG, 18)):
+		coeff[reg] = value & 0xFF
+	h1, h2 = 794, 1014
+	coeff[H1_MSB_REG] = h1 >> 4
+	coeff[H2_MSB_REG] = h2 >> 4
+	coeff[H1_LSB_REG] = ((h2 & 0x0F) << 4) | (h1 & 0x0F)
+	return {"type": "BME680", "coeff": coeff, "heat_range": 0x10, "heat_value": 40, "sw_error": 0, "temp_offset": 0}
+
+
+def check(samples):
+	"""Cases comparing the drivers with the bulk compensation on random counts
+
+	Yields the sensor type, the blob, the counts, a function calculating
+	the values of one sample with the driver and the tolerated deviation.
+	"""
+	import bme680
+	import sht75
+
+	rng = np.random.default_rng(1)
+
+	blob = _bme280_blob()
+	raw = {"temp": rng.integers(480000, 560000, samples).astype(float),
+		"hum": rng.integers(20000, 40000, samples).astype(float),
+		"pres": rng.integers(280000, 420000, samples).astype(float)}
+	sensor = bme280.BME280.__new__(bme280.BME280)
+	sensor.calibration_t, sensor.calibration_p, sensor.calibration_h = bme280.parse_calibration(blob["regs"])
+
+	def driver(t, h, p):
+		data = bme280.BME280Result(None, True, t, h, p)
+		return {"temp": sensor.read_temperature(data), "hum": sensor.read_humidity(data), "pres": sensor.read_pressure(data)}
+	yield ("BME280", blob, raw, driver, 1e-9)
+
+	blob = _bme680_blob()
+	raw = {"temp": rng.integers(450000, 560000, samples).astype(float),
+		"hum": rng.integers(15000, 30000, samples).astype(float),
+		"pres": rng.integers(250000, 400000, samples).astype(float),
+		"gas": rng.integers(100, 1000, samples).astype(float),
+		"gas_range": rng.integers(0, 16, samples).astype(float),
+		"status": np.full(samples, 0x80 | HEAT_STAB_MSK, dtype=float)}
+	sensor = bme680.BME680.__new__(bme680.BME680)
+	bme680.BME680Data.__init__(sensor)
+	sensor.calibration_data.set_from_array(blob["coeff"])
+	sensor.calibration_data.set_other(blob["heat_range"], blob["heat_value"], blob["sw_error"])
+	sensor.offset_temp_in_t_fine = blob["temp_offset"]
+
+	def driver(t, h, p, g, r, s):
+		temp = sensor._calc_temperature(int(t)) / 100.0
+		hum = sensor._calc_humidity(int(h)) / 1000.0
+		return {"temp": temp, "hum": hum, "pres": sensor._calc_pressure(int(p)) / 100.0,
+			"gas_resistance": sensor._calc_gas_resistance(int(g), int(r))}
+	yield ("BME680", blob, raw, driver, 1e-12)
+
+	sensor = sht75.SHT75(0, 1, transport=sht75.SimulatedTransport(0, 1))
+	blob = dict(type="SHT75", d1=sensor.c.d1[sensor.voltage], d2=sensor.c.d2, c1=sensor.c.c1, c2=sensor.c.c2,
+		c3=sensor.c.c3, t1=sensor.c.t1, t2=sensor.c.t2)
+	count = min(samples, 200)
+	raw = {"temp": rng.integers(5000, 8000, count).astype(float), "hum": rng.integers(500, 3000, count).astype(float)}
+
+	def driver(t, h):
+		sensor.transport.t_raw, sensor.transport.rh_raw = int(t), int(h)
+		result = sensor.read()
+		return {"temp": result.temp, "hum": result.hum}
+	yield ("SHT75", blob, raw, driver, 1e-9)
+
+
+if __name__ == "__main__":
+	import argparse
+	import time
+
+	parser = argparse.ArgumentParser(description="Compensate the raw counts in a sensor log.")
+	parser.add_argument("log", nargs="?", help="Log written with drivers in raw mode.")
+	parser.add_argument("--output", "-o", type=str, help="File to write the compensated log to. Default: stdout")
+	parser.add_argument("--calibration", type=str, default=calibration.CALIBRATION_PATH,
+		help="Calibration store of the drivers. Default: %s" % (calibration.CALIBRATION_PATH,))
+	parser.add_argument("--keep-raw", action="store_true", help="Keep the raw and cal columns.")
+	parser.add_argument("--check", type=int, metavar="SAMPLES", help="Compare with the drivers on SAMPLES random counts.")
+	args = parser.parse_args()
+
+	if not args.check is None:
+		for name, blob, raw, driver, tolerance in check(args.check):
+			count = len(raw["temp"])
+			start = time.perf_counter()
+			expected = [driver(*values) for values in zip(*raw.values())]
+			driver_time = time.perf_counter() - start
+			start = time.perf_counter()
+			results = COMPENSATIONS[name][0](blob, raw)
+			bulk_time = time.perf_counter() - start
+			deviation = max(abs(results[field][i] - row[field]) / max(1.0, abs(row[field]))
+				for i, row in enumerate(expected) for field in row)
+			print("%-6s %7i samples  driver %8.2f µs/sample  bulk %6.3f µs/sample  max deviation %.1e %s" % (name,
+				count, driver_time / count * 1e6, bulk_time / count * 1e6, deviation, "ok" if deviation <= tolerance else "MISMATCH"))
+	elif args.log is None:
+		parser.error("No log given.")
+	elif args.output is None:
+		compensate_log(args.log, sys.stdout, args.calibration, args.keep_raw)
+	else:
+		with open(args.output, "w") as fp:
+			compensate_log(args.log, fp, args.calibration, args.keep_raw)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Checksums shared by the sensor drivers
+
+Sensirion sensors (SHT2x, SHT7x) protect their results with a CRC-8 with
+the polynomial x^8 + x^5 + x^4 + 1 (0x31). The lookup table is generated
+once from the bitwise definition, after that the CRC costs one lookup per
+byte. The DHT11 uses a plain 8 bit sum.
+
+Run this file to check the table driven CRC against the bitwise one on
+random data and to time both.
+"""
+
+CRC8_POLYNOMIAL = 0x31
+
+
+def crc8_bitwise(data, init=0):
+	"""Reference CRC-8, one bit at a time"""
+	crc = init
+	for byte in data:
+		crc ^= byte
+		for bit in range(8):
+			if crc & 0x80:
+				crc = ((crc << 1) ^ CRC8_POLYNOMIAL) & 0xFF
+			else:
+				crc = (crc << 1) & 0xFF
+	return crc
+
+
+CRC8_TABLE = bytes(crc8_bitwise([i]) for i in range(256))
+REVERSE_TABLE = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+
+
+def crc8(data, init=0):
+	"""CRC-8 of a sequence of bytes, table driven"""
+	crc = init
+	table = CRC8_TABLE
+	for byte in data:
+		crc = table[crc ^ byte]
+	return crc
+
+
+def reverse_bits(byte):
+	"""Reverse the bit order of a byte, the SHT7x sends its CRC reversed"""
+	return REVERSE_TABLE[byte]
+
+
+def sum8(data):
+	"""8 bit sum of a sequence of bytes, as used by the DHT11"""
+	return sum(data) & 0xFF
+
+
+if __name__ == "__main__":
+	import random
+	import timeit
+
+	rng = random.Random(1)
+	for n in range(10000):
+		data = bytes(rng.randrange(256) for i in range(rng.randrange(1, 9)))
+		init = rng.randrange(256)
+		assert crc8(data, init) == crc8_bitwise(data, init), (data, init)
+		assert crc8(data + bytes([crc8(data, init)]), init) == 0, (data, init)
+		assert reverse_bits(reverse_bits(data[0])) == data[0]
+	# Example from the SHT21 datasheet
+	assert crc8([0x68, 0x3A]) == 0x7C
+	print("crc8 matches the bitwise reference.")
+
+	data = bytes([0x68, 0x3A])
+	number = 100000
+	for name, func in (("table", crc8), ("bitwise", crc8_bitwise)):
+		seconds = timeit.timeit(lambda: func(data), number=number)
+		print("%s: %.2fµs per 2 byte CRC" % (name, seconds / number * 1e6))
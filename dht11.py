@@ -1,25 +1,99 @@
+import json
+import os
 import time
 import RPi
 import RPi.GPIO as GPIO
 from collections import namedtuple
 
+import dht11_decode
+import gpio_cdev
+
 NUM_BCM_PINS = 28 #including BCM0
 
-DHT11Result = namedtuple("DHT11Result", ("sensor_name", "is_valid", "temp", "hum"))
+# The whole transmission takes about 5ms
+CAPTURE_TIME = 0.01
+# Pins found by detect_sensors, trusted on the next start
+DETECT_CACHE = "dht11_pins.json"
+# The sensor needs at least a second between two measurements
+MIN_INTERVAL = 1.0
+# Default oldest result served in place of a fresh one, in seconds
+MAX_AGE = 30.0
+# Default time a read may take including retries of failed transmissions,
+# a retry waits MIN_INTERVAL
+RETRY_BUDGET = 1.2
+
+# age is 0 for fresh results and the age in seconds for a served last good result
+DHT11Result = namedtuple("DHT11Result", ("sensor_name", "is_valid", "temp", "hum", "age"))
 
 class DHT11(object):
 	'DHT11 sensor reader class for Raspberry'
 
-	def __init__(self, pin):
+	def __init__(self, pin, max_age=MAX_AGE, retry_budget=RETRY_BUDGET, lines=None):
+		"""lines: gpio_cdev.Lines (or an object with its calls) to capture
+		the transmissions with instead of requesting the pin"""
 		if pin >= NUM_BCM_PINS:
 			raise ValueError("No pin with this BCM number.", pin)
 		#Need reliable way to check if there is a DHT11 on this pin
 		self.__pin = pin
-		GPIO.setwarnings(False)
-		GPIO.setmode(GPIO.BCM)
-		GPIO.cleanup()
+		self.__lines = None
+		self.max_age = max_age
+		self.retry_budget = retry_budget
+		self.__last_start = float("-inf")
+		self.__last_good = None
+		self.__last_good_time = None
+		if lines is not None:
+			self.__lines = lines
+		elif gpio_cdev.available():
+			self.__lines = gpio_cdev.Lines([pin])
+		else:
+			GPIO.setwarnings(False)
+			GPIO.setmode(GPIO.BCM)
 
 	def read(self):
+		"""Measure, or serve the last good result if that is not possible
+
+		The sensor is triggered at most once per MIN_INTERVAL. A failed
+		transmission is retried if the retry still fits into retry_budget
+		seconds and the sensor delivered a good result before, so a dead
+		sensor does not hold up a monitor cycle. Otherwise the last good
+		result is returned with its age, as long as it is not older than
+		max_age.
+		"""
+		start = time.monotonic()
+		if start - self.__last_start >= MIN_INTERVAL:
+			while True:
+				self.__last_start = time.monotonic()
+				result = self.decode(self.capture())
+				if result.is_valid:
+					self.__last_good = result
+					self.__last_good_time = self.__last_start
+					return result
+				next_start = self.__last_start + MIN_INTERVAL
+				if self.__last_good is None or next_start - start > self.retry_budget:
+					break
+				time.sleep(max(0, next_start - time.monotonic()))
+		if self.__last_good is not None:
+			age = time.monotonic() - self.__last_good_time
+			if age <= self.max_age:
+				return self.__last_good._replace(age=age)
+		return DHT11Result(self.get_sensor_name(), False, 0, 0, None)
+
+	def decode(self, trace):
+		"""Result from a trace as returned by capture"""
+		the_bytes = dht11_decode.decode_trace(trace)
+		if the_bytes is None or not dht11_decode.checksum_ok(the_bytes):
+			return DHT11Result(self.get_sensor_name(), False, 0, 0, None)
+		return DHT11Result(self.get_sensor_name(), True, the_bytes[2], the_bytes[0], 0.0)
+
+	def capture(self):
+		"""Trigger a transmission and record it as a dht11_decode trace
+
+		With the GPIO character device the trace are the kernel timestamped
+		edges, otherwise the line is polled as fast as possible.
+		"""
+		if self.__lines is not None:
+			return self.__capture_edges()
+
 		GPIO.setmode(GPIO.BCM)
 		RPi.GPIO.setup(self.__pin, RPi.GPIO.OUT)
 
@@ -33,30 +107,10 @@ class DHT11(object):
 		RPi.GPIO.setup(self.__pin, RPi.GPIO.IN, RPi.GPIO.PUD_UP)
 
 		# collect data into an array
-		data = self.__collect_input()
-
-		# parse lengths of all data pull up periods
-		pull_up_lengths = self.__parse_data_pull_up_lengths(data)
-
-		# if bit count mismatch, return error (4 byte data + 1 byte checksum)
-		if len(pull_up_lengths) != 40:
-			#return DHT11Result(DHT11Result.ERR_MISSING_DATA, self.get_sensor_name(), 0, 0)
-			return DHT11Result(self.get_sensor_name(), False, 0, 0)
-
-		# calculate bits from lengths of the pull up periods
-		bits = self.__calculate_bits(pull_up_lengths)
+		return dict(samples=self.__collect_input())
 
-		# we have the bits, calculate bytes
-		the_bytes = self.__bits_to_bytes(bits)
-
-		# calculate checksum and check
-		checksum = self.__calculate_checksum(the_bytes)
-		if the_bytes[4] != checksum:
-			#return DHT11Result(DHT11Result.ERR_CRC, self.get_sensor_name(), 0, 0)
-			return DHT11Result(self.get_sensor_name(), False, 0, 0)
-
-		# ok, we have valid data, return it
-		return DHT11Result(self.get_sensor_name(), True, the_bytes[2], the_bytes[0])
+	def __capture_edges(self):
+		return capture_edges(self.__lines, [self.__pin])[self.__pin]
 
 	def __send_and_sleep(self, output, sleep):
 		RPi.GPIO.output(self.__pin, output)
@@ -84,91 +138,6 @@ class DHT11(object):
 
 		return data
 
-	def __parse_data_pull_up_lengths(self, data):
-		STATE_INIT_PULL_DOWN = 1
-		STATE_INIT_PULL_UP = 2
-		STATE_DATA_FIRST_PULL_DOWN = 3
-		STATE_DATA_PULL_UP = 4
-		STATE_DATA_PULL_DOWN = 5
-
-		state = STATE_INIT_PULL_DOWN
-
-		lengths = [] # will contain the lengths of data pull up periods
-		current_length = 0 # will contain the length of the previous period
-
-		for i in range(len(data)):
-
-			current = data[i]
-			current_length += 1
-
-			if state == STATE_INIT_PULL_DOWN:
-				if current == RPi.GPIO.LOW:
-					# ok, we got the initial pull down
-					state = STATE_INIT_PULL_UP
-			elif state == STATE_INIT_PULL_UP:
-				if current == RPi.GPIO.HIGH:
-					# ok, we got the initial pull up
-					state = STATE_DATA_FIRST_PULL_DOWN
-			elif state == STATE_DATA_FIRST_PULL_DOWN:
-				if current == RPi.GPIO.LOW:
-					# we have the initial pull down, the next will be the data pull up
-					state = STATE_DATA_PULL_UP
-			elif state == STATE_DATA_PULL_UP:
-				if current == RPi.GPIO.HIGH:
-					# data pulled up, the length of this pull up will determine whether it is 0 or 1
-					current_length = 0
-					state = STATE_DATA_PULL_DOWN
-			elif state == STATE_DATA_PULL_DOWN:
-				if current == RPi.GPIO.LOW:
-					# pulled down, we store the length of the previous pull up period
-					lengths.append(current_length)
-					state = STATE_DATA_PULL_UP
-
-		return lengths
-
-	def __calculate_bits(self, pull_up_lengths):
-		# find shortest and longest period
-		shortest_pull_up = 1000
-		longest_pull_up = 0
-
-		for i in range(0, len(pull_up_lengths)):
-			length = pull_up_lengths[i]
-			if length < shortest_pull_up:
-				shortest_pull_up = length
-			if length > longest_pull_up:
-				longest_pull_up = length
-
-		# use the halfway to determine whether the period it is long or short
-		halfway = shortest_pull_up + (longest_pull_up - shortest_pull_up) / 2
-		bits = []
-
-		for i in range(0, len(pull_up_lengths)):
-			bit = False
-			if pull_up_lengths[i] > halfway:
-				bit = True
-			bits.append(bit)
-
-		return bits
-
-	def __bits_to_bytes(self, bits):
-		the_bytes = []
-		byte = 0
-
-		for i in range(0, len(bits)):
-			byte = byte << 1
-			if (bits[i]):
-				byte = byte | 1
-			else:
-				byte = byte | 0
-			if ((i + 1) % 8 == 0):
-				the_bytes.append(byte)
-				byte = 0
-
-		return the_bytes
-
-	def __calculate_checksum(self, the_bytes):
-		return the_bytes[0] + the_bytes[1] + the_bytes[2] + the_bytes[3] & 255
-		
 	def get_sensor_type_name(self):
 		return "DHT11"
 		
@@ -176,25 +145,113 @@ class DHT11(object):
 		return "DHT11_PIN%i" % self.__pin
 		
 	def get_sensor_fields(self):
-		return ["temp", "hum"]
+		return ["temp", "hum", "age"]
 		
 	def get_sensor_options(self):
-		return (self.__pin,)
+		return (self.__pin, self.max_age, self.retry_budget)
 		
 	@staticmethod
-	def detect_sensors():
-		sensors = list()
-		for i in range(NUM_BCM_PINS):
-			sensor = DHT11(i)
-			res = sensor.read()
-			if res.is_valid:
-				sensors.append(sensor)
-		return sensors
+	def detect_sensors(rescan=False, cache_path=DETECT_CACHE):
+		"""Find DHT11 sensors on the free BCM pins
+
+		The pins found are saved to cache_path and used without probing on
+		the next call, unless rescan is set.
+		"""
+		free = free_pins()
+		pins = None if rescan else load_cached_pins(cache_path)
+		if pins is None:
+			pins = probe_pins(free)
+			if pins:
+				save_cached_pins(cache_path, pins)
+		return [DHT11(pin) for pin in pins if pin in free]
+
+def capture_edges(lines, pins):
+	"""Send the start signal on all pins at once and capture the answers"""
+	for pin in pins:
+		lines.set_direction(pin, "high")
+	time.sleep(0.05)
+	for pin in pins:
+		lines.set(pin, 0)
+	time.sleep(0.02)
+	edges = lines.capture_edges(pins, CAPTURE_TIME, pull_up=True)
+	return dict((pin, dict(timestamps=timestamps, levels=levels, lost=lost))
+		for pin, (timestamps, levels, lost) in edges.items())
+
+def free_pins():
+	"""BCM pins not used by the kernel (I2C, 1-wire, ...) or other programs"""
+	pins = range(NUM_BCM_PINS)
+	if gpio_cdev.available():
+		return gpio_cdev.free_lines(pins)
+	GPIO.setwarnings(False)
+	GPIO.setmode(GPIO.BCM)
+	return [pin for pin in pins if GPIO.gpio_function(pin) == GPIO.IN]
+
+def probe_pins(pins):
+	"""The pins with a DHT11 answering, probed concurrently if possible"""
+	if not pins:
+		return []
+	if not gpio_cdev.available():
+		return [pin for pin in pins if DHT11(pin, retry_budget=0.0).read().is_valid]
+	lines = gpio_cdev.Lines(pins)
+	try:
+		traces = capture_edges(lines, pins)
+	finally:
+		lines.close()
+	found = list()
+	for pin in pins:
+		the_bytes = dht11_decode.decode_trace(traces[pin])
+		if the_bytes is not None and dht11_decode.checksum_ok(the_bytes):
+			found.append(pin)
+	return found
+
+def load_cached_pins(cache_path):
+	"""Pins saved by save_cached_pins, None if there are none"""
+	if cache_path is None or not os.path.exists(cache_path):
+		return None
+	try:
+		with open(cache_path) as fp:
+			pins = [int(pin) for pin in json.load(fp)["pins"]]
+	except (OSError, ValueError, KeyError, TypeError):
+		return None
+	return pins or None
+
+def save_cached_pins(cache_path, pins):
+	if cache_path is None:
+		return
+	tmp_path = cache_path + ".tmp"
+	try:
+		with open(tmp_path, "w") as fp:
+			json.dump({"pins": list(pins)}, fp)
+		os.replace(tmp_path, cache_path)
+	except OSError:
+		pass
 
 def get_sensors(*pins):
 	return [DHT11(pin) for pin in pins]
 
 if __name__ == "__main__":
-	sensor = DHT11.detect_sensors()[0]
-	result = sensor.read()
-	print("valid:%r temperature:%i huminidty:%i" % (result.is_valid, result.temp, result.hum))
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Read a DHT11 sensor.")
+	parser.add_argument("--pin", type=int, help="BCM pin of the sensor. Default: detect")
+	parser.add_argument("--record", metavar="FILE", help="Append the raw traces to FILE, for the dht11_decode benchmark")
+	parser.add_argument("--count", type=int, default=1, help="Number of readings. Default: 1")
+	parser.add_argument("--rescan", action="store_true", help="Probe all free pins instead of using the pins found before (%s)" % DETECT_CACHE)
+	parser.add_argument("--retry-budget", type=float, default=RETRY_BUDGET, help="Seconds a reading may take with retries of failed transmissions. Default: %.1f" % RETRY_BUDGET)
+	args = parser.parse_args()
+
+	if args.pin is None:
+		sensor = DHT11.detect_sensors(rescan=args.rescan)[0]
+	else:
+		sensor = DHT11(args.pin)
+	sensor.retry_budget = args.retry_budget
+	for n in range(args.count):
+		if n:
+			time.sleep(1)
+		if args.record is None:
+			result = sensor.read()
+		else:
+			trace = sensor.capture()
+			dht11_decode.save_traces(args.record, [(sensor.get_sensor_name(), trace)])
+			result = sensor.decode(trace)
+		print("valid:%r temperature:%i huminidty:%i age:%s" % (result.is_valid, result.temp, result.hum, result.age))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+"""Decoding of DHT11 transmissions, independent of any hardware
+
+A trace is a dict with either
+- "timestamps" (edge times in ns) and "levels" (line level after each
+  edge), as captured from GPIO edge events, with "lost" the number of
+  edges the kernel dropped, or
+- "samples", the line level polled as fast as possible.
+Traces can carry the "expected" 5 bytes for benchmarking.
+
+Run this file to benchmark decoding on a synthetic corpus (clean, jittered
+and with missing bits) and optionally on traces recorded with
+"python3 dht11.py --record <file>".
+"""
+
+import json
+import random
+from array import array
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+import crc
+
+# Data bits are high for 26-28µs (0) or 70µs (1)
+BIT_THRESHOLD_NS = 50000
+# The response before the data is high for 80µs, the line is high for
+# 20-40µs between the release of the start signal and the response
+RESPONSE_THRESHOLD_NS = 60000
+
+LOW = 0
+HIGH = 1
+
+
+def decode_trace(trace):
+	"""Decode a trace dict, returns the 5 bytes or None
+
+	A trace of edges the kernel dropped some of (lost > 0) is invalid.
+	"""
+	if trace.get("lost"):
+		return None
+	if "samples" in trace:
+		return decode_samples(trace["samples"])
+	return decode_edges(trace["timestamps"], trace["levels"])
+
+
+def checksum_ok(the_bytes):
+	return the_bytes[4] == crc.sum8(the_bytes[:4])
+
+
+def decode_edges(timestamps, levels):
+	"""Decode the 5 bytes of a transmission from its edges
+
+	Bits are classified by the duration of their high pulse, so the result
+	does not depend on how fast the edges were read.
+	Returns None unless the response pulse is followed by exactly 40 bits.
+	"""
+	if np is None:
+		widths = [timestamps[i + 1] - timestamps[i] for i in range(len(levels) - 1)
+			if levels[i] == HIGH and levels[i + 1] == LOW]
+		if len(widths) < 41 or widths[-41] <= RESPONSE_THRESHOLD_NS:
+			return None
+		return bits_to_bytes([width > BIT_THRESHOLD_NS for width in widths[-40:]])
+
+	timestamps = np.asarray(timestamps, dtype=np.int64)
+	levels = np.asarray(levels, dtype=np.int8)
+	# High pulses start with a rising and end with a falling edge
+	rising = np.flatnonzero((levels[:-1] == HIGH) & (levels[1:] == LOW))
+	widths = timestamps[rising + 1] - timestamps[rising]
+	# The last 40 high pulses are the data, the one before is the response
+	if len(widths) < 41 or widths[-41] <= RESPONSE_THRESHOLD_NS:
+		return None
+	return np.packbits(widths[-40:] > BIT_THRESHOLD_NS).tolist()
+
+
+def decode_samples(samples):
+	"""Decode the 5 bytes of a transmission from polled samples
+
+	Returns None if not exactly 40 bits were received.
+	"""
+	lengths = parse_pull_up_lengths(samples)
+	# if bit count mismatch, return error (4 byte data + 1 byte checksum)
+	if len(lengths) != 40:
+		return None
+	return bits_to_bytes(calculate_bits(lengths))
+
+
+def parse_pull_up_lengths(samples):
+	"""Lengths (in samples) of the high periods of the data bits"""
+	STATE_INIT_PULL_DOWN = 1
+	STATE_INIT_PULL_UP = 2
+	STATE_DATA_FIRST_PULL_DOWN = 3
+	STATE_DATA_PULL_UP = 4
+	STATE_DATA_PULL_DOWN = 5
+
+	state = STATE_INIT_PULL_DOWN
+
+	lengths = [] # will contain the lengths of data pull up periods
+	current_length = 0 # will contain the length of the previous period
+
+	for current in samples:
+		current_length += 1
+
+		if state == STATE_INIT_PULL_DOWN:
+			if current == LOW:
+				# ok, we got the initial pull down
+				state = STATE_INIT_PULL_UP
+		elif state == STATE_INIT_PULL_UP:
+			if current == HIGH:
+				# ok, we got the initial pull up
+				state = STATE_DATA_FIRST_PULL_DOWN
+		elif state == STATE_DATA_FIRST_PULL_DOWN:
+			if current == LOW:
+				# we have the initial pull down, the next will be the data pull up
+				state = STATE_DATA_PULL_UP
+		elif state == STATE_DATA_PULL_UP:
+			if current == HIGH:
+				# data pulled up, the length of this pull up will determine whether it is 0 or 1
+				current_length = 0
+				state = STATE_DATA_PULL_DOWN
+		elif state == STATE_DATA_PULL_DOWN:
+			if current == LOW:
+				# pulled down, we store the length of the previous pull up period
+				lengths.append(current_length)
+				state = STATE_DATA_PULL_UP
+
+	return lengths
+
+
+def calculate_bits(pull_up_lengths):
+	"""Bits from high period lengths, split halfway between shortest and longest"""
+	shortest_pull_up = min(pull_up_lengths)
+	longest_pull_up = max(pull_up_lengths)
+	halfway = shortest_pull_up + (longest_pull_up - shortest_pull_up) / 2
+	return [length > halfway for length in pull_up_lengths]
+
+
+def bits_to_bytes(bits):
+	the_bytes = []
+	byte = 0
+	for i, bit in enumerate(bits):
+		byte = (byte << 1) | (1 if bit else 0)
+		if (i + 1) % 8 == 0:
+			the_bytes.append(byte)
+			byte = 0
+	return the_bytes
+
+
+def synthetic_edges(the_bytes, jitter_ns=0, missing_bits=(), rng=random):
+	"""Edges of a transmission of the_bytes as the sensor sends them
+
+	jitter_ns adds uniform noise to every edge, the bit positions in
+	missing_bits are left out entirely.
+	"""
+	timestamps = array("q")
+	levels = array("b")
+	now = [1000000]
+
+	def edge(level, after_ns):
+		now[0] += after_ns + (rng.randint(-jitter_ns, jitter_ns) if jitter_ns else 0)
+		timestamps.append(now[0])
+		levels.append(level)
+
+	# Response: 80µs low, 80µs high
+	edge(LOW, 30000)
+	edge(HIGH, 80000)
+	edge(LOW, 80000)
+	for i in range(len(the_bytes) * 8):
+		bit = (the_bytes[i // 8] >> (7 - i % 8)) & 1
+		if i in missing_bits:
+			continue
+		edge(HIGH, 50000)
+		edge(LOW, 70000 if bit else 27000)
+	edge(HIGH, 50000)
+	return timestamps, levels
+
+
+def edges_to_samples(timestamps, levels, period_ns, tail=101):
+	"""Polled samples of an edge trace, one sample every period_ns"""
+	samples = array("b", [HIGH] * ((timestamps[0] - 1) // period_ns + 1))
+	for i in range(len(timestamps) - 1):
+		start = timestamps[i] // period_ns + 1
+		end = timestamps[i + 1] // period_ns + 1
+		samples.extend([levels[i]] * (end - start))
+	samples.extend([levels[-1]] * tail)
+	return samples
+
+
+def synthetic_corpus(count=100, seed=1):
+	"""Traces with random data: clean, jittered, polled and with missing bits"""
+	rng = random.Random(seed)
+	corpus = list()
+	for n in range(count):
+		data = [rng.randrange(100), 0, rng.randrange(50), 0]
+		data.append(crc.sum8(data))
+		timestamps, levels = synthetic_edges(data, rng=rng)
+		corpus.append(("clean", dict(timestamps=timestamps, levels=levels, expected=data)))
+		timestamps, levels = synthetic_edges(data, jitter_ns=8000, rng=rng)
+		corpus.append(("jitter", dict(timestamps=timestamps, levels=levels, expected=data)))
+		corpus.append(("samples", dict(samples=edges_to_samples(timestamps, levels, 3000), expected=data)))
+		timestamps, levels = synthetic_edges(data, missing_bits=(rng.randrange(40),), rng=rng)
+		corpus.append(("missing_bit", dict(timestamps=timestamps, levels=levels, expected=data)))
+	return corpus
+
+
+def save_traces(path, traces):
+	"""Append (name, trace) pairs to a JSON lines file"""
+	with open(path, "a") as fp:
+		for name, trace in traces:
+			record = dict((k, v if isinstance(v, int) else list(v)) for k, v in trace.items() if v is not None)
+			record["name"] = name
+			fp.write(json.dumps(record) + "\n")
+
+
+def load_traces(path):
+	traces = list()
+	with open(path) as fp:
+		for line in fp:
+			record = json.loads(line)
+			traces.append((record.pop("name", "recorded"), record))
+	return traces
+
+
+def benchmark(corpus, repeat=10):
+	"""Decode every trace repeat times, returns {name: (count, successes, seconds per decode)}"""
+	import time
+	results = dict()
+	for name, trace in corpus:
+		start = time.perf_counter()
+		for i in range(repeat):
+			the_bytes = decode_trace(trace)
+		duration = (time.perf_counter() - start) / repeat
+		expected = trace.get("expected")
+		if expected is None:
+			success = the_bytes is not None and checksum_ok(the_bytes)
+		else:
+			success = the_bytes == list(expected)
+		count, successes, total = results.get(name, (0, 0, 0.0))
+		results[name] = (count + 1, successes + success, total + duration)
+	return dict((name, (count, successes, total / count)) for name, (count, successes, total) in results.items())
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Benchmark DHT11 decoding.")
+	parser.add_argument("traces", nargs="*", help="JSON lines files with recorded traces")
+	parser.add_argument("--count", type=int, default=100, help="Synthetic traces per kind. Default: 100")
+	args = parser.parse_args()
+
+	corpus = synthetic_corpus(args.count)
+	for path in args.traces:
+		corpus.extend(load_traces(path))
+
+	print("decoder: %s" % ("numpy" if np is not None else "python",))
+	for name, (count, successes, duration) in sorted(benchmark(corpus).items()):
+		print("%-12s %5i traces %6.1f%% decoded %8.1fµs per trace %8.0f traces/s"
+			% (name, count, 100.0 * successes / count, duration * 1e6, 1 / duration))
@@ -1,45 +1,160 @@
 #!/usr/bin/python3
 
-from collections import namedtuple
+from collections import namedtuple, deque
+from itertools import islice
+import threading
+import time
 import serial
-#ser = serial.Serial ( '/dev/ttyUSB0', 9600 )
 
-DustResult = namedtuple ( "DustResult", ( "sensor_name", "is_valid", "smalldust", "largedust" ) )
+import dust_frames
+
+DEFAULT_PORT = "/dev/ttyUSB0"
+DEFAULT_BAUDRATE = 9600
+# Number of samples kept by the background reader
+BUFFER_SIZE = 1000
+# Wait before reopening the port after an error, in seconds
+REOPEN_DELAY = 1.0
+
+# The *_min and *_max fields are None unless the sensor keeps statistics
+DustResult = namedtuple ( "DustResult", ( "sensor_name", "is_valid", "smalldust", "largedust",
+	"smalldust_min", "smalldust_max", "largedust_min", "largedust_max" ) )
 
 class DustSensor ( object ) :
-	def __init__ ( self, number ) :
+	"""Dust sensor on a serial port
+
+	protocol is one of dust_frames.PARSERS: "ascii" for "small,large"
+	lines, "sds011" or "pms5003" for the binary frames of these sensors
+	(small is PM2.5, large PM10). A background thread parses the stream
+	continuously into a ring buffer, so read ( ) returns at once. It
+	returns the latest sample, or with statistics the mean, minimum and
+	maximum of the samples received since the previous call. Without a
+	new sample since the previous call the result is invalid.
+	"""
+
+	def __init__ ( self, number, port = DEFAULT_PORT, baudrate = DEFAULT_BAUDRATE, statistics = False, protocol = "ascii" ) :
 		self._number = number
-		
-	def read ( self ) :
-		while True :
-			data = ser.readline ( )
+		self._protocol = protocol
+		self._parser = dust_frames.make_parser ( protocol )
+		self._port = port
+		self._baudrate = baudrate
+		self._statistics = statistics
+		self._samples = deque ( maxlen = BUFFER_SIZE )
+		self._sample_count = 0
+		self._read_count = 0
+		self._lock = threading.Lock ( )
+		self._stop = threading.Event ( )
+		self._serial = serial.Serial ( port, baudrate, timeout = 0.5 )
+		self._thread = threading.Thread ( target = self._read_loop, name = self.get_sensor_name ( ), daemon = True )
+		self._thread.start ( )
+
+	def _read_loop ( self ) :
+		while not self._stop.is_set ( ) :
+			try :
+				if self._serial is None :
+					self._serial = serial.Serial ( self._port, self._baudrate, timeout = 0.5 )
+				data = self._serial.read ( max ( 1, self._serial.in_waiting ) )
+			except ( serial.SerialException, OSError ) :
+				if self._serial is not None :
+					self._serial.close ( )
+					self._serial = None
+				self._stop.wait ( REOPEN_DELAY )
+				continue
 			if data :
-				[small_str, large_str] = data.split ( b',' )
-				smalldst = float ( small_str )
-				largedst = float ( large_str )
-				if smalldst < 0.5 :
-					smalldst = float ( 0.00001 )
-				if largedst < 0.5 :
-					largedst = float ( 0.00001 )
-				return DustResult ( self.get_sensor_name ( ), True, smalldst, largedst )
-	
+				for sample in self._parser.feed ( data ) :
+					self._add_sample ( sample )
+
+	def _add_sample ( self, sample ) :
+		with self._lock :
+			self._samples.append ( ( time.monotonic ( ), ) + sample )
+			self._sample_count += 1
+
+	def read ( self ) :
+		with self._lock :
+			new_count = min ( self._sample_count - self._read_count, len ( self._samples ) )
+			self._read_count = self._sample_count
+			# Only the newest samples are taken from the ring buffer
+			samples = list ( islice ( reversed ( self._samples ), new_count if self._statistics else min ( new_count, 1 ) ) )
+		if len ( samples ) == 0 :
+			return DustResult ( self.get_sensor_name ( ), False, 0, 0, None, None, None, None )
+		if not self._statistics :
+			return DustResult ( self.get_sensor_name ( ), True, samples[0][1], samples[0][2], None, None, None, None )
+		small = [sample[1] for sample in samples]
+		large = [sample[2] for sample in samples]
+		return DustResult ( self.get_sensor_name ( ), True, sum ( small ) / len ( small ), sum ( large ) / len ( large ),
+			min ( small ), max ( small ), min ( large ), max ( large ) )
+
+	def close ( self ) :
+		self._stop.set ( )
+		self._thread.join ( )
+		if self._serial is not None :
+			self._serial.close ( )
+			self._serial = None
+
 	def get_sensor_type_name ( self ) :
 		return "DustSensor"
-		
+
 	def get_sensor_name ( self ) :
 		return ( "DustSensor_%i" % self._number )
 
 	def get_sensor_fields ( self ) :
+		if self._statistics :
+			return ["smalldust", "largedust", "smalldust_min", "smalldust_max", "largedust_min", "largedust_max"]
 		return ["smalldust", "largedust"]
 
 	def get_sensor_options ( self ) :
-		return ( self._number )
-		
+		return ( self._number, self._port, self._baudrate, self._statistics, self._protocol )
+
 	@staticmethod
 	def detect_sensors ( ) :
-		return [DustSensor ( 1 )]
+		try :
+			return [DustSensor ( 1 )]
+		except ( serial.SerialException, OSError ) :
+			return []
+
+def pty_test ( lines, **kws ) :
+	"""Feed lines through a pseudo-terminal to a DustSensor, returns its reading"""
+	import os
+	import tty
+	master, slave = os.openpty ( )
+	tty.setraw ( slave )
+	sensor = DustSensor ( 1, port = os.ttyname ( slave ), **kws )
+	try :
+		for line in lines :
+			os.write ( master, line )
+		time.sleep ( 0.2 )
+		return sensor.read ( )
+	finally :
+		sensor.close ( )
+		os.close ( slave )
+		os.close ( master )
 
 if __name__ == "__main__":
-	sensor = DustSensor ( 1 )
-	result = sensor.read ( )
-	print ( "valid:%r smalldust:%i largedust:%i" % ( result.is_valid, result.smalldust, result.largedust ) )
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser ( description = "Read a serial dust sensor." )
+	parser.add_argument ( "--port", type = str, default = DEFAULT_PORT, help = "Serial port. Default: %s" % DEFAULT_PORT )
+	parser.add_argument ( "--baudrate", type = int, default = DEFAULT_BAUDRATE, help = "Baud rate. Default: %i" % DEFAULT_BAUDRATE )
+	parser.add_argument ( "--protocol", choices = sorted ( dust_frames.PARSERS ), default = "ascii", help = "Data format of the sensor. Default: ascii" )
+	parser.add_argument ( "--statistics", action = "store_true", help = "Report mean, minimum and maximum since the last reading." )
+	parser.add_argument ( "--pty-test", action = "store_true", help = "Read test data through a pseudo-terminal instead of the sensor." )
+	parser.add_argument ( "--record", type = str, metavar = "FILE", help = "Write the raw stream to FILE for 60s, for the dust_frames benchmark." )
+	args = parser.parse_args ( )
+
+	if args.pty_test :
+		result = pty_test ( [b"1.5,20.0\n", b"garbage\n", b"3.5,0.2\n"], statistics = True )
+		assert result.is_valid and result.smalldust == 2.5 and result.largedust_max == 20.0, result
+		result = pty_test ( [dust_frames.sds011_frame ( 12.5, 30.1 )[3:], b"\x00", dust_frames.sds011_frame ( 12.5, 30.1 )], protocol = "sds011" )
+		assert result.is_valid and result.smalldust == 12.5 and result.largedust == 30.1, result
+		print ( "pty test passed: %r" % ( result, ) )
+	elif not args.record is None :
+		port = serial.Serial ( args.port, args.baudrate, timeout = 0.5 )
+		end = time.monotonic ( ) + 60
+		with open ( args.record, "wb" ) as fp :
+			while time.monotonic ( ) < end :
+				fp.write ( port.read ( max ( 1, port.in_waiting ) ) )
+		port.close ( )
+	else :
+		sensor = DustSensor ( 1, port = args.port, baudrate = args.baudrate, statistics = args.statistics, protocol = args.protocol )
+		time.sleep ( 2 )
+		result = sensor.read ( )
+		print ( "valid:%r smalldust:%i largedust:%i" % ( result.is_valid, result.smalldust, result.largedust ) )
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+"""Incremental parsers for the data streams of dust sensors
+
+A parser is fed the bytes as they arrive from the serial port and returns
+the samples, (small, large) in µg/m³, of all frames completed so far:
+
+- "ascii": "small,large" lines
+- "sds011": Nova SDS011 10 byte frames (AA C0 ... AB), PM2.5 and PM10
+- "pms5003": Plantower PMS5003 32 byte frames (42 4D ...), PM2.5 and PM10
+  (atmospheric environment)
+
+Binary frames are checked in place in the receive buffer. A frame with a
+bad checksum or tail is skipped by one byte, so the parser resynchronizes
+on the next header of a corrupted stream.
+
+Run this file to benchmark the parsers on synthetic streams with
+corruption and optionally on recorded streams ("dust.py --record").
+"""
+
+import abc
+import struct
+
+
+def parse_line(data):
+	"""(small, large) from a "small,large" line, None if it is garbled"""
+	try:
+		[small_str, large_str] = data.split(b',')
+		smalldst = float(small_str)
+		largedst = float(large_str)
+	except ValueError:
+		return None
+	if smalldst < 0.5:
+		smalldst = float(0.00001)
+	if largedst < 0.5:
+		largedst = float(0.00001)
+	return (smalldst, largedst)
+
+
+class LineParser(object):
+	"""Parser for "small,large" lines"""
+
+	def __init__(self):
+		self._buffer = bytearray()
+
+	def feed(self, data):
+		self._buffer += data
+		samples = list()
+		start = 0
+		while True:
+			end = self._buffer.find(b"\n", start)
+			if end < 0:
+				break
+			sample = parse_line(bytes(self._buffer[start:end]))
+			if sample is not None:
+				samples.append(sample)
+			start = end + 1
+		del self._buffer[:start]
+		return samples
+
+
+class FrameParser(abc.ABC):
+	"""Parser for fixed length binary frames starting with header
+
+	Subclasses set header and length and implement decode.
+	"""
+
+	header = b""
+	length = 0
+
+	def __init__(self):
+		self._buffer = bytearray()
+		self.bad_frames = 0
+
+	def feed(self, data):
+		buffer = self._buffer
+		buffer += data
+		samples = list()
+		pos = 0
+		with memoryview(buffer) as view:
+			while True:
+				pos = buffer.find(self.header, pos)
+				if pos < 0:
+					# Keep a partial header at the end
+					pos = max(0, len(buffer) - len(self.header) + 1)
+					break
+				if len(buffer) - pos < self.length:
+					break
+				sample = self.decode(view, pos)
+				if sample is None:
+					self.bad_frames += 1
+					pos += 1
+				else:
+					samples.append(sample)
+					pos += self.length
+		del buffer[:pos]
+		return samples
+
+	@abc.abstractmethod
+	def decode(self, view, offset):
+		"""The sample of the length bytes frame at offset in view
+
+		Returns (small, large) in µg/m³, or None if the checksum or the
+		tail of the frame is wrong.
+		"""
+
+
+class SDS011Parser(FrameParser):
+	header = b"\xaa\xc0"
+	length = 10
+
+	def decode(self, view, offset):
+		if view[offset + 9] != 0xAB or sum(view[offset + 2:offset + 8]) & 0xFF != view[offset + 8]:
+			return None
+		pm25, pm10 = struct.unpack_from("<HH", view, offset + 2)
+		return (pm25 / 10.0, pm10 / 10.0)
+
+
+class PMS5003Parser(FrameParser):
+	header = b"\x42\x4d"
+	length = 32
+
+	def decode(self, view, offset):
+		frame_length, = struct.unpack_from(">H", view, offset + 2)
+		checksum, = struct.unpack_from(">H", view, offset + 30)
+		if frame_length != 28 or sum(view[offset:offset + 30]) != checksum:
+			return None
+		pm25, pm10 = struct.unpack_from(">HH", view, offset + 12)
+		return (float(pm25), float(pm10))
+
+
+PARSERS = {"ascii": LineParser, "sds011": SDS011Parser, "pms5003": PMS5003Parser}
+
+
+def make_parser(protocol):
+	if protocol not in PARSERS:
+		raise ValueError("Unknown dust sensor protocol.", protocol)
+	return PARSERS[protocol]()
+
+
+def sds011_frame(pm25, pm10, device_id=0x1234):
+	data = struct.pack("<HHH", int(round(pm25 * 10)), int(round(pm10 * 10)), device_id)
+	return b"\xaa\xc0" + data + bytes([sum(data) & 0xFF, 0xAB])
+
+
+def pms5003_frame(pm25, pm10):
+	data = struct.pack(">HH13H", 0x424D, 28, 0, int(pm25), int(pm10), 0, int(pm25), int(pm10), *([0] * 7))
+	return data + struct.pack(">H", sum(data))
+
+
+def synthetic_stream(protocol, count, corruption=0.0, seed=1):
+	"""A stream of count frames with random values
+
+	A fraction corruption of the frames has a byte flipped (binary
+	frames) or is preceded by garbage. Returns the stream and the samples
+	that should be parsed from it.
+	"""
+	import random
+	rng = random.Random(seed)
+	stream = bytearray()
+	expected = list()
+	for n in range(count):
+		pm25, pm10 = rng.randrange(1000), rng.randrange(1000)
+		if protocol == "ascii":
+			frame = b"%i,%i\n" % (pm25, pm10)
+			sample = parse_line(frame[:-1])
+		elif protocol == "sds011":
+			frame = sds011_frame(pm25 / 10.0, pm10 / 10.0)
+			sample = (pm25 / 10.0, pm10 / 10.0)
+		else:
+			frame = pms5003_frame(pm25, pm10)
+			sample = (float(pm25), float(pm10))
+		if rng.random() < corruption:
+			if protocol != "ascii" and rng.random() < 0.5:
+				frame = bytearray(frame)
+				frame[rng.randrange(2, len(frame))] ^= 0x10
+				sample = None
+			elif protocol == "ascii":
+				stream += b"garbage\n"[rng.randrange(7):]
+			else:
+				stream += bytes(rng.randrange(256) for i in range(rng.randrange(1, 8)))
+		stream += frame
+		if sample is not None:
+			expected.append(sample)
+	return bytes(stream), expected
+
+
+if __name__ == "__main__":
+	import argparse
+	import time
+
+	parser = argparse.ArgumentParser(description="Benchmark the dust sensor stream parsers.")
+	parser.add_argument("--count", type=int, default=20000, help="Frames per synthetic stream. Default: 20000")
+	parser.add_argument("--chunk", type=int, default=64, help="Bytes per feed call. Default: 64")
+	parser.add_argument("--recorded", nargs=2, action="append", metavar=("PROTOCOL", "FILE"), default=[],
+		help="A recorded raw stream to parse as well")
+	args = parser.parse_args()
+
+	streams = list()
+	for protocol in sorted(PARSERS):
+		for corruption in (0.0, 0.05):
+			stream, expected = synthetic_stream(protocol, args.count, corruption)
+			streams.append(("%s %i%% corrupted" % (protocol, corruption * 100), protocol, stream, expected))
+	for protocol, path in args.recorded:
+		with open(path, "rb") as fp:
+			streams.append((path, protocol, fp.read(), None))
+
+	for name, protocol, stream, expected in streams:
+		frame_parser = make_parser(protocol)
+		samples = list()
+		start = time.perf_counter()
+		for pos in range(0, len(stream), args.chunk):
+			samples.extend(frame_parser.feed(stream[pos:pos + args.chunk]))
+		duration = time.perf_counter() - start
+		if expected is None:
+			check = "%i frames" % len(samples)
+		else:
+			check = "%i/%i frames %s" % (len(samples), len(expected), "ok" if samples == expected else "MISMATCH")
+		print("%-22s %7.2f MB/s %9.0f frames/s  %s" % (name, len(stream) / duration / 1e6, len(samples) / duration, check))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Access to GPIO lines through the GPIO character device (/dev/gpiochipN)
+
+Uses the libgpiod (>= 2.0) python bindings. Lines stay requested, i.e. the
+file descriptor stays open, as long as the objects live, so changing or
+reading a line is a single ioctl instead of a sysfs file write.
+"""
+
+import time
+from array import array
+
+try:
+	import gpiod
+	from gpiod.line import Bias, Direction, Drive, Edge, Value
+except ImportError:
+	gpiod = None
+
+DEFAULT_CHIP = "/dev/gpiochip0"
+CONSUMER = "fhlthermorasp"
+# Kernel buffer for edge events per requested line, a DHT11 frame has
+# about 84 edges and the kernel default of 16 drops the oldest ones
+EVENT_BUFFER_SIZE = 128
+
+
+def available():
+	"""True if the libgpiod v2 bindings can be used"""
+	return gpiod is not None and hasattr(gpiod, "request_lines")
+
+
+def delay(seconds):
+	"""Wait for seconds, busy waiting below a millisecond
+
+	time.sleep can not do microsecond delays, it usually takes at least
+	50-100µs and often more on a loaded system.
+	"""
+	if seconds >= 0.001:
+		time.sleep(seconds)
+		return
+	end = time.perf_counter_ns() + int(seconds * 1e9)
+	while time.perf_counter_ns() < end:
+		pass
+
+
+def free_lines(pins, chip=DEFAULT_CHIP):
+	"""The pins not used by a kernel driver or another consumer"""
+	with gpiod.Chip(chip) as gpio_chip:
+		return [pin for pin in pins if not gpio_chip.get_line_info(pin).used]
+
+
+class OpenDrainLines(object):
+	"""A set of lines driven open drain, e.g. for a bit-banged bus
+
+	Setting a line to 1 releases it (it is pulled up externally), setting it
+	to 0 drives it low. Reading returns the actual level on the line, so
+	a released line driven low by another device reads 0.
+	"""
+
+	def __init__(self, pins, chip=DEFAULT_CHIP):
+		if not available():
+			raise RuntimeError("libgpiod python bindings (v2) are not available.")
+		settings = gpiod.LineSettings(direction=Direction.OUTPUT,
+			drive=Drive.OPEN_DRAIN, output_value=Value.ACTIVE)
+		self.pins = tuple(pins)
+		self._request = gpiod.request_lines(chip, consumer=CONSUMER,
+			config={self.pins: settings})
+
+	def set(self, pin, value):
+		self._request.set_value(pin, Value.ACTIVE if value else Value.INACTIVE)
+
+	def get(self, pin):
+		return 1 if self._request.get_value(pin) == Value.ACTIVE else 0
+
+	def close(self):
+		if self._request is not None:
+			self._request.release()
+			self._request = None
+
+
+class Lines(object):
+	"""A set of lines that can be switched between input and output
+
+	Directions are named like in sysfs: "in", "out", "low" (output,
+	driven low) and "high" (output, driven high).
+	"""
+
+	def __init__(self, pins, chip=DEFAULT_CHIP):
+		if not available():
+			raise RuntimeError("libgpiod python bindings (v2) are not available.")
+		self.pins = tuple(pins)
+		self._settings = dict((pin, gpiod.LineSettings(direction=Direction.INPUT)) for pin in self.pins)
+		# Sequence number of the last edge event seen per line
+		self._seqnos = dict((pin, 0) for pin in self.pins)
+		self._request = gpiod.request_lines(chip, consumer=CONSUMER,
+			config=dict(self._settings), event_buffer_size=EVENT_BUFFER_SIZE * len(self.pins))
+
+	def _reconfigure(self):
+		# Lines missing from the config would be reset to defaults
+		self._request.reconfigure_lines(dict(self._settings))
+
+	def set_direction(self, pin, direction):
+		if direction == "in":
+			settings = gpiod.LineSettings(direction=Direction.INPUT)
+		else:
+			value = Value.ACTIVE if direction == "high" else Value.INACTIVE
+			settings = gpiod.LineSettings(direction=Direction.OUTPUT, output_value=value)
+		self._settings[pin] = settings
+		self._reconfigure()
+
+	def set(self, pin, value):
+		self._request.set_value(pin, Value.ACTIVE if value else Value.INACTIVE)
+
+	def get(self, pin):
+		return 1 if self._request.get_value(pin) == Value.ACTIVE else 0
+
+	def wait_value(self, pin, value, timeout):
+		"""Wait until an input line reads value, sleeping on edge events
+
+		Returns False if the line did not change within timeout seconds.
+		"""
+		edge = Edge.RISING if value else Edge.FALLING
+		self._settings[pin] = gpiod.LineSettings(direction=Direction.INPUT, edge_detection=edge)
+		self._reconfigure()
+		try:
+			deadline = time.monotonic() + timeout
+			# The level is checked after enabling edge detection, so a
+			# change in between can not be missed
+			while self.get(pin) != value:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0 or not self._request.wait_edge_events(remaining):
+					return self.get(pin) == value
+				for event in self._request.read_edge_events():
+					self._seqnos[event.line_offset] = event.line_seqno
+			return True
+		finally:
+			self._settings[pin] = gpiod.LineSettings(direction=Direction.INPUT)
+			self._reconfigure()
+
+	def capture_edges(self, pins, duration, pull_up=False):
+		"""Switch pins to input and record their edges for duration seconds
+
+		Returns a dict pin: (timestamps, levels, lost) with the kernel
+		timestamps of the edges in ns (array "q"), the level after each edge
+		(array "b") and the number of edges the kernel dropped because its
+		buffer overflowed, from the gaps in the event sequence numbers. The
+		timestamps are taken in the interrupt handler, so they do not depend
+		on when this process gets to run.
+		"""
+		bias = Bias.PULL_UP if pull_up else Bias.AS_IS
+		edges = dict()
+		for pin in pins:
+			self._settings[pin] = gpiod.LineSettings(direction=Direction.INPUT,
+				edge_detection=Edge.BOTH, bias=bias)
+			edges[pin] = (array("q"), array("b"), [0])
+		self._reconfigure()
+		try:
+			deadline = time.monotonic() + duration
+			while True:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0 or not self._request.wait_edge_events(remaining):
+					break
+				for event in self._request.read_edge_events():
+					if event.line_offset not in edges:
+						continue
+					timestamps, levels, lost = edges[event.line_offset]
+					expected = self._seqnos[event.line_offset] + 1
+					# A first event numbered 1 means the kernel restarted the count
+					if event.line_seqno > expected and not (len(timestamps) == 0 and event.line_seqno == 1):
+						lost[0] += event.line_seqno - expected
+					self._seqnos[event.line_offset] = event.line_seqno
+					timestamps.append(event.timestamp_ns)
+					levels.append(1 if event.event_type == gpiod.EdgeEvent.Type.RISING_EDGE else 0)
+		finally:
+			for pin in pins:
+				self._settings[pin] = gpiod.LineSettings(direction=Direction.INPUT, bias=bias)
+			self._reconfigure()
+		return dict((pin, (timestamps, levels, lost[0])) for pin, (timestamps, levels, lost) in edges.items())
+
+	def close(self):
+		if self._request is not None:
+			self._request.release()
+			self._request = None
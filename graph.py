@@ -145,6 +145,16 @@ def smooth(y, box_pts):
     return y_smooth
 			
 	
+#timestamps of the samples of key: the capture times of its sensor if the
+#log has <sensor>_ts columns ("--log-timestamps"), else the row times
+def timestamps_for(data, key):
+	parts = key.split("_")
+	for i in range(len(parts) - 1, 0, -1):
+		ts_key = "_".join(parts[:i]) + "_ts"
+		if ts_key in data:
+			return array("d", [ts if ts != NO_VALUE else row_ts for ts, row_ts in zip(data[ts_key], data["timestamp"])])
+	return data["timestamp"]
+
 def date_from_pos(data, pos):
 	dates = list()
 	for p in pos:
@@ -158,7 +168,7 @@ if __name__ == "__main__":
 	
 	data = parse_hist(sys.argv[1])
 
-	sensors = list(set(data.keys()) - {"date", "time", "timestamp"})
+	sensors = [key for key in set(data.keys()) - {"date", "time", "timestamp"} if not key.endswith(("_ts", "_dur"))]
 	sensors.sort()
 	n = len(data["timestamp"])
 	if len(sensors) == 0:
@@ -206,7 +216,7 @@ if __name__ == "__main__":
 		print("Replacing errors...")
 		replace_stray_samples(data[key], 2)
 		print("Plotting...")
-		g1 = TGraph(n, data["timestamp"], data[key])
+		g1 = TGraph(n, timestamps_for(data, key), data[key])
 		x_axis = g1.GetXaxis()
 		x_axis.SetTimeDisplay(1)
 		x_axis.SetTitle("Time")
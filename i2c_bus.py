@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Process wide access to the I2C buses
+
+Drivers get their handles from here instead of opening the bus
+themselves, so all sensors on a bus share one smbus.SMBus and one
+/dev/i2c-N descriptor per device address.
+
+Every transfer holds the bus lock: a per bus RLock against other threads
+and an advisory flock on a lock file against other processes (e.g. the
+GUI and the service). Drivers can hold bus.lock() around a sequence of
+transfers that must not be interleaved. Transfers are recorded in a
+transaction log of the most recent LOG_SIZE entries.
+
+A bus on which all transfers fail with the errors of a stuck bus, or
+on which devices at several addresses stop answering, is recovered
+in-process: the controller driver is unbound, SCL is clocked
+9 times to release a slave holding SDA low, and the driver is bound
+again. Drivers register recovery listeners to re-initialize their
+sensors afterwards. Recoveries back off exponentially while the bus
+stays broken.
+
+The handles are opened through the module's backend, which bus_replay
+replaces to record or replay the transfers.
+"""
+
+import errno
+import fcntl
+import os
+import tempfile
+import threading
+import time
+import weakref
+from collections import deque, namedtuple
+
+import gpio_cdev
+
+try:
+	import smbus
+except ImportError:
+	smbus = None
+
+LOCK_DIR = tempfile.gettempdir()
+LOG_SIZE = 1000
+I2C_SLAVE_FORCE = 0x0706
+SYSFS_ADAPTERS = "/sys/class/i2c-adapter"
+
+# Errors of a stuck or hung bus
+STUCK_ERRORS = (errno.ETIMEDOUT, errno.EIO)
+# A NACK may just be a missing device, the bus only counts as stuck when
+# devices at more than one address NACK
+NACK_ERRORS = (errno.EREMOTEIO,)
+# Successive failed transfers on a bus before it is recovered
+RECOVERY_THRESHOLD = 2
+# Minimum and maximum wait between recoveries of a broken bus
+RECOVERY_BACKOFF_MIN = 1.0
+RECOVERY_BACKOFF_MAX = 300.0
+# BCM (SCL, SDA) pins of the Raspberry Pi buses, for the 9 clock pulses
+BUS_PINS = {0: (1, 0), 1: (3, 2)}
+
+Transaction = namedtuple("Transaction", ("time", "bus", "address", "operation", "args", "error"))
+
+# Transfers on all buses, newest last
+transactions = deque(maxlen=LOG_SIZE)
+
+_buses = dict()
+_buses_lock = threading.Lock()
+
+
+class DeviceFile(object):
+	"""/dev/i2c-N opened for the device at address"""
+
+	def __init__(self, number, address):
+		self._fd = os.open("/dev/i2c-%i" % number, os.O_RDWR)
+		try:
+			fcntl.ioctl(self._fd, I2C_SLAVE_FORCE, address)
+		except OSError:
+			os.close(self._fd)
+			raise
+
+	def write(self, data):
+		return os.write(self._fd, data)
+
+	def read(self, size):
+		return os.read(self._fd, size)
+
+	def close(self):
+		os.close(self._fd)
+
+
+class OSBackend(object):
+	"""Opens the handles of the real buses"""
+
+	def open_smbus(self, number):
+		return smbus.SMBus(number)
+
+	def open_device(self, number, address):
+		return DeviceFile(number, address)
+
+
+backend = OSBackend()
+
+
+def set_backend(new_backend):
+	"""Open all handles through new_backend, returns the previous backend
+
+	The buses opened so far are forgotten, drivers created afterwards get
+	new handles.
+	"""
+	global backend
+	with _buses_lock:
+		previous = backend
+		backend = new_backend
+		_buses.clear()
+	return previous
+
+
+def get_bus(number):
+	"""The shared Bus object of /dev/i2c-<number>"""
+	with _buses_lock:
+		bus = _buses.get(number)
+		if bus is None:
+			bus = Bus(number)
+			_buses[number] = bus
+		return bus
+
+
+class Bus(object):
+	def __init__(self, number):
+		self.number = number
+		self._lock = threading.RLock()
+		self._depth = 0
+		self._lock_file = None
+		self._smbus = None
+		self._devices = dict()
+		self._listeners = list()
+		self._failures = 0
+		self._stuck = False
+		self._nack_addresses = set()
+		self._recovering = False
+		self._backoff = RECOVERY_BACKOFF_MIN
+		self._next_recovery = 0.0
+		self.stats = {"failures": 0, "recoveries": 0, "failed_recoveries": 0,
+			"last_recovery_time": None, "total_recovery_time": 0.0, "last_error": None}
+
+	def lock(self):
+		"""Context manager holding the bus for this thread and process"""
+		return _BusLock(self)
+
+	def _acquire(self):
+		self._lock.acquire()
+		if self._depth == 0:
+			try:
+				if self._lock_file is None:
+					self._lock_file = open(os.path.join(LOCK_DIR, "i2c-%i.lock" % self.number), "a")
+				fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+			except OSError:
+				# Without the lock file only this process is serialized
+				pass
+		self._depth += 1
+
+	def _release(self):
+		self._depth -= 1
+		if self._depth == 0 and self._lock_file is not None:
+			fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+		self._lock.release()
+
+	def transfer(self, address, operation, func, *args, expect_nack=False):
+		"""Call func(*args) holding the lock and log it
+
+		expect_nack marks transfers that fail as part of the protocol, e.g.
+		polling a sensor for the end of a conversion. Their failures do not
+		count towards a bus recovery.
+		"""
+		with self.lock():
+			try:
+				result = func(*args)
+			except Exception as e:
+				transactions.append(Transaction(time.time(), self.number, address, operation, args, repr(e)))
+				if not expect_nack and isinstance(e, OSError) and e.errno in STUCK_ERRORS + NACK_ERRORS:
+					self._failed(e, address)
+				raise
+			self._reset_failures()
+			self._backoff = RECOVERY_BACKOFF_MIN
+		transactions.append(Transaction(time.time(), self.number, address, operation, args, None))
+		return result
+
+	def _failed(self, error, address):
+		self._failures += 1
+		self.stats["failures"] += 1
+		self.stats["last_error"] = repr(error)
+		if error.errno in NACK_ERRORS:
+			self._nack_addresses.add(address)
+		else:
+			self._stuck = True
+		# Transfers of the recovery listeners fail again while a recovery runs
+		if self._recovering or self._failures < RECOVERY_THRESHOLD:
+			return
+		if (self._stuck or len(self._nack_addresses) > 1) and time.monotonic() >= self._next_recovery:
+			self.recover()
+
+	def _reset_failures(self):
+		self._failures = 0
+		self._stuck = False
+		self._nack_addresses.clear()
+
+	def add_recovery_listener(self, listener):
+		"""Call listener ( ) after each recovery of this bus
+
+		Bound methods are referenced weakly, so a listening sensor can
+		still be garbage collected.
+		"""
+		if hasattr(listener, "__self__"):
+			self._listeners.append(weakref.WeakMethod(listener))
+		else:
+			self._listeners.append(lambda: listener)
+
+	def recover(self):
+		"""Reset a stuck bus and tell the drivers to re-initialize
+
+		Returns True if the bus works again (as far as the listeners can
+		tell), the time taken is added to stats. Returns False at once if
+		called again while recovering.
+		"""
+		with self.lock():
+			if self._recovering:
+				return False
+			self._recovering = True
+			try:
+				return self._recover()
+			finally:
+				self._recovering = False
+
+	def _recover(self):
+		start = time.monotonic()
+		for device in self._devices.values():
+			device.close()
+		ok = True
+		try:
+			self._rebind(self._clock_out)
+		except OSError as e:
+			self.stats["last_error"] = repr(e)
+			ok = False
+		if self._smbus is not None:
+			try:
+				self._smbus.reopen()
+			except OSError as e:
+				self.stats["last_error"] = repr(e)
+				ok = False
+		self._reset_failures()
+		# Back off before the listeners run, their transfers may fail again
+		self._next_recovery = time.monotonic() + self._backoff
+		self._backoff = min(2 * self._backoff, RECOVERY_BACKOFF_MAX)
+		for reference in list(self._listeners):
+			listener = reference()
+			if listener is None:
+				self._listeners.remove(reference)
+				continue
+			try:
+				listener()
+			except Exception as e:
+				self.stats["last_error"] = repr(e)
+				ok = False
+		duration = time.monotonic() - start
+		self.stats["recoveries"] += 1
+		self.stats["last_recovery_time"] = duration
+		self.stats["total_recovery_time"] += duration
+		if ok:
+			self._backoff = RECOVERY_BACKOFF_MIN
+			self._next_recovery = time.monotonic()
+		else:
+			self.stats["failed_recoveries"] += 1
+		return ok
+
+	def _rebind(self, while_unbound):
+		"""Unbind and bind the controller driver of the bus (needs root)"""
+		device = os.path.realpath(os.path.join(SYSFS_ADAPTERS, "i2c-%i" % self.number, "device"))
+		driver = os.path.realpath(os.path.join(device, "driver"))
+		name = os.path.basename(device)
+		with open(os.path.join(driver, "unbind"), "w") as fp:
+			fp.write(name)
+		try:
+			while_unbound()
+		finally:
+			with open(os.path.join(driver, "bind"), "w") as fp:
+				fp.write(name)
+		# i2c-dev creates the device node again
+		deadline = time.monotonic() + 1.0
+		while not os.path.exists("/dev/i2c-%i" % self.number) and time.monotonic() < deadline:
+			time.sleep(0.01)
+
+	def _clock_out(self):
+		"""Clock SCL 9 times and send a STOP, so a slave releases SDA"""
+		if self.number not in BUS_PINS or not gpio_cdev.available():
+			return
+		scl, sda = BUS_PINS[self.number]
+		try:
+			lines = gpio_cdev.OpenDrainLines([scl, sda])
+		except OSError:
+			# The pins are still claimed, the rebind alone has to do
+			return
+		try:
+			for i in range(9):
+				lines.set(scl, 0)
+				gpio_cdev.delay(5e-6)
+				lines.set(scl, 1)
+				gpio_cdev.delay(5e-6)
+			lines.set(sda, 0)
+			gpio_cdev.delay(5e-6)
+			lines.set(sda, 1)
+		finally:
+			lines.close()
+
+	def smbus(self):
+		"""The shared smbus.SMBus of this bus, wrapped in a LockedSMBus"""
+		with self._lock:
+			if self._smbus is None:
+				self._smbus = LockedSMBus(self, backend.open_smbus(self.number))
+			return self._smbus
+
+	def device(self, address):
+		"""The shared /dev/i2c-N handle for the device at address"""
+		with self._lock:
+			device = self._devices.get(address)
+			if device is None:
+				device = Device(self, address)
+				self._devices[address] = device
+			return device
+
+
+class _BusLock(object):
+	def __init__(self, bus):
+		self._bus = bus
+
+	def __enter__(self):
+		self._bus._acquire()
+		return self._bus
+
+	def __exit__(self, *exc):
+		self._bus._release()
+		return False
+
+
+class LockedSMBus(object):
+	"""smbus.SMBus whose methods hold the bus lock and are logged
+
+	It can be passed wherever an SMBus is expected. The first argument
+	of the SMBus methods is the device address.
+	"""
+
+	def __init__(self, bus, smbus_instance):
+		self.bus = bus
+		self._smbus = smbus_instance
+
+	def lock(self):
+		return self.bus.lock()
+
+	def reopen(self):
+		"""Replace the SMBus, e.g. after the adapter was rebound"""
+		try:
+			self._smbus.close()
+		except Exception:
+			pass
+		self._smbus = backend.open_smbus(self.bus.number)
+
+	def __getattr__(self, name):
+		func = getattr(self._smbus, name)
+		if not callable(func):
+			return func
+
+		def locked(address, *args):
+			return self.bus.transfer(address, name, func, address, *args)
+		return locked
+
+
+class Device(object):
+	"""Raw reads and writes to one device through /dev/i2c-N"""
+
+	def __init__(self, bus, address):
+		self.bus = bus
+		self.address = address
+		self._file = None
+
+	def _open(self):
+		if self._file is None:
+			self._file = backend.open_device(self.bus.number, self.address)
+		return self._file
+
+	def write(self, data):
+		self.bus.transfer(self.address, "write", lambda data: self._open().write(data), bytes(data))
+
+	def read(self, size, expect_nack=False):
+		return self.bus.transfer(self.address, "read", lambda size: self._open().read(size), size,
+			expect_nack=expect_nack)
+
+	def close(self):
+		"""Close the descriptor, the next transfer reopens it"""
+		with self.bus.lock():
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+
+def format_transactions(entries=None):
+	"""The transaction log as text, one transfer per line"""
+	lines = list()
+	for entry in transactions if entries is None else entries:
+		lines.append("%s.%03i i2c-%i 0x%02x %s%r%s" % (time.strftime("%H:%M:%S", time.localtime(entry.time)),
+			int(entry.time * 1000) % 1000, entry.bus, entry.address, entry.operation, entry.args,
+			"" if entry.error is None else " " + entry.error))
+	return "\n".join(lines)
+
+
+def get_stats():
+	"""Failure and recovery statistics of all buses used so far"""
+	with _buses_lock:
+		return dict((number, dict(bus.stats)) for number, bus in _buses.items())
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Recover a stuck I2C bus (needs root).")
+	parser.add_argument("bus", type=int, nargs="?", default=1, help="Bus number. Default: 1")
+	args = parser.parse_args()
+
+	bus = get_bus(args.bus)
+	ok = bus.recover()
+	print("recovered:%r in %.3fs %s" % (ok, bus.stats["last_recovery_time"], bus.stats["last_error"] or ""))
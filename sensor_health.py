@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Health tracking of the sensors of a monitor
+
+Each sensor gets a circuit breaker with three states:
+
+- healthy: the last reading was valid
+- degraded: the last readings failed, but fewer than open_after in a row.
+  The sensor is still read every cycle.
+- open: open_after readings in a row failed. The sensor is skipped and
+  only probed again after probe_interval, which doubles with every failed
+  probe up to max_probe_interval. A valid reading makes it healthy again.
+"""
+
+import time
+
+HEALTHY = "healthy"
+DEGRADED = "degraded"
+OPEN = "open"
+
+
+class SensorHealth(object):
+	def __init__(self, open_after=5, probe_interval=30.0, max_probe_interval=3600.0):
+		self.open_after = open_after
+		self.probe_interval = probe_interval
+		self.max_probe_interval = max_probe_interval
+		self.state = HEALTHY
+		self.failures = 0
+		self.total_reads = 0
+		self.total_failures = 0
+		self.last_error = None
+		self.next_probe = None
+		self._interval = probe_interval
+
+	def should_read(self, now=None):
+		"""False while the breaker is open and no probe is due"""
+		if self.state != OPEN:
+			return True
+		if now is None:
+			now = time.monotonic()
+		return now >= self.next_probe
+
+	def record(self, valid, error=None, now=None):
+		"""Record the outcome of a reading
+
+		Returns the previous state if the state changed, None otherwise.
+		"""
+		if now is None:
+			now = time.monotonic()
+		previous = self.state
+		self.total_reads += 1
+		if valid:
+			self.failures = 0
+			self.state = HEALTHY
+			self._interval = self.probe_interval
+			self.next_probe = None
+		else:
+			self.failures += 1
+			self.total_failures += 1
+			self.last_error = error
+			if previous == OPEN:
+				# A failed probe, wait longer for the next one
+				self._interval = min(2 * self._interval, self.max_probe_interval)
+				self.next_probe = now + self._interval
+			elif self.failures >= self.open_after:
+				self.state = OPEN
+				self.next_probe = now + self._interval
+			else:
+				self.state = DEGRADED
+		return previous if previous != self.state else None
+
+	def as_dict(self):
+		return {"state": self.state, "failures": self.failures, "total_reads": self.total_reads,
+			"total_failures": self.total_failures, "last_error": self.last_error}
@@ -528,8 +528,8 @@ class SensorMonitorWindow(Gtk.Window):
 	def take_measurements(self, interval):
 		while self._meas_running:
 			next_measurement_time = time.time() + interval
-			readings = self._monitor.get_readings()
-			line = self._monitor.save_readings(datetime.datetime.now(), readings)
+			self._monitor.read_row()
+			line = self._monitor.save_readings(datetime.datetime.now())
 			self.emit("measurement_taken", line)
 			while time.time() < next_measurement_time and self._meas_running:
 				time.sleep(0.1)
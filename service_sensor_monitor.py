@@ -3,7 +3,10 @@
 import os
 from os.path import join
 import json
-from collections import defaultdict
+import math
+import time
+from array import array
+from collections import defaultdict, namedtuple
 
 from w1_temp import W1TempSensor
 from sht21 import SHT21
@@ -12,18 +15,43 @@ from bme280 import BME280
 from sht75 import SHT75
 from bme680 import myBME680
 from dust import DustSensor
+from sensor_health import SensorHealth, HEALTHY
+
+# Capture time of a reading: wall clock and monotonic time when the sensor
+# returned it, and the seconds since the read (or conversion) was started.
+ReadingTime = namedtuple ( "ReadingTime", ( "time", "monotonic", "duration" ) )
+
+# Log columns added per sensor with log_timestamps
+TIMESTAMP_FIELDS = ( "ts", "dur" )
+
+# Fields of drivers in raw mode, logged as integers (see compensate.py)
+RAW_FIELD_SUFFIXES = ( "_raw", "_cal" )
+
+# State of a sensor in the last cycle, PENDING while its conversion runs
+NOT_READ = 0
+INVALID = 1
+VALID = 2
+PENDING = 3
+
+# Columns of a sensor in the reading row: its index, name, the offset of
+# its first column and its fields
+SensorColumns = namedtuple ( "SensorColumns", ( "index", "name", "offset", "fields" ) )
 
 class SensorMonitor ( object ) :
-	KNOWN_SENSORS = { "W1Temp": [W1TempSensor], "SHT21": [SHT21], "DHT11": [DHT11], "BME280": [BME280], "SHT75": [SHT75], "BME680": [myBME680], "DUST": [DustSensor] }
+	# "DustSensor" is the type name save_config writes for the dust sensor
+	KNOWN_SENSORS = { "W1Temp": [W1TempSensor], "SHT21": [SHT21], "DHT11": [DHT11], "BME280": [BME280], "SHT75": [SHT75], "BME680": [myBME680], "DUST": [DustSensor], "DustSensor": [DustSensor] }
 
-	def __init__ ( self, sensors = list ( ), readings_path = None, readings_log_path = None, mrtg_path = "/var/www/scripts/sensoroutput", options_path = None, alarm_number = None ) :
+	def __init__ ( self, sensors = list ( ), readings_path = None, readings_log_path = None, mrtg_path = "/var/www/scripts/sensoroutput", options_path = None, alarm_number = None, log_timestamps = False ) :
 		self._loaded_sensors = list ( )
 		self._readings_path = join ( os.getcwd ( ), "readings.txt" )
 		self._readings_log_path = join ( os.getcwd ( ), "readings_log.txt" )
 		self._mrtg_path = mrtg_path
 		self._log_fields = list ( )
+		self._log_timestamps = log_timestamps
+		self._health = dict ( )
 		self._should_abort = False
 		self._alarms = dict ( )
+		self._build_plan ( )
 		self._alarm_number = 1
 		self._alarm_states = defaultdict ( int )
 		self._alarm_causes = defaultdict ( list )
@@ -60,14 +88,62 @@ class SensorMonitor ( object ) :
 			return
 
 		self._loaded_sensors.append ( sensor )
-		for field in sensor.get_sensor_fields ( ) :
-			self._log_fields.append ( "%s_%s" % ( name, field ) )
+		self._health[name] = SensorHealth ( )
+		self._build_plan ( )
 
 	def remove_sensor ( self, sensor ) :
 		self._loaded_sensors.remove ( sensor )
-		name = sensor.get_sensor_name ( )
-		for field in sensor.get_sensor_fields ( ) :
-			self._log_fields.remove ( "%s_%s" % ( name, field ) )
+		self._health.pop ( sensor.get_sensor_name ( ), None )
+		self._build_plan ( )
+
+	def _sensor_log_fields ( self, sensor ) :
+		fields = list ( sensor.get_sensor_fields ( ) )
+		if self._log_timestamps :
+			fields.extend ( TIMESTAMP_FIELDS )
+		return [ "%s_%s" % ( sensor.get_sensor_name ( ), field ) for field in fields ]
+
+	def _build_plan ( self ) :
+		"""Assign the log columns of each sensor and allocate the reading row
+
+		Every cycle is read into the same row, an array of doubles with one
+		entry per log column, and its mask, which is 1 for the columns that
+		got a value. The capture times go into _times, three entries per
+		sensor, NaN for the sensors that were not read. The state of each
+		sensor in the cycle is kept in _states and the start of its
+		conversion in _starts, so a cycle allocates no containers.
+		"""
+		self._log_fields = list ( )
+		self._columns = dict ( )
+		for index, sensor in enumerate ( self._loaded_sensors ) :
+			self._columns[sensor] = SensorColumns ( index, sensor.get_sensor_name ( ), len ( self._log_fields ),
+				tuple ( sensor.get_sensor_fields ( ) ) )
+			self._log_fields.extend ( self._sensor_log_fields ( sensor ) )
+		self._formats = [ self._field_format ( field ) for field in self._log_fields ]
+		self._row = array ( "d", bytes ( 8 * len ( self._log_fields ) ) )
+		self._mask = bytearray ( len ( self._log_fields ) )
+		self._no_mask = bytes ( len ( self._log_fields ) )
+		self._states = bytearray ( len ( self._loaded_sensors ) )
+		self._no_states = bytes ( len ( self._loaded_sensors ) )
+		self._no_times = array ( "d", [math.nan] * ( 3 * len ( self._loaded_sensors ) ) )
+		self._times = array ( "d", self._no_times )
+		self._starts = array ( "d", bytes ( 8 * len ( self._loaded_sensors ) ) )
+		self._error = None
+		self._build_alarm_columns ( )
+
+	def _build_alarm_columns ( self ) :
+		self._alarm_columns = list ( )
+		for field, limits in self._alarms.items ( ) :
+			columns = [ sensor_columns.offset + sensor_columns.fields.index ( field )
+				for sensor_columns in self._columns.values ( ) if field in sensor_columns.fields ]
+			self._alarm_columns.append ( ( field, limits, columns ) )
+
+	def set_log_timestamps ( self, log_timestamps ) :
+		"""Log the capture time and read duration of each sensor in <sensor>_ts and <sensor>_dur"""
+		self._log_timestamps = log_timestamps
+		self._build_plan ( )
+
+	def get_log_timestamps ( self ) :
+		return self._log_timestamps
 
 	def save_log_fields ( self ) :
 		log_file = open ( self._readings_log_path, "a" )
@@ -92,48 +168,205 @@ class SensorMonitor ( object ) :
 		return "date time %s" % ( " ".join ( self._log_fields ), )
 
 	def get_readings ( self, check_alarm = True ) :
+		"""Read all sensors, returns a dict of the readings by sensor name
+
+		The reading of a sensor is a dict of its fields or None if it is
+		not valid. Sensors not read because of an abort are missing.
+		"""
+		self.read_row ( check_alarm )
 		readings = dict ( )
+		for sensor_columns in self._columns.values ( ) :
+			state = self._states[sensor_columns.index]
+			if state == NOT_READ or state == PENDING :
+				continue
+			if state == INVALID :
+				readings[sensor_columns.name] = None
+				continue
+			reading = dict ( )
+			for column, field in enumerate ( sensor_columns.fields, sensor_columns.offset ) :
+				reading[field] = self._row[column] if self._mask[column] else None
+			readings[sensor_columns.name] = reading
+		return readings
+
+	def read_row ( self, check_alarm = True ) :
+		"""Read all sensors into the reading row, returns the row and its mask
+
+		Both are reused by the next cycle. The columns are those of
+		get_log_fields ( ), the mask is 1 for the columns that got a value.
+		Drivers with a read_into ( row, mask, offset ) method write their
+		fields into the row themselves, from offset on in the order of
+		get_sensor_fields ( ), and return whether the reading is valid.
+		The results of the other drivers are copied into the row.
+		"""
+		self._mask[:] = self._no_mask
+		self._states[:] = self._no_states
+		self._times[:] = self._no_times
 		self._should_abort = False
+
+		# Sensors with an open circuit are skipped until their next probe
+		now = time.monotonic ( )
+		for sensor in self._loaded_sensors :
+			sensor_columns = self._columns[sensor]
+			if not self._health[sensor_columns.name].should_read ( now ) :
+				self._states[sensor_columns.index] = INVALID
+
+		# Trigger all sensors with split-phase conversions first, so their
+		# conversions overlap each other and the plain reads below.
+		ready_time = time.monotonic ( )
+		for sensor in self._loaded_sensors :
+			index = self._columns[sensor].index
+			if self._states[index] != NOT_READ or not hasattr ( sensor, "start_measurement" ) :
+				continue
+			start = time.monotonic ( )
+			delay = self._call_sensor ( sensor.start_measurement )
+			if not self._error is None :
+				self._store_reading ( sensor, None, self._error, start )
+				continue
+			self._states[index] = PENDING
+			self._starts[index] = start
+			ready_time = max ( ready_time, time.monotonic ( ) + delay )
+
 		for sensor in self._loaded_sensors :
-			fields = sensor.get_sensor_fields ( )
-			reading = sensor.read ( )
-			reading_dict = None
-			if reading and reading.is_valid :
-				reading_dict = dict ( )
-				for field in fields :
-					reading_dict[field] = getattr ( reading, field )
-			readings[reading.sensor_name] = reading_dict
 			if self._should_abort :
 				break
+			sensor_columns = self._columns[sensor]
+			if self._states[sensor_columns.index] != NOT_READ :
+				continue
+			start = time.monotonic ( )
+			if hasattr ( sensor, "read_into" ) :
+				reading = self._call_sensor ( sensor.read_into, self._row, self._mask, sensor_columns.offset )
+			else :
+				reading = self._call_sensor ( sensor.read )
+			self._store_reading ( sensor, reading, self._error, start )
+
+		# Sensors may start another conversion phase in collect ( ), which
+		# then returns the time to wait instead of a reading.
+		pending = PENDING in self._states
+		while pending and not self._should_abort :
+			delay = ready_time - time.monotonic ( )
+			if delay > 0 :
+				time.sleep ( delay )
+			pending = False
+			ready_time = time.monotonic ( )
+			for sensor in self._loaded_sensors :
+				index = self._columns[sensor].index
+				if self._states[index] != PENDING :
+					continue
+				reading = self._call_sensor ( sensor.collect )
+				if isinstance ( reading, float ) :
+					pending = True
+					ready_time = max ( ready_time, time.monotonic ( ) + reading )
+				else :
+					self._store_reading ( sensor, reading, self._error, self._starts[index] )
 
 		if check_alarm :
-			self._check_alarm_for_readings ( readings )
+			self._check_alarm_for_row ( )
 
 		self._should_abort = False
-		return readings
+		return ( self._row, self._mask )
+
+	def _call_sensor ( self, func, *args ) :
+		"""The result of func ( *args ), None if it raised, the exception is kept in _error"""
+		self._error = None
+		try :
+			return func ( *args )
+		except Exception as e :
+			self._error = e
+			return None
+
+	def _store_reading ( self, sensor, reading, error = None, start = None ) :
+		"""Put a reading into the row, reading is True or False from read_into"""
+		sensor_columns = self._columns[sensor]
+		offset = sensor_columns.offset
+		count = len ( sensor_columns.fields )
+		now = time.monotonic ( )
+		times = 3 * sensor_columns.index
+		self._times[times] = time.time ( )
+		self._times[times + 1] = now
+		self._times[times + 2] = 0.0 if start is None else now - start
+
+		valid = reading is True or ( bool ( reading ) and reading.is_valid )
+		if valid and not reading is True :
+			for column, field in enumerate ( sensor_columns.fields, offset ) :
+				self._set_column ( column, getattr ( reading, field ) )
+		elif not valid :
+			# read_into may have written some fields before failing
+			for column in range ( offset, offset + count ) :
+				self._mask[column] = 0
+		if valid and self._log_timestamps :
+			self._set_column ( offset + count, self._times[times] )
+			self._set_column ( offset + count + 1, self._times[times + 2] )
+		self._states[sensor_columns.index] = VALID if valid else INVALID
+
+		if not valid and error is None :
+			error = "invalid reading"
+		health = self._health[sensor_columns.name]
+		previous = health.record ( valid, None if valid else str ( error ) )
+		if not previous is None :
+			self._health_changed ( sensor_columns.name, previous, health )
+
+	def _set_column ( self, column, value ) :
+		if value is None or value is False :
+			self._mask[column] = 0
+		else :
+			self._row[column] = value
+			self._mask[column] = 1
+
+	def _health_changed ( self, sensor_name, previous, health ) :
+		if health.last_error is None or health.state == HEALTHY :
+			print ( "Sensor %s: %s -> %s" % ( sensor_name, previous, health.state ) )
+		else :
+			print ( "Sensor %s: %s -> %s (%s)" % ( sensor_name, previous, health.state, health.last_error ) )
+
+	def get_sensor_states ( self ) :
+		return dict ( ( name, health.as_dict ( ) ) for name, health in self._health.items ( ) )
+
+	def get_reading_times ( self ) :
+		"""ReadingTime per sensor read by the last cycle"""
+		reading_times = dict ( )
+		for sensor_columns in self._columns.values ( ) :
+			times = 3 * sensor_columns.index
+			if not math.isnan ( self._times[times] ) :
+				reading_times[sensor_columns.name] = ReadingTime ( *self._times[times:times + 3] )
+		return reading_times
 
 	def abort ( self ) :
 		self._should_abort = True
 
-	def _generate_readings_line ( self, datetime, readings ) :
-		log_dict = dict ( )
-		for sensor_name, reading in readings.items ( ) :
+	def _fill_row ( self, readings ) :
+		"""Put the readings of a get_readings ( ) dict into the row"""
+		self._mask[:] = self._no_mask
+		for sensor_columns in self._columns.values ( ) :
+			reading = readings.get ( sensor_columns.name )
 			if reading is None :
 				continue
-			for field_name, value in reading.items ( ) :
-				log_field = "%s_%s" % ( sensor_name, field_name )
-				log_dict[log_field] = value
-
-		reading_line = datetime.isoformat ( " " )
-		for field in self._log_fields :
-			reading_line += " "
-			if field in log_dict and log_dict[field] != False and not log_dict[field] is None :
-				reading_line += "%.2f" % ( log_dict[field], )
-
-		return reading_line
-
-	def save_readings ( self, datetime, readings ) :
-		reading_line = self._generate_readings_line ( datetime, readings )
+			for column, field in enumerate ( sensor_columns.fields, sensor_columns.offset ) :
+				self._set_column ( column, reading.get ( field ) )
+			times = 3 * sensor_columns.index
+			if self._log_timestamps and not math.isnan ( self._times[times] ) :
+				column = sensor_columns.offset + len ( sensor_columns.fields )
+				self._set_column ( column, self._times[times] )
+				self._set_column ( column + 1, self._times[times + 2] )
+
+	def _generate_readings_line ( self, datetime ) :
+		reading_line = [ datetime.isoformat ( " " ) ]
+		for column in range ( len ( self._row ) ) :
+			reading_line.append ( self._formats[column] % ( self._row[column], ) if self._mask[column] else "" )
+		return " ".join ( reading_line )
+
+	def _field_format ( self, log_field ) :
+		# Capture times are seconds since the epoch, they need milliseconds
+		if self._log_timestamps and log_field.rsplit ( "_", 1 )[-1] in TIMESTAMP_FIELDS :
+			return "%.3f"
+		if log_field.endswith ( RAW_FIELD_SUFFIXES ) :
+			return "%i"
+		return "%.2f"
+
+	def save_readings ( self, datetime, readings = None ) :
+		"""Log the readings of a get_readings ( ) dict, by default the row of the last cycle"""
+		if not readings is None :
+			self._fill_row ( readings )
+		reading_line = self._generate_readings_line ( datetime )
 
 		log_file = open ( self._readings_log_path, "a" )
 		log_file.write ( reading_line + "\n" )
@@ -142,6 +375,8 @@ class SensorMonitor ( object ) :
 		cur_file = open ( self._readings_path, "w" )
 		cur_file.write ( "#{}\n".format ( self.get_log_fields ( ) ) )
 		cur_file.write ( reading_line )
+		states = [ "%s=%s" % ( name, health.state ) for name, health in self._health.items ( ) ]
+		cur_file.write ( "\n#states %s" % ( " ".join ( states ), ) )
 		cur_file.close ( )
 
 		#if self._mrtg_path != False:
@@ -171,6 +406,7 @@ class SensorMonitor ( object ) :
 		options["readings_log_path"] = self.get_readings_log_path ( )
 		options["alarms"] = self._alarms.copy ( )
 		options["alarm_number"] = self._alarm_number
+		options["log_timestamps"] = self._log_timestamps
 		return options
 
 	def set_options_from_file ( self, path, add_sensors = False ) :
@@ -181,6 +417,8 @@ class SensorMonitor ( object ) :
 		fp = open ( path, "r" )
 		options = json.load ( fp )
 		fp.close ( )
+		if "log_timestamps" in options :
+			self.set_log_timestamps ( bool ( options["log_timestamps"] ) )
 		if "sensors" in options :
 			sensors = self.load_sensors ( options["sensors"] )
 		if add_sensors :
@@ -201,6 +439,7 @@ class SensorMonitor ( object ) :
 		low = min ( limit1, limit2 )
 		high = max ( limit1, limit2 )
 		self._alarms[field_name] = ( low, high )
+		self._build_alarm_columns ( )
 
 	def get_alarm_limits ( self, field_name ) :
 		if not field_name in self._alarms :
@@ -211,6 +450,7 @@ class SensorMonitor ( object ) :
 	def unset_alarm_for ( self, field_name ) :
 		if field_name in self._alarms :
 			del self._alarms[field_name]
+			self._build_alarm_columns ( )
 
 	def set_alarm_number ( self, alarm_number ) :
 		self._alarm_number = alarm_number
@@ -221,17 +461,16 @@ class SensorMonitor ( object ) :
 	def _check_alarm_for_count ( self, field, count ) :
 		return count >= self._alarm_number
 
-	def _check_alarm_for_readings ( self, readings ) :
+	def _check_alarm_for_row ( self ) :
 		alarm = False
 		states_per_reading = defaultdict ( int )
 		cause_per_reading = defaultdict ( list )
 
-		for sensor_name, reading in readings.items ( ) :
-			if reading is None :
-				continue
-			for field in ( self._alarms.keys ( ) & reading.keys ( ) ) :
-				limits = self._alarms[field]
-				value = reading[field]
+		for field, limits, columns in self._alarm_columns :
+			for column in columns :
+				if not self._mask[column] :
+					continue
+				value = self._row[column]
 				if not limits[0] <= value <= limits[1] :
 					states_per_reading[field] += 1
 					cause_per_reading[field].append ( value )
@@ -266,7 +505,6 @@ class SensorMonitor ( object ) :
 if __name__ == "__main__" :
 	from argparse import ArgumentParser
 	import datetime
-	import time
 	import sys
 
 	parser = ArgumentParser ( description = "Monitor various sensors over time." )
@@ -277,6 +515,7 @@ if __name__ == "__main__" :
 	parser.add_argument ( "--alarm-temp", type = float, nargs = 2, help = "If set, alarm will be rang if temperature is not within these two values for alarm_num times." )
 	parser.add_argument ( "--alarm-hum", type = float, nargs = 2, help = "If set, alarm will be rang if humidity is not within these two values for alarm_num times." )
 	parser.add_argument ( "--alarm-pres", type = float, nargs = 2, help = "If set, alarm will be rang if pressure is not within these two values for alarm-num times." )
+	parser.add_argument ( "--log-timestamps", action = "store_true", help = "Log the capture time and read duration of each sensor in <sensor>_ts and <sensor>_dur columns." )
 	parser.add_argument ( "--num-alarm", type = int, help = "The number of times a measurement can be (successive) outside of the limits given by the --alarm-* options. Default: 1" )
 	parser.add_argument ( "--w1", action = "store_true", help = "Enable W1 sensors and try to auto-detect them." )
 	parser.add_argument ( "--dht11", action = "store_true", help = "Enable DHT11 sensors and try to auto-detect them." )
@@ -314,6 +553,8 @@ if __name__ == "__main__" :
 		monitor = SensorMonitor ( sensors, readings_path, readings_log_path, options_path=args.config, alarm_number = args.num_alarm )
 	else :
 		monitor = SensorMonitor ( sensors, readings_path, readings_log_path, alarm_number = args.num_alarm )
+	if args.log_timestamps :
+		monitor.set_log_timestamps ( True )
 	if not args.alarm_temp is None :
 		monitor.set_alarm_limits ( "temp", args.alarm_temp[0], args.alarm_temp[1] )
 	if not args.alarm_hum is None :
@@ -331,7 +572,7 @@ if __name__ == "__main__" :
 
 	#print ( monitor.save_log_fields ( ) )
 	while True :
-		readings = monitor.get_readings ( )
-		line = monitor.save_readings ( datetime.datetime.now ( ), readings )
+		monitor.read_row ( )
+		line = monitor.save_readings ( datetime.datetime.now ( ) )
 		#print ( line )
 		time.sleep ( args.interval )
@@ -17,20 +17,28 @@
 # 24.06.2015    Martin Steppuhn     Initial version
 
 import RPi.GPIO as GPIO  # http://sourceforge.net/p/raspberry-gpio-python/wiki/Home/
-import fcntl
+import errno
 import time
 from collections import namedtuple
 
+import crc
+import gpio_cdev
+import i2c_bus
+
 class I2C(object):
 	"""Wrapper class for I2C with raspberry Pi
 
-	Open the "internal" I2C Port with driver or emulate an I2C Bus on GPIO
+	Open the "internal" I2C Port with driver or emulate an I2C Bus on GPIO.
+	The emulation uses the GPIO character device if libgpiod is available
+	and RPi.GPIO otherwise.
 	"""
 	addr = 0
 	dev = None
 	gpio_scl = 0
 	gpio_sda = 0
-	delay = 0.001
+	delay = 0.000005  # half bit time, ~100kHz
+	stretch_timeout = 0.01
+	_lines = None
 
 	def open(self,addr=0, dev=1, scl=0, sda=0):
 		"""Open I2C-Port
@@ -47,18 +55,25 @@ class I2C(object):
 		self.gpio_sda = sda
 
 		if (self.dev == None):
-			GPIO.setwarnings(False)
-			GPIO.setmode(GPIO.BCM)
-			GPIO.setup(self.gpio_scl, GPIO.IN)  # SCL=1
-			GPIO.setup(self.gpio_sda, GPIO.IN)  # SDA=1
+			if gpio_cdev.available():
+				self._lines = gpio_cdev.OpenDrainLines([self.gpio_scl, self.gpio_sda])
+			else:
+				GPIO.setwarnings(False)
+				GPIO.setmode(GPIO.BCM)
+				GPIO.setup(self.gpio_scl, GPIO.IN)  # SCL=1
+				GPIO.setup(self.gpio_sda, GPIO.IN)  # SDA=1
 		else:
-			self.dev_i2c = open(("/dev/i2c-%s" % self.dev), 'rb+', 0)
-			fcntl.ioctl(self.dev_i2c, 0x0706, self.addr)  # I2C Address
+			# Shared descriptor with the address set, transfers lock the bus
+			self.dev_i2c = i2c_bus.get_bus(self.dev).device(self.addr)
 
 	def close(self):
 		if (self.dev == None):
-			GPIO.setup(self.gpio_scl, GPIO.IN)  # SCL=1
-			GPIO.setup(self.gpio_sda, GPIO.IN)  # SDA=1
+			if self._lines is not None:
+				self._lines.close()
+				self._lines = None
+			else:
+				GPIO.setup(self.gpio_scl, GPIO.IN)  # SCL=1
+				GPIO.setup(self.gpio_sda, GPIO.IN)  # SDA=1
 		else:
 			self.dev_i2c.close()
 
@@ -77,23 +92,26 @@ class I2C(object):
 			d = bytes(data)
 			self.dev_i2c.write(d)
 
-	def read(self, size):
+	def read(self, size, expect_nack=False):
 		"""Read Bytes from I2C Device
 
 		:param size: Number of Bytes to read
+		:param expect_nack: a NACK is part of the protocol, not a bus error
 		:return: List with bytes
 		"""
-		data = dict()
+		data = list()
 		if (self.dev == None):
 			self._i2c_gpio_start()
 			ack = self._i2c_gpio_write_byte((self.addr << 1) + 1)  # set READ-BIT
-			# if not ack: print("I2C-ERROR: READ,NACK1")
+			if not ack:
+				self._i2c_gpio_stop()
+				raise IOError(errno.EREMOTEIO, "I2C-ERROR: READ,NACK1")
 			for i in range(size):
 				ack = True if ((i + 1) < size) else False
-				data[i] = self._i2c_gpio_read_byte(ack)
+				data.append(self._i2c_gpio_read_byte(ack))
 			self._i2c_gpio_stop()
 		else:
-			data = self.dev_i2c.read(size)
+			data = self.dev_i2c.read(size, expect_nack)
 		return (data)
 
 	##########################################################################
@@ -102,103 +120,179 @@ class I2C(object):
 	##########################################################################
 	##########################################################################
 
+	def _gpio_set(self, pin, value):
+		"""Release (1) or pull down (0) a line"""
+		if self._lines is not None:
+			self._lines.set(pin, value)
+		elif value:
+			GPIO.setup(pin, GPIO.IN)
+		else:
+			GPIO.setup(pin, GPIO.OUT)
+			GPIO.output(pin, 0)
+
+	def _gpio_get(self, pin):
+		if self._lines is not None:
+			return self._lines.get(pin)
+		return GPIO.input(pin)
+
+	def _scl_high(self):
+		"""Release SCL and wait while the slave is stretching the clock"""
+		self._gpio_set(self.gpio_scl, 1)
+		if self._gpio_get(self.gpio_scl):
+			return
+		deadline = time.perf_counter() + self.stretch_timeout
+		while not self._gpio_get(self.gpio_scl):
+			if time.perf_counter() > deadline:
+				raise IOError(errno.ETIMEDOUT, "I2C-ERROR: clock stretching timeout")
+
 	def _i2c_gpio_start(self):
 		"""Send Start"""
-		GPIO.setup(self.gpio_scl, GPIO.IN)  # SCL=1
-		GPIO.setup(self.gpio_sda, GPIO.IN)  # SDA=1
-		time.sleep(2 * self.delay)
-		GPIO.setup(self.gpio_sda, GPIO.OUT)  # SDA=0
-		GPIO.output(self.gpio_sda, 0)
-		time.sleep(2 * self.delay)
-		GPIO.setup(self.gpio_scl, GPIO.OUT)  # SCL=0
-		GPIO.output(self.gpio_scl, 0)
+		self._gpio_set(self.gpio_scl, 1)  # SCL=1
+		self._gpio_set(self.gpio_sda, 1)  # SDA=1
+		gpio_cdev.delay(2 * self.delay)
+		self._gpio_set(self.gpio_sda, 0)  # SDA=0
+		gpio_cdev.delay(2 * self.delay)
+		self._gpio_set(self.gpio_scl, 0)  # SCL=0
 
 	def _i2c_gpio_stop(self):
 		"""Send Stop"""
-		GPIO.setup(self.gpio_sda, GPIO.OUT)  # SDA=0
-		GPIO.output(self.gpio_sda, 0)
-		time.sleep(2 * self.delay)
-		GPIO.setup(self.gpio_scl, GPIO.IN)  # SCL=1
-		time.sleep(2 * self.delay)
-		GPIO.setup(self.gpio_sda, GPIO.IN)  # SDA=1
-		time.sleep(2 * self.delay)
+		self._gpio_set(self.gpio_sda, 0)  # SDA=0
+		gpio_cdev.delay(2 * self.delay)
+		self._scl_high()  # SCL=1
+		gpio_cdev.delay(2 * self.delay)
+		self._gpio_set(self.gpio_sda, 1)  # SDA=1
+		gpio_cdev.delay(2 * self.delay)
 
 	def _i2c_gpio_write_byte(self, data):
 		"""Write a single byte"""
 		for i in range(8):  # stop
-			if (data & 0x80):
-				GPIO.setup(self.gpio_sda, GPIO.IN)  # SDA=1
-			else:
-				GPIO.setup(self.gpio_sda, GPIO.OUT)  # SDA=0
-				GPIO.output(self.gpio_sda, 0)
+			self._gpio_set(self.gpio_sda, data & 0x80)  # SDA=bit
 			data = data << 1
-			time.sleep(self.delay)
-			GPIO.setup(self.gpio_scl, GPIO.IN)  # SCL=1
-			time.sleep(self.delay)
-			# Clockstretching ToDo
-			GPIO.setup(self.gpio_scl, GPIO.OUT)  # SCL=0
-			GPIO.output(self.gpio_scl, 0)
-			time.sleep(self.delay)
-
-		GPIO.setup(self.gpio_sda, GPIO.IN)  # SDA=1
-		time.sleep(self.delay)
-		GPIO.setup(self.gpio_scl, GPIO.IN)  # SCL=1
-		time.sleep(self.delay)
-		# Clockstretching ToDo
-		ack = True if (GPIO.input(self.gpio_sda) == 0) else False
-		GPIO.setup(self.gpio_scl, GPIO.OUT)  # SCL=0
-		GPIO.output(self.gpio_scl, 0)
-		time.sleep(self.delay)
+			gpio_cdev.delay(self.delay)
+			self._scl_high()  # SCL=1
+			gpio_cdev.delay(self.delay)
+			self._gpio_set(self.gpio_scl, 0)  # SCL=0
+			gpio_cdev.delay(self.delay)
+
+		self._gpio_set(self.gpio_sda, 1)  # SDA=1
+		gpio_cdev.delay(self.delay)
+		self._scl_high()  # SCL=1
+		gpio_cdev.delay(self.delay)
+		ack = True if (self._gpio_get(self.gpio_sda) == 0) else False
+		self._gpio_set(self.gpio_scl, 0)  # SCL=0
+		gpio_cdev.delay(self.delay)
 		return (ack)  # SCL=0 SDA=1
 
 	def _i2c_gpio_read_byte(self, ack):
 		"""Read a single byte"""
 		data = 0
 		for i in range(8):  # stop
-			time.sleep(self.delay)
-			GPIO.setup(self.gpio_scl, GPIO.IN)  # SCL=1
-			time.sleep(self.delay)
-			# Clockstretching ToDo
-			data = data << 1
-			if (GPIO.input(self.gpio_sda)):
-				data |= 1
-			else:
-				data &= ~1
-			GPIO.setup(self.gpio_scl, GPIO.OUT)  # SCL=0
-			GPIO.output(self.gpio_scl, 0)
+			gpio_cdev.delay(self.delay)
+			self._scl_high()  # SCL=1
+			gpio_cdev.delay(self.delay)
+			data = (data << 1) | (1 if self._gpio_get(self.gpio_sda) else 0)
+			self._gpio_set(self.gpio_scl, 0)  # SCL=0
 
 		# ACK Bit ausgeben
-		if (ack):
-			GPIO.setup(self.gpio_sda, GPIO.OUT)  # SDA=0
-			GPIO.output(self.gpio_sda, 0)
-		else:
-			GPIO.setup(self.gpio_sda, GPIO.IN)  # SDA=1
-
-		time.sleep(self.delay)
-		GPIO.setup(self.gpio_scl, GPIO.IN)  # SCL=1
-		time.sleep(self.delay)
-		# Clockstretching ToDo
-		GPIO.setup(self.gpio_scl, GPIO.OUT)  # SCL=0
-		GPIO.output(self.gpio_scl, 0)
-		time.sleep(self.delay)
-		GPIO.setup(self.gpio_sda, GPIO.IN)  # SDA=1  freigeben
+		self._gpio_set(self.gpio_sda, 0 if ack else 1)
+
+		gpio_cdev.delay(self.delay)
+		self._scl_high()  # SCL=1
+		gpio_cdev.delay(self.delay)
+		self._gpio_set(self.gpio_scl, 0)  # SCL=0
+		gpio_cdev.delay(self.delay)
+		self._gpio_set(self.gpio_sda, 1)  # SDA=1  freigeben
 		return (data)
 		
 SHT21Result = namedtuple("SHT21Result", ("sensor_name", "is_valid", "temp", "hum"))
 
+# Temperature bits: (user register bits, T (typ, max) seconds, RH bits, RH (typ, max) seconds)
+SHT21_RESOLUTIONS = {
+	14: (0x00, (0.066, 0.085), 12, (0.022, 0.029)),
+	13: (0x80, (0.033, 0.043), 10, (0.007, 0.009)),
+	12: (0x01, (0.017, 0.022), 8, (0.003, 0.004)),
+	11: (0x81, (0.009, 0.011), 11, (0.012, 0.015)),
+}
+SHT21_RESOLUTION_MASK = 0x81
+
 class SHT21(object):
-	def __init__(self, i2c_bus_number, i2c_address):
+	POLL_INTERVAL = 0.002
+
+	def __init__(self, i2c_bus_number, i2c_address, resolution=14, persistent=True):
+		"""resolution: temperature resolution in bits (14, 13, 12 or 11), the
+		humidity resolution follows from it (12, 10, 8 or 11 bits).
+		persistent: keep the I2C device open between reads and only
+		soft reset the sensor after an error. Otherwise the device is opened
+		and reset for every read."""
+		if resolution not in SHT21_RESOLUTIONS:
+			raise ValueError("Unsupported SHT21 resolution.", resolution)
 		self._bus_number = i2c_bus_number
 		self._address = i2c_address
+		self._resolution = resolution
+		self._persistent = persistent
+		self._is_open = False
+		self._pending = None
+		self._pending_t = None
 		self._i2c = I2C()     # I2C Wrapper Class
 		self._eid = self.read_electronic_id()
 		if self._eid is None:
-			raise ValueError("No I2C sensor on these pins.", scl_pin, sda_pin)
+			raise ValueError("No I2C sensor at this address.", i2c_bus_number, i2c_address)
+		# Reopening after a bus recovery resets the sensor and restores the resolution
+		i2c_bus.get_bus(i2c_bus_number).add_recovery_listener(self.close)
 		
 	def read(self):
-		self.open()
-		t = self.read_temperature()
-		hum = self.read_humidity()
+		t = None
+		hum = None
+		try:
+			if not self._is_open:
+				self.open()
+			t = self.read_temperature()
+			hum = self.read_humidity()
+		except (IOError, OSError):
+			pass
+		return self._make_result(t, hum)
+
+	def start_measurement(self):
+		"""Trigger a temperature conversion without waiting for it
+
+		Returns the time in seconds until the result should be ready.
+		"""
+		self._pending_t = None
+		try:
+			if not self._is_open:
+				self.open()
+			self._i2c.write([0xF3])
+		except (IOError, OSError):
+			self._pending = None
+			return 0.0
+		self._pending = 0xF3
+		return SHT21_RESOLUTIONS[self._resolution][1][0]
+
+	def collect(self):
+		"""Finish a measurement started with start_measurement
+
+		After fetching the temperature the humidity conversion is triggered
+		and the time in seconds until it is ready is returned instead of a
+		result. collect has to be called again after that time.
+		"""
+		pending = self._pending
+		self._pending = None
+		try:
+			if pending == 0xF3:
+				typ_time, max_time = SHT21_RESOLUTIONS[self._resolution][1]
+				self._pending_t = self._convert_temperature(self._fetch(max_time - typ_time))
+				self._i2c.write([0xF5])
+				self._pending = 0xF5
+				return SHT21_RESOLUTIONS[self._resolution][3][0]
+			elif pending == 0xF5:
+				typ_time, max_time = SHT21_RESOLUTIONS[self._resolution][3]
+				hum = self._convert_humidity(self._fetch(max_time - typ_time))
+				return self._make_result(self._pending_t, hum)
+		except (IOError, OSError):
+			pass
+		return self._make_result(None, None)
+
+	def _make_result(self, t, hum):
 		is_valid = True
 		if t is None:
 			is_valid = False
@@ -206,20 +300,67 @@ class SHT21(object):
 		if hum is None:
 			is_valid = False
 			hum = 0
-		self._i2c.close()
+		if not is_valid or not self._persistent:
+			# Reopening will soft reset the sensor
+			self.close()
 		return SHT21Result(self.get_sensor_name(), is_valid, t, hum)
 		
 	def open(self):
 		self._i2c.open(self._address, self._bus_number)
+		self._is_open = True
+		self.reset()
+		if self._resolution != 14:
+			self.set_resolution(self._resolution)
+
+	def reset(self):
 		self._i2c.write([0xFE])  # execute Softreset Command  (default T=14Bit RH=12)
-		time.sleep(0.050)
-		
+		time.sleep(0.015)  # soft reset takes less than 15ms
+
+	def read_user_register(self):
+		self._i2c.write([0xE7])
+		return self._i2c.read(1)[0]
+
+	def set_resolution(self, resolution):
+		"""Select the measurement resolution by its temperature bits"""
+		if resolution not in SHT21_RESOLUTIONS:
+			raise ValueError("Unsupported SHT21 resolution.", resolution)
+		register = self.read_user_register()
+		bits = SHT21_RESOLUTIONS[resolution][0]
+		if register & SHT21_RESOLUTION_MASK != bits:
+			# Reserved bits must not be changed
+			self._i2c.write([0xE6, (register & ~SHT21_RESOLUTION_MASK) | bits])
+		self._resolution = resolution
+
+	def _measure(self, command, typ_time, max_time):
+		"""Trigger a measurement (no hold master) and poll for the result"""
+		self._i2c.write([command])
+		time.sleep(typ_time)
+		return self._fetch(max_time - typ_time)
+
+	def _fetch(self, timeout):
+		"""Read a measurement result, retrying for up to timeout seconds
+
+		The sensor does not acknowledge its address until the conversion is
+		done, so reading is retried until then.
+		"""
+		deadline = time.monotonic() + timeout + self.POLL_INTERVAL
+		while True:
+			try:
+				return self._i2c.read(3, expect_nack=True)
+			except (IOError, OSError):
+				if time.monotonic() > deadline:
+					raise
+				time.sleep(self.POLL_INTERVAL)
 
 	def read_temperature(self):
-		""" Temperature measurement (no hold master), blocking for ~ 88ms !!! """
-		self._i2c.write([0xF3])
-		time.sleep(0.086)  # wait, typ=66ms, max=85ms @ 14Bit resolution
-		data = self._i2c.read(3)
+		""" Temperature measurement (no hold master), typ=66ms, max=85ms @ 14Bit resolution, max=11ms @ 11Bit """
+		return self._convert_temperature(self._measure(0xF3, *SHT21_RESOLUTIONS[self._resolution][1]))
+
+	def read_humidity(self):
+		""" RH measurement (no hold master), typ=22ms, max=29ms @ 12Bit resolution, max=4ms @ 8Bit """
+		return self._convert_humidity(self._measure(0xF5, *SHT21_RESOLUTIONS[self._resolution][3]))
+
+	def _convert_temperature(self, data):
 		if (self._check_crc(data, 2)):
 			t = ((data[0] << 8) + data[1]) & 0xFFFC  # set status bits to zero
 			t = -46.82 + ((t * 175.72) / 65536)  # T = 46.82 + (175.72 * ST/2^16 )
@@ -227,11 +368,7 @@ class SHT21(object):
 		else:
 			return None
 
-	def read_humidity(self):
-		""" RH measurement (no hold master), blocking for ~ 32ms !!! """
-		self._i2c.write([0xF5])  # Trigger RH measurement (no hold master)
-		time.sleep(0.03)  # wait, typ=22ms, max=29ms @ 12Bit resolution
-		data = self._i2c.read(3)
+	def _convert_humidity(self, data):
 		if (self._check_crc(data, 2)):
 			rh = ((data[0] << 8) + data[1]) & 0xFFFC  # zero the status bits
 			rh = -6 + ((125 * rh) / 65536)
@@ -241,7 +378,18 @@ class SHT21(object):
 			return None
 			
 	def read_electronic_id(self):
-		self.open()
+		if not self._is_open:
+			self.open()
+		try:
+			eid = self._read_electronic_id()
+		except (IOError, OSError):
+			self.close()
+			raise
+		if eid is None or not self._persistent:
+			self.close()
+		return eid
+
+	def _read_electronic_id(self):
 		self._i2c.write([0xFA, 0x0F])
 		data = self._i2c.read(8)
 		snb = 0
@@ -262,23 +410,16 @@ class SHT21(object):
 		return (format(sna, "x").zfill(4)
 			+ format(snb, "x").zfill(8)
 			+ format(snc, "x").zfill(4))
-		self.close()
 
 	def close(self):
 		"""Closes the i2c connection"""
-		self.i2c.close()
+		if self._is_open:
+			self._is_open = False
+			self._i2c.close()
 
 	def _check_crc(self, data, length):
 		"""Calculates checksum for n bytes of data and compares it with expected"""
-		crc = 0
-		for i in range(length):
-			crc ^= (ord(chr(data[i])))
-			for bit in range(8, 0, -1):
-				if crc & 0x80:
-					crc = (crc << 1) ^ 0x131  # CRC POLYNOMIAL
-				else:
-					crc = (crc << 1)
-		return True if (crc == data[length]) else False
+		return crc.crc8(data[:length]) == data[length]
 		
 	def get_sensor_type_name(self):
 		return "SHT21"
@@ -290,7 +431,7 @@ class SHT21(object):
 		return ["temp", "hum"]
 		
 	def get_sensor_options(self):
-		return (self._bus_number, self._address)
+		return (self._bus_number, self._address, self._resolution)
 		
 	@staticmethod
 	def detect_sensors():
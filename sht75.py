@@ -2,30 +2,35 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import abc
 import functools as ft
 import logging
 import math
-import os
 import sys
 import time
 from collections import namedtuple
 
 from builtins import range
 
+import calibration
+import crc
+import gpio_cdev
+
 try: import sht_sensor
 except ImportError:
+	# Only SysfsTransport needs it and imports it when created.
 	# Make sure tool works from a checkout
-	if __name__ != '__main__': raise
-	from os.path import dirname, exists, isdir, join, abspath
-	pkg_root = abspath(dirname(__file__))
-	for pkg_root in pkg_root, dirname(pkg_root):
-		if isdir(join(pkg_root, 'sht_sensor'))\
-				and exists(join(pkg_root, 'setup.py')):
-			sys.path.insert(0, pkg_root)
-			try: import sht_sensor
-			except ImportError: pass
-			else: break
-	else: raise ImportError('Failed to find/import "sht_sensor" module')
+	if __name__ == '__main__':
+		from os.path import dirname, exists, isdir, join, abspath
+		pkg_root = abspath(dirname(__file__))
+		for pkg_root in pkg_root, dirname(pkg_root):
+			if isdir(join(pkg_root, 'sht_sensor'))\
+					and exists(join(pkg_root, 'setup.py')):
+				sys.path.insert(0, pkg_root)
+				try: import sht_sensor
+				except ImportError: pass
+				else: break
+		else: raise ImportError('Failed to find/import "sht_sensor" module')
 
 
 @ft.total_ordering
@@ -67,24 +72,6 @@ class Enum(object):
 		return '<Enum {} [{}]>'.format(self._name, ' '.join(sorted(self._values.keys())))
 
 
-try: import ctypes as ct
-except ImportError: mono_time = None
-else:
-	def mono_time():
-		if not hasattr(mono_time, 'ts'):
-			class timespec(ct.Structure):
-				_fields_ = [('tv_sec', ct.c_long), ('tv_nsec', ct.c_long)]
-			librt = ct.CDLL('librt.so.1', use_errno=True)
-			mono_time.get = librt.clock_gettime
-			mono_time.get.argtypes = [ct.c_int, ct.POINTER(timespec)]
-			mono_time.ts = timespec
-		ts = mono_time.ts()
-		if mono_time.get(4, ct.pointer(ts)) != 0:
-			err = ct.get_errno()
-			raise OSError(err, os.strerror(err))
-		return ts.tv_sec + ts.tv_nsec * 1e-9
-
-
 ShtVDDLevel = Enum('sht-vdd-level', dict(
 	vdd_5='5V', vdd_4='4V', vdd_3_5='3.5V', vdd_3='3V', vdd_2_5='2.5V' ))
 
@@ -93,54 +80,229 @@ class ShtFailure(Exception): pass
 class ShtCommFailure(ShtFailure): pass
 class ShtCRCCheckError(ShtFailure): pass
 
+class ShtTransport(abc.ABC):
+	'''Pin access used by ShtComms.
+		Directions are "in", "out" and "low" (output, driven low).
+		Transports that can sleep on edge events set edge_events and
+			provide wait_value(pin, v, timeout), which returns False if
+			the pin did not read v within timeout seconds.
+			Otherwise ShtComms polls the pin itself.'''
+
+	edge_events = False
+
+	@abc.abstractmethod
+	def set_direction(self, pin, direction):
+		'Switch pin to direction, "in", "out" or "low".'
+
+	@abc.abstractmethod
+	def set(self, pin, v):
+		'Drive the output pin high (v true) or low.'
+
+	@abc.abstractmethod
+	def get(self, pin):
+		'Level of the pin, 0 or 1.'
+
+	def close(self):
+		'Release the pins.'
+
+
+class SysfsTransport(ShtTransport):
+	'Pins through the sht_sensor.gpio sysfs helper (or a module with its calls).'
+
+	def __init__(self, gpio=None):
+		if gpio is None:
+			from sht_sensor import gpio
+		self.gpio = gpio
+
+	def set_direction(self, pin, direction):
+		self.gpio.set_pin_value(pin, k='direction', v=direction)
+
+	def set(self, pin, v):
+		self.gpio.set_pin_value(pin, v, force=True)
+
+	def get(self, pin):
+		return self.gpio.get_pin_value(pin)
+
+
+class CdevTransport(ShtTransport):
+	'''Pins through the GPIO character device.
+		The lines stay requested, so every edge is a single ioctl.'''
+
+	edge_events = True
+
+	def __init__(self, pins, chip=gpio_cdev.DEFAULT_CHIP):
+		self.lines = gpio_cdev.Lines(pins, chip)
+
+	def set_direction(self, pin, direction):
+		self.lines.set_direction(pin, direction)
+
+	def set(self, pin, v):
+		self.lines.set(pin, v)
+
+	def get(self, pin):
+		return self.lines.get(pin)
+
+	def wait_value(self, pin, v, timeout):
+		return self.lines.wait_value(pin, v, timeout)
+
+	def close(self):
+		self.lines.close()
+
+
+class SimulatedTransport(ShtTransport):
+	'''Simulated SHT7x sensor on two pins, for testing without hardware.
+		Decodes transmission start, commands, status register writes and
+			answers measurements with t_raw/rh_raw and a valid CRC.
+		Measurements are ready conv_time seconds after the command.
+		The commands received are appended to commands.'''
+
+	edge_events = True
+
+	def __init__(self, pin_sck, pin_data, t_raw=6400, rh_raw=1500, conv_time=0.0005):
+		self.pin_sck, self.pin_data = pin_sck, pin_data
+		self.t_raw, self.rh_raw, self.conv_time = t_raw, rh_raw, conv_time
+		self.status = 0
+		self.edges = 0
+		self._sck = 0
+		self._master_data = 1
+		self._master_output = False
+		self._state = 'idle'
+		self._start_low = False
+		self._shift = self._bits = 0
+		self._sensor_low = False
+		self._ready_at = None
+		self._reply = self._reply_bit = None
+		self.commands = list()
+
+	def set_direction(self, pin, direction):
+		if pin == self.pin_data:
+			self._master_output = direction != 'in'
+			self._data_changed(0 if direction == 'low' else self._master_data)
+		else:
+			self._sck_changed(0)
+
+	def set(self, pin, v):
+		v = 1 if v else 0
+		if pin == self.pin_data: self._data_changed(v)
+		else: self._sck_changed(v)
+
+	def get(self, pin):
+		if pin == self.pin_sck: return self._sck
+		return 0 if self._level_low() else 1
+
+	def reset(self):
+		'Power loss or soft reset of the sensor, clears the status register.'
+		self.status = 0
+
+	def wait_value(self, pin, v, timeout):
+		if self._ready_at is not None:
+			remaining = self._ready_at - time.monotonic()
+			if remaining > timeout: return False
+			if remaining > 0: time.sleep(remaining)
+		return self.get(pin) == v
+
+	def _level_low(self):
+		if self._master_output and not self._master_data: return True
+		if self._ready_at is not None:
+			return time.monotonic() >= self._ready_at
+		if self._reply is not None:
+			return self._reply_level() == 0
+		return self._sensor_low
+
+	def _reply_level(self):
+		byte, bit = divmod(self._reply_bit, 9)
+		if byte >= len(self._reply) or bit == 8: return 1
+		return (self._reply[byte] >> (7 - bit)) & 1
+
+	def _data_changed(self, v):
+		if self._master_output and self._sck and v != self._master_data:
+			# DATA changing while SCK is high frames a transmission start
+			if not v: self._start_low = True
+			elif self._start_low:
+				self._start_low = False
+				self._state, self._shift, self._bits = 'cmd', 0, 0
+				self._reply = self._ready_at = None
+				self._sensor_low = False
+		self._master_data = v
+
+	def _sck_changed(self, v):
+		if v == self._sck: return
+		self._sck = v
+		self.edges += 1
+		if v:
+			if self._ready_at is not None and self._level_low():
+				# Conversion done, the clock now shifts out the result
+				self._ready_at = None
+				self._state = 'reply'
+			if self._state in ('cmd', 'status') and self._bits < 8:
+				self._shift = (self._shift << 1) | (0 if self._level_low() else 1)
+				self._bits += 1
+			return
+		if self._state == 'reply':
+			self._reply_bit += 1
+		elif self._state in ('cmd', 'status'):
+			if self._bits == 8 and not self._sensor_low:
+				self._sensor_low = True  # ACK
+			elif self._sensor_low:
+				self._sensor_low = False
+				self._command(self._shift)
+
+	def _command(self, value):
+		state, self._shift, self._bits = self._state, 0, 0
+		if state == 'status':
+			self.status, self._state = value, 'idle'
+			return
+		self.commands.append(value)
+		if value == SHT75.cmd.status_write:
+			self._state = 'status'
+		elif value == SHT75.cmd.status_read:
+			crc_init = crc.reverse_bits(self.status & 0x0f)
+			self._reply = [self.status, crc.reverse_bits(crc.crc8((value, self.status), crc_init))]
+			self._reply_bit = 0
+			self._state = 'reply'
+		elif value in (SHT75.cmd.t, SHT75.cmd.rh):
+			raw = self.t_raw if value == SHT75.cmd.t else self.rh_raw
+			v0, v1 = raw >> 8, raw & 0xff
+			crc_init = crc.reverse_bits(self.status & 0x0f)
+			self._reply = [v0, v1, crc.reverse_bits(crc.crc8((value, v0, v1), crc_init))]
+			self._reply_bit = 0
+			self._ready_at = time.monotonic() + self.conv_time
+			self._state = 'wait'
+		else:
+			self._state = 'idle'
+
+
 class ShtComms(object):
 
 	bitbang_delay_min = 0
+	poll_interval_min = 0.001
+	poll_interval_max = 0.01
+	# CRC start value, lower nibble of the status register in reversed bit order
+	crc_init = 0
 
-	def _crc8(self, cmd, v0, v1, _crc_table=[
-			0x00, 0x31, 0x62, 0x53, 0xc4, 0xf5, 0xa6, 0x97, 0xb9, 0x88, 0xdb, 0xea,
-			0x7d, 0x4c, 0x1f, 0x2e, 0x43, 0x72, 0x21, 0x10, 0x87, 0xb6, 0xe5, 0xd4,
-			0xfa, 0xcb, 0x98, 0xa9, 0x3e, 0x0f, 0x5c, 0x6d, 0x86, 0xb7, 0xe4, 0xd5,
-			0x42, 0x73, 0x20, 0x11, 0x3f, 0x0e, 0x5d, 0x6c, 0xfb, 0xca, 0x99, 0xa8,
-			0xc5, 0xf4, 0xa7, 0x96, 0x01, 0x30, 0x63, 0x52, 0x7c, 0x4d, 0x1e, 0x2f,
-			0xb8, 0x89, 0xda, 0xeb, 0x3d, 0x0c, 0x5f, 0x6e, 0xf9, 0xc8, 0x9b, 0xaa,
-			0x84, 0xb5, 0xe6, 0xd7, 0x40, 0x71, 0x22, 0x13, 0x7e, 0x4f, 0x1c, 0x2d,
-			0xba, 0x8b, 0xd8, 0xe9, 0xc7, 0xf6, 0xa5, 0x94, 0x03, 0x32, 0x61, 0x50,
-			0xbb, 0x8a, 0xd9, 0xe8, 0x7f, 0x4e, 0x1d, 0x2c, 0x02, 0x33, 0x60, 0x51,
-			0xc6, 0xf7, 0xa4, 0x95, 0xf8, 0xc9, 0x9a, 0xab, 0x3c, 0x0d, 0x5e, 0x6f,
-			0x41, 0x70, 0x23, 0x12, 0x85, 0xb4, 0xe7, 0xd6, 0x7a, 0x4b, 0x18, 0x29,
-			0xbe, 0x8f, 0xdc, 0xed, 0xc3, 0xf2, 0xa1, 0x90, 0x07, 0x36, 0x65, 0x54,
-			0x39, 0x08, 0x5b, 0x6a, 0xfd, 0xcc, 0x9f, 0xae, 0x80, 0xb1, 0xe2, 0xd3,
-			0x44, 0x75, 0x26, 0x17, 0xfc, 0xcd, 0x9e, 0xaf, 0x38, 0x09, 0x5a, 0x6b,
-			0x45, 0x74, 0x27, 0x16, 0x81, 0xb0, 0xe3, 0xd2, 0xbf, 0x8e, 0xdd, 0xec,
-			0x7b, 0x4a, 0x19, 0x28, 0x06, 0x37, 0x64, 0x55, 0xc2, 0xf3, 0xa0, 0x91,
-			0x47, 0x76, 0x25, 0x14, 0x83, 0xb2, 0xe1, 0xd0, 0xfe, 0xcf, 0x9c, 0xad,
-			0x3a, 0x0b, 0x58, 0x69, 0x04, 0x35, 0x66, 0x57, 0xc0, 0xf1, 0xa2, 0x93,
-			0xbd, 0x8c, 0xdf, 0xee, 0x79, 0x48, 0x1b, 0x2a, 0xc1, 0xf0, 0xa3, 0x92,
-			0x05, 0x34, 0x67, 0x56, 0x78, 0x49, 0x1a, 0x2b, 0xbc, 0x8d, 0xde, 0xef,
-			0x82, 0xb3, 0xe0, 0xd1, 0x46, 0x77, 0x24, 0x15, 0x3b, 0x0a, 0x59, 0x68,
-			0xff, 0xce, 0x9d, 0xac ]):
+	def _crc8(self, cmd, v0, v1):
 		# See: http://www.sensirion.com/nc/en/products/\
 		#  humidity-temperature/download-center/?cid=884&did=124&sechash=5c5f91f6
-		crc = _crc_table[cmd]
-		crc = _crc_table[crc ^ v0]
-		crc = _crc_table[crc ^ v1]
-		# Reverse bit order
-		# See: http://graphics.stanford.edu/~seander/bithacks.html#ReverseByteWith64BitsDiv
-		return (crc * 0x0202020202 & 0x010884422010) % 1023
-
-	def __init__(self, pin_sck, pin_data, gpio=None, freq_sck=None, freq_data=None):
-		if gpio is None:
-			from sht_sensor import gpio
-		self.pin_sck, self.pin_data, self.gpio = pin_sck, pin_data, gpio
+		# The sensor sends the CRC with reversed bit order
+		return crc.reverse_bits(crc.crc8((cmd, v0, v1), self.crc_init))
+
+	def __init__(self, pin_sck, pin_data, gpio=None, freq_sck=None, freq_data=None, transport=None):
+		'''transport is a ShtTransport, by default the GPIO character device
+				is used if available and the sht_sensor.gpio sysfs helper otherwise.
+			gpio is a module with the calls of sht_sensor.gpio to use instead.'''
+		if transport is None:
+			if gpio is None and gpio_cdev.available():
+				transport = CdevTransport([pin_sck, pin_data])
+			else:
+				transport = SysfsTransport(gpio)
+		self.pin_sck, self.pin_data, self.transport = pin_sck, pin_data, transport
 		self.freq_sck, self.freq_data = map(self._freq_iter, [freq_sck, freq_data])
 		self.log = logging.getLogger('sht')
 		self._init()
 
 	def _init(self):
 		for pin in self.pin_sck, self.pin_data:
-			# self.gpio.set_pin_value(pin, k='edge', v='none')
-			self.gpio.set_pin_value(pin, k='direction', v='low')
+			self.transport.set_direction(pin, 'low')
 		self.pin_data_mode = 'out'
 	_cleanup = _init
 
@@ -148,38 +310,38 @@ class ShtComms(object):
 	def _freq_iter(self, freq):
 		if not freq:
 			while True:
-				time.sleep(self.bitbang_delay_min)
+				if self.bitbang_delay_min: gpio_cdev.delay(self.bitbang_delay_min)
 				yield
-		if not mono_time:
-			raise ShtFailure( 'Unable to use frequency settings'
-				' due to failure to import monotonic timer func via ctypes' )
-		delay = 1.0 / freq
+		delay_ns = int(1e9 / freq)
 		while True:
-			ts_next = mono_time() + delay
+			ts_next = time.monotonic_ns() + delay_ns
 			yield
-			delta = ts_next - mono_time()
-			if delta > 0: time.sleep(delta)
+			delta = ts_next - time.monotonic_ns()
+			if delta > 0: gpio_cdev.delay(delta * 1e-9)
 
 	def _data_mode(self, mode):
 		if self.pin_data_mode != mode:
-			self.gpio.set_pin_value(self.pin_data, k='direction', v=mode)
+			self.transport.set_direction(self.pin_data, mode)
 			self.pin_data_mode = mode
 
 	def _data_set(self, v):
 		self._data_mode('out')
-		self.gpio.set_pin_value(self.pin_data, v, force=True)
+		self.transport.set(self.pin_data, v)
 		next(self.freq_data)
 
 	def _data_get(self):
 		self._data_mode('in')
-		return self.gpio.get_pin_value(self.pin_data)
+		return self.transport.get(self.pin_data)
 
 	def _sck_tick(self, v):
-		self.gpio.set_pin_value(self.pin_sck, v)
-		next(self.freq_data)
+		self.transport.set(self.pin_sck, v)
+		next(self.freq_sck)
 
 
-	def _send(self, cmd):
+	def _send(self, cmd, released=True):
+		'''Send a transmission start and cmd.
+			released checks that the sensor releases DATA after its ACK,
+				commands answered at once start driving it instead.'''
 		tick, data = self._sck_tick, self._data_set
 
 		tick(0)
@@ -206,20 +368,61 @@ class ShtComms(object):
 					' specified correctly, and/or has/needs a pull-up resistor.'
 				' See README file for more information.')
 		tick(0)
-		if not self._data_get():
+		if released and not self._data_get():
 			raise ShtCommFailure('Command ACK failed on step-2')
 
-	def _wait(self, timeout=1.0, poll_interval=0.01):
+	def _write_byte(self, v):
+		tick, data = self._sck_tick, self._data_set
+		for n in range(8):
+			data(v & (1 << 7 - n))
+			tick(1)
+			tick(0)
+		tick(1)
+		if self._data_get():
+			raise ShtCommFailure('Write ACK failed on step-1')
+		tick(0)
+		if not self._data_get():
+			raise ShtCommFailure('Write ACK failed on step-2')
+
+	def _set_status(self, cmd, status):
+		self._send(cmd)
+		self._write_byte(status)
+		self.crc_init = crc.reverse_bits(status & 0x0f)
+
+	def _get_status(self, cmd):
+		'Read the status register with the status read cmd, the CRC start value is set from it.'
+		self._send(cmd, released=False)
+		status = self._read_bits(8)
+		# The CRC of the reply already starts with the lower nibble of status
+		crc0 = crc.reverse_bits(crc.crc8((cmd, status), crc.reverse_bits(status & 0x0f)))
+		crc1 = self._read_crc()
+		self._cleanup()
+		if crc0 != crc1: raise ShtCRCCheckError(crc0, crc1)
+		self.crc_init = crc.reverse_bits(status & 0x0f)
+		return status
+
+	def _conversion_time(self, cmd):
+		'Expected duration of the measurement started by cmd in seconds, None if unknown.'
+		return None
+
+	def _wait(self, timeout=1.0, conv_time=None):
+		'''Wait for the sensor to pull DATA low at the end of a measurement.
+			Sleeps on edge events if the gpio backend supports them,
+				otherwise sleeps for the expected conversion time
+				and then polls with growing intervals.'''
 		self._data_mode('in')
-		## Proper edge-poll seem to always return POLLERR on BBB
-		## Also seem unreliable in general case, and not super-necessary here
-		# ack = self.gpio.poll_pin(self.pin_data, edge='falling')
-		for i in range(int(timeout / poll_interval) + 1):
+		if self.transport.edge_events:
+			if not self.transport.wait_value(self.pin_data, 0, timeout):
+				raise ShtCommFailure('Measurement timeout: {:.2f}s'.format(timeout))
+			return
+		deadline = time.monotonic() + timeout
+		if conv_time: time.sleep(conv_time)
+		poll_interval = self.poll_interval_min
+		while self.transport.get(self.pin_data):
+			if time.monotonic() > deadline:
+				raise ShtCommFailure('Measurement timeout: {:.2f}s'.format(timeout))
 			time.sleep(poll_interval)
-			ack = self.gpio.get_pin_value(self.pin_data)
-			if not ack: break
-		else:
-			raise ShtCommFailure('Measurement timeout: {:.2f}s'.format(timeout))
+			poll_interval = min(poll_interval * 2, self.poll_interval_max)
 
 	def _read_bits(self, bits, v=0):
 		tick = self._sck_tick
@@ -245,7 +448,7 @@ class ShtComms(object):
 
 	def _get_meas_result(self, cmd):
 		self._send(cmd)
-		self._wait()
+		self._wait(conv_time=self._conversion_time(cmd))
 		v0, v1 = self._read_meas_16bit()
 		# self._skip_crc()
 		crc0, crc1 = self._crc8(cmd, v0, v1), self._read_crc()
@@ -271,6 +474,8 @@ class ShtComms(object):
 			self._sck_tick(0)
 
 SHT75Result = namedtuple("SHT75Result", ("sensor_name", "is_valid", "temp", "hum"))
+# Raw mode: sensor counts and the calibration reference, see compensate.py
+SHT75RawResult = namedtuple("SHT75RawResult", ("sensor_name", "is_valid", "temp_raw", "hum_raw", "cal"))
 
 class SHT75(ShtComms):
 	# All table/chapter refs here point to:
@@ -291,25 +496,94 @@ class SHT75(ShtComms):
 		tn = dict(water=243.12, ice=272.62) # Table 9
 		m = dict(water=17.62, ice=22.46) # Table 9
 
+	class c_low_res(c):
+		d2 = 0.04 # Table 8, C/12b
+		c1, c2, c3 = -2.0468, 0.5872, -4.0845e-4 # Table 6, 8b
+		t1, t2 = 0.01, 0.00128 # Table 7, 8b
+
+	# Typical measurement times in seconds by resolution in bits, ch 3.3
+	meas_time = {8: 0.011, 12: 0.055, 14: 0.210}
+
 	class cmd:
 		t = 0b00000011
 		rh = 0b00000101
+		status_write = 0b00000110
+		status_read = 0b00000111
 
-	def __init__(self, pin_sck, pin_data, voltage=None, **sht_comms_kws):
+	def __init__(self, pin_sck, pin_data, voltage=None, low_resolution=False, raw=False, **sht_comms_kws):
 		'''"voltage" setting is important,
 					as it influences temperature conversion coefficients!!!
 			Unless you're using SHT1x/SHT7x, please make
-				sure all coefficients match your sensor's datasheet.'''
+				sure all coefficients match your sensor's datasheet.
+			"low_resolution" selects 12 bit temperature and 8 bit humidity
+				measurements, which take a quarter of the time.
+			"raw" makes read() report the sensor counts and the
+				calibration reference instead of converted values.'''
 		self.voltage = voltage or self.voltage_default
 		assert self.voltage in self.c.d1, [self.voltage, self.c.d1.keys()]
 		super(SHT75, self).__init__(pin_sck, pin_data, **sht_comms_kws)
+		self.raw = raw
+		self._calibration_ref = None
+		self.low_resolution = False
+		self._status_checked = False
+		if low_resolution:
+			self.set_low_resolution(True)
+
+	def set_low_resolution(self, low_resolution):
+		'Switch between 12/8 bit and 14/12 bit (default) T/RH measurements.'
+		self._set_status(self.cmd.status_write, 0b00000001 if low_resolution else 0)
+		self.low_resolution = low_resolution
+		self.c = self.c_low_res if low_resolution else SHT75.c
+		self._calibration_ref = None
+		self._status_checked = True
+
+	def _check_status(self):
+		'''Read the status register back and write the resolution again,
+			if the sensor lost it through a power loss or soft reset.
+			Done on the first read and after a CRC failure only, as a reset
+				sensor starts its CRCs with another value.'''
+		if self._status_checked: return
+		status = self._get_status(self.cmd.status_read)
+		if (status & 0b00000001) != self.low_resolution:
+			self.log.warning('Status register 0x%02x does not match the resolution, setting it again', status)
+			self.set_low_resolution(self.low_resolution)
+		self._status_checked = True
+
+	def calibration_ref(self):
+		'Reference of the conversion coefficients in the calibration store.'
+		if self._calibration_ref is None:
+			c = self.c
+			self._calibration_ref = calibration.get_store().register(dict( type='SHT75',
+				d1=c.d1[self.voltage], d2=c.d2, c1=c.c1, c2=c.c2, c3=c.c3, t1=c.t1, t2=c.t2 ))
+		return self._calibration_ref
+
+	def _conversion_time(self, cmd):
+		if cmd == self.cmd.t: bits = 12 if self.low_resolution else 14
+		else: bits = 8 if self.low_resolution else 12
+		return self.meas_time[bits]
+
+	def get_sensor_type_name(self):
+		return "SHT75"
 
 	def get_sensor_name(self):
 		return "SHT75"
 
+	def get_sensor_options(self):
+		return (self.pin_sck, self.pin_data, self.voltage, self.low_resolution, self.raw)
+
 	def read(self):
-		t = self.read_t()
-		h = self.read_rh()
+		'''One temperature and one humidity conversion per sample.
+			The status register is checked if needed, see _check_status.'''
+		if self.raw: return self.read_raw()
+		try:
+			self._check_status()
+			t = self.read_t()
+			h = self.read_rh(t)
+		except ShtCRCCheckError:
+			self._status_checked = False
+			t = h = None
+		except ShtFailure:
+			t = h = None
 		is_valid = True
 		if t is None:
 			is_valid = False
@@ -319,6 +593,20 @@ class SHT75(ShtComms):
 			h = 0
 		return SHT75Result(self.get_sensor_name(), is_valid, t, h)
 
+	def read_raw(self):
+		'Counts of one temperature and one humidity conversion, see compensate.py.'
+		try:
+			self._check_status()
+			t_raw = self._get_meas_result(self.cmd.t)
+			rh_raw = self._get_meas_result(self.cmd.rh)
+			self._cleanup()
+		except ShtCRCCheckError:
+			self._status_checked = False
+			return SHT75RawResult(self.get_sensor_name(), False, 0, 0, None)
+		except ShtFailure:
+			return SHT75RawResult(self.get_sensor_name(), False, 0, 0, None)
+		return SHT75RawResult(self.get_sensor_name(), True, t_raw, rh_raw, self.calibration_ref())
+
 	def read_t(self):
 		t_raw = self._get_meas_result(self.cmd.t)
 		return t_raw * self.c.d2 + self.c.d1[self.voltage]
@@ -343,6 +631,7 @@ class SHT75(ShtComms):
 			tn * (math.log(rh / 100.0) + (m * t) / (tn + t))
 			/ (m - math.log(rh / 100.0) - m * t / (tn + t)) )
 
+	@staticmethod
 	def detect_sensors():
 		try:
 			sensors = [SHT75(21, 20)] #Default bus is 1, default address is 0x40
@@ -352,6 +641,7 @@ class SHT75(ShtComms):
 		return sensors
 
 	def get_sensor_fields(self):
+		if self.raw: return ["temp_raw", "hum_raw", "cal"]
 		return ["temp", "hum"]
 
 
@@ -373,6 +663,9 @@ def main(args=None):
 			' For example, specifying "20" will introduce ~50ms delays between each DATA/SCK change.'
 			' Default is unlimited - i.e. not introduce any additional delays.')
 
+	parser.add_argument('-l', '--low-resolution', action='store_true',
+		help='Measure with 12 bit temperature and 8 bit humidity resolution (faster).')
+
 	parser.add_argument('-t', '--temperature', action='store_true',
 		help='Print temperature value to stdout. Default if no other values were specified.')
 	parser.add_argument('-r', '--rel-humidity',
@@ -395,7 +688,8 @@ def main(args=None):
 		except ValueError as err:
 			parser.error('Invalid frequency "hz[:hz]" spec {!r}: {}'.format(opts.max_freq, err))
 
-	sht = SHT75(opts.pin_sck, opts.pin_data, **freq_kws)
+	sht = SHT75(opts.pin_sck, opts.pin_data, voltage=opts.voltage,
+		low_resolution=opts.low_resolution, **freq_kws)
 
 	p = '{name}: {val}' if opts.verbose else '{val}'
 	p = lambda name, val, fmt=p: print(fmt.format(name=name, val=val))
@@ -0,0 +1,27 @@
+import random
+
+import crc
+
+
+def test_table_matches_bitwise():
+	rng = random.Random(1)
+	for n in range(2000):
+		data = bytes(rng.randrange(256) for i in range(rng.randrange(1, 9)))
+		init = rng.randrange(256)
+		assert crc.crc8(data, init) == crc.crc8_bitwise(data, init)
+
+
+def test_every_byte():
+	for byte in range(256):
+		assert crc.crc8([byte]) == crc.crc8_bitwise([byte])
+
+
+def test_reverse_bits():
+	for byte in range(256):
+		assert crc.reverse_bits(crc.reverse_bits(byte)) == byte
+	assert crc.reverse_bits(0b00000001) == 0b10000000
+	assert crc.reverse_bits(0b11010000) == 0b00001011
+
+
+def test_sum8():
+	assert crc.sum8([200, 100, 10, 0]) == 54
@@ -0,0 +1,82 @@
+import random
+
+import pytest
+
+import crc
+import dht11_decode
+
+
+@pytest.fixture(params=["numpy", "python"])
+def decoder(request, monkeypatch):
+	"""Run a test with the numpy decoder, if installed, and without it"""
+	if request.param == "numpy":
+		pytest.importorskip("numpy")
+	else:
+		monkeypatch.setattr(dht11_decode, "np", None)
+	return dht11_decode
+
+
+def make_data(rng):
+	data = [rng.randrange(100), 0, rng.randrange(50), 0]
+	data.append(crc.sum8(data))
+	return data
+
+
+def test_clean(decoder):
+	rng = random.Random(1)
+	for n in range(50):
+		data = make_data(rng)
+		timestamps, levels = decoder.synthetic_edges(data, rng=rng)
+		assert decoder.decode_trace(dict(timestamps=timestamps, levels=levels)) == data
+
+
+def test_jitter(decoder):
+	rng = random.Random(2)
+	for n in range(50):
+		data = make_data(rng)
+		timestamps, levels = decoder.synthetic_edges(data, jitter_ns=8000, rng=rng)
+		assert decoder.decode_trace(dict(timestamps=timestamps, levels=levels)) == data
+
+
+def test_samples(decoder):
+	rng = random.Random(3)
+	data = make_data(rng)
+	timestamps, levels = decoder.synthetic_edges(data, jitter_ns=8000, rng=rng)
+	samples = decoder.edges_to_samples(timestamps, levels, 3000)
+	assert decoder.decode_trace(dict(samples=samples)) == data
+
+
+def test_missing_bit(decoder):
+	rng = random.Random(4)
+	data = make_data(rng)
+	for bit in (0, 7, 39):
+		timestamps, levels = decoder.synthetic_edges(data, missing_bits=(bit,), rng=rng)
+		assert decoder.decode_trace(dict(timestamps=timestamps, levels=levels)) is None
+		# The high period after the release of the start signal is no response
+		timestamps.insert(0, timestamps[0] - 30000)
+		levels.insert(0, decoder.HIGH)
+		assert decoder.decode_trace(dict(timestamps=timestamps, levels=levels)) is None
+
+
+def test_start_signal_release(decoder):
+	data = make_data(random.Random(7))
+	timestamps, levels = decoder.synthetic_edges(data)
+	timestamps.insert(0, timestamps[0] - 30000)
+	levels.insert(0, decoder.HIGH)
+	assert decoder.decode_trace(dict(timestamps=timestamps, levels=levels)) == data
+
+
+def test_lost_edges(decoder):
+	data = make_data(random.Random(5))
+	timestamps, levels = decoder.synthetic_edges(data)
+	assert decoder.decode_trace(dict(timestamps=timestamps, levels=levels, lost=1)) is None
+
+
+def test_saved_traces(tmp_path):
+	data = make_data(random.Random(6))
+	timestamps, levels = dht11_decode.synthetic_edges(data)
+	path = str(tmp_path / "traces.jsonl")
+	dht11_decode.save_traces(path, [("recorded", dict(timestamps=timestamps, levels=levels, lost=0))])
+	(name, trace), = dht11_decode.load_traces(path)
+	assert name == "recorded"
+	assert dht11_decode.decode_trace(trace) == data
@@ -0,0 +1,80 @@
+import os
+import time
+import tty
+
+import pytest
+
+pytest.importorskip("serial")
+
+import dust
+import dust_frames
+
+
+@pytest.fixture
+def pty_sensor():
+	"""Open DustSensors on a pseudo-terminal, returns (write, sensor) pairs"""
+	opened = list()
+
+	def open_sensor(**kws):
+		master, slave = os.openpty()
+		tty.setraw(slave)
+		sensor = dust.DustSensor(1, port=os.ttyname(slave), **kws)
+		opened.append((sensor, master, slave))
+
+		def write(*chunks):
+			for chunk in chunks:
+				os.write(master, chunk)
+			time.sleep(0.2)
+		return write, sensor
+
+	yield open_sensor
+	for sensor, master, slave in opened:
+		sensor.close()
+		os.close(slave)
+		os.close(master)
+
+
+def test_ascii_statistics():
+	result = dust.pty_test([b"1.5,20.0\n", b"garbage\n", b"3.5,10.0\n"], statistics=True)
+	assert result == dust.DustResult("DustSensor_1", True, 2.5, 15.0, 1.5, 3.5, 10.0, 20.0)
+
+
+def test_sds011_split_frames():
+	frame = dust_frames.sds011_frame(12.5, 30.1)
+	result = dust.pty_test([frame[3:], b"\x00", frame[:4], frame[4:]], protocol="sds011")
+	assert result.is_valid
+	assert (result.smalldust, result.largedust) == (12.5, 30.1)
+
+
+def test_pms5003():
+	result = dust.pty_test([b"\x00\x42", dust_frames.pms5003_frame(7, 11)], protocol="pms5003")
+	assert result.is_valid
+	assert (result.smalldust, result.largedust) == (7, 11)
+
+
+def test_latest_sample(pty_sensor):
+	write, sensor = pty_sensor()
+	write(b"1.0,2.0\n", b"3.0,4.0\n")
+	result = sensor.read()
+	assert result.is_valid
+	assert (result.smalldust, result.largedust) == (3.0, 4.0)
+	assert result.smalldust_min is None
+
+
+@pytest.mark.parametrize("statistics", [False, True])
+def test_no_new_sample_invalid(pty_sensor, statistics):
+	write, sensor = pty_sensor(statistics=statistics)
+	write(b"1.0,2.0\n")
+	assert sensor.read().is_valid
+	assert not sensor.read().is_valid
+	write(b"5.0,6.0\n")
+	result = sensor.read()
+	assert result.is_valid
+	assert (result.smalldust, result.largedust) == (5.0, 6.0)
+
+
+def test_detect_without_device(monkeypatch):
+	def no_device(*args, **kws):
+		raise dust.serial.SerialException("could not open port")
+	monkeypatch.setattr(dust.serial, "Serial", no_device)
+	assert dust.DustSensor.detect_sensors() == []
@@ -0,0 +1,65 @@
+import pytest
+
+import sht75
+
+CMD = sht75.SHT75.cmd
+
+
+def make_sensor(low_resolution, **kws):
+	transport = sht75.SimulatedTransport(0, 1, **kws)
+	sensor = sht75.SHT75(0, 1, transport=transport, low_resolution=low_resolution)
+	return sensor, transport
+
+
+def expected(c, t_raw, rh_raw, voltage="3.5V"):
+	t = t_raw * c.d2 + c.d1[voltage]
+	rh = c.c1 + c.c2 * rh_raw + c.c3 * rh_raw**2
+	return t, (t - 25.0) * (c.t1 + c.t2 * rh_raw) + rh
+
+
+@pytest.mark.parametrize("low_resolution, t_raw, rh_raw", [(False, 6400, 1500), (True, 1600, 100)])
+def test_read(low_resolution, t_raw, rh_raw):
+	sensor, transport = make_sensor(low_resolution, t_raw=t_raw, rh_raw=rh_raw)
+	assert transport.status == (1 if low_resolution else 0)
+	sensor.read()
+	# One temperature and one humidity conversion per sample
+	del transport.commands[:]
+	result = sensor.read()
+	assert transport.commands == [CMD.t, CMD.rh]
+	t, rh = expected(sensor.c_low_res if low_resolution else sht75.SHT75.c, t_raw, rh_raw)
+	assert result.is_valid
+	assert result.temp == pytest.approx(t)
+	assert result.hum == pytest.approx(rh)
+
+
+@pytest.mark.parametrize("low_resolution", [False, True])
+def test_read_raw(low_resolution, tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	sensor, transport = make_sensor(low_resolution)
+	sensor.raw = True
+	sensor.read()
+	del transport.commands[:]
+	result = sensor.read()
+	assert transport.commands == [CMD.t, CMD.rh]
+	assert result.is_valid
+	assert (result.temp_raw, result.hum_raw) == (transport.t_raw, transport.rh_raw)
+
+
+def test_status_read_once():
+	sensor, transport = make_sensor(False)
+	sensor.read()
+	sensor.read()
+	assert transport.commands == [CMD.status_read, CMD.t, CMD.rh, CMD.t, CMD.rh]
+
+
+def test_status_restored_after_reset():
+	sensor, transport = make_sensor(True, t_raw=1600, rh_raw=100)
+	transport.reset()
+	# The reset sensor starts its CRCs with another value
+	assert not sensor.read().is_valid
+	del transport.commands[:]
+	result = sensor.read()
+	assert transport.commands == [CMD.status_read, CMD.status_write, CMD.t, CMD.rh]
+	assert transport.status == 1
+	assert result.is_valid
+	assert result.temp == pytest.approx(expected(sensor.c_low_res, 1600, 100)[0])
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+import w1_temp
+
+SLAVE = "72 01 4b 46 7f ff 0e 10 57 : crc=57 {}\n72 01 4b 46 7f ff 0e 10 57 t={}\n"
+
+
+def make_tree(root, masters):
+	"""Fake w1 sysfs tree, masters maps a master to (bulk, {sensor: (crc ok, millidegrees)})"""
+	for master, (bulk, sensors) in masters.items():
+		(root / master).mkdir()
+		(root / master / "w1_master_slaves").write_text("".join(name + "\n" for name in sensors) or "not found.\n")
+		if bulk:
+			(root / master / "therm_bulk_read").write_text("0\n")
+		for name, (ok, t) in sensors.items():
+			(root / name).mkdir()
+			(root / name / "w1_slave").write_text(SLAVE.format("YES" if ok else "NO", t))
+			(root / name / "resolution").write_text("12\n")
+	return w1_temp.W1Sysfs(str(root))
+
+
+@pytest.fixture
+def sysfs(tmp_path, monkeypatch):
+	monkeypatch.setitem(w1_temp.CONVERSION_TIMES, 12, 0.02)
+	monkeypatch.setattr(w1_temp, "_bulk_triggers", dict())
+	return make_tree(tmp_path, {
+		"w1_bus_master1": (True, {"28-a1": (True, 23125), "28-a2": (True, -1500)}),
+		"w1_bus_master2": (False, {"28-b1": (False, 85000)}),
+		"w1_bus_master10": (True, {}),
+	})
+
+
+def test_discovery(sysfs):
+	assert sysfs.masters() == ["w1_bus_master1", "w1_bus_master2", "w1_bus_master10"]
+	assert sysfs.slaves("w1_bus_master10") == []
+	sensors = w1_temp.W1TempSensor.detect_sensors(sysfs)
+	assert [(sensor.get_sensor_name(), sensor._master) for sensor in sensors] == [
+		("W1_28-a1", "w1_bus_master1"), ("W1_28-a2", "w1_bus_master1"), ("W1_28-b1", "w1_bus_master2")]
+
+
+def test_bulk_read(sysfs, tmp_path):
+	sensors = w1_temp.W1TempSensor.detect_sensors(sysfs)
+	delay = max(sensor.start_measurement() for sensor in sensors)
+	assert (tmp_path / "w1_bus_master1" / "therm_bulk_read").read_text() == "trigger\n"
+	results = dict()
+	pending = sensors
+	deadline = time.monotonic() + 5
+	while pending and time.monotonic() < deadline:
+		time.sleep(delay)
+		waiting = list()
+		for sensor in pending:
+			result = sensor.collect()
+			if isinstance(result, float):
+				waiting.append(sensor)
+				delay = result
+			else:
+				results[sensor.get_sensor_name()] = result
+		pending = waiting
+	assert not pending
+	assert [sensor._bulk for sensor in sensors] == [True, True, False]
+	assert results["W1_28-a1"] == w1_temp.W1Result("W1_28-a1", True, 23.125)
+	assert results["W1_28-a2"] == w1_temp.W1Result("W1_28-a2", True, -1.5)
+	assert results["W1_28-b1"] == w1_temp.W1Result("W1_28-b1", False, 85.0)
+
+
+def test_trigger_shared_per_master(sysfs, tmp_path):
+	first, second = w1_temp.W1TempSensor.detect_sensors(sysfs)[:2]
+	first.start_measurement()
+	trigger = w1_temp._bulk_triggers["w1_bus_master1"]
+	second.start_measurement()
+	assert w1_temp._bulk_triggers["w1_bus_master1"] is trigger
+	first._future.result()
+	second._future.result()
+	# Both collected the conversion, the next start triggers a new one
+	first.start_measurement()
+	assert w1_temp._bulk_triggers["w1_bus_master1"] is not trigger
+	first._future.result()
+
+
+def test_missing_sensor(sysfs):
+	with pytest.raises(ValueError):
+		w1_temp.W1TempSensor("28-zz", sysfs=sysfs)
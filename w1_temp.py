@@ -1,41 +1,203 @@
 #!/usr/bin/env python3
 
+import os
 from os.path import join, exists
 import re
+import time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 W1_DEVICES_DIR = "/sys/bus/w1/devices/"
+MASTER_PREFIX = "w1_bus_master"
+# Maximum conversion time per resolution in bits, the default is 12 bit
+CONVERSION_TIMES = {9: 0.09375, 10: 0.1875, 11: 0.375, 12: 0.75}
+CONVERSION_TIME = CONVERSION_TIMES[12]
+# A bulk conversion is reused by sensors started within this time
+BULK_MAX_AGE = 1.0
+# Polling interval while therm_bulk_read reports a running conversion
+BULK_POLL_INTERVAL = 0.05
 SENSOR_PAT = re.compile("((?:[0-9a-f]{2} ){9}): crc=[0-9a-f]{2} (\w+)\n"
 	"(?:[0-9a-f]{2} ){9}t=([0-9\-]+)")
 
 	
 W1Result = namedtuple("W1Result", ("sensor_name", "is_valid", "temp"))
 
+# Bulk conversions per w1 master: [trigger time, names of the sensors
+# already collected since]
+_bulk_triggers = dict()
+# One worker thread per w1 master, a master talks to one sensor at a
+# time but different masters work in parallel
+_workers = dict()
+
+
+def _worker(master):
+	worker = _workers.get(master)
+	if worker is None:
+		worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="w1")
+		_workers[master] = worker
+	return worker
+
+
+class W1Sysfs(object):
+	"""The w1 sysfs layout below devices_dir
+
+	All file access of the driver goes through this class, so it can be
+	pointed at a fake tree. Masters are the w1_bus_master* entries, their
+	sensors are listed in w1_master_slaves.
+	"""
+
+	def __init__(self, devices_dir=None):
+		self.devices_dir = W1_DEVICES_DIR if devices_dir is None else devices_dir
+
+	def path(self, *parts):
+		return join(self.devices_dir, *parts)
+
+	def exists(self, *parts):
+		return exists(self.path(*parts))
+
+	def read(self, *parts):
+		with open(self.path(*parts)) as fp:
+			return fp.read()
+
+	def write(self, data, *parts):
+		with open(self.path(*parts), "w") as fp:
+			fp.write(data)
+
+	def masters(self):
+		try:
+			names = [name for name in os.listdir(self.devices_dir) if name.startswith(MASTER_PREFIX)]
+		except OSError:
+			return []
+		return sorted(names, key=lambda name: (len(name), name))
+
+	def slaves(self, master):
+		try:
+			lines = self.read(master, "w1_master_slaves").splitlines()
+		except OSError:
+			return []
+		# The kernel lists "not found." for a master without slaves
+		return [line for line in lines if line and line != "not found."]
+
+	def master_of(self, name):
+		"""The master a sensor is connected to, None if it is not listed"""
+		for master in self.masters():
+			if name in self.slaves(master):
+				return master
+		return None
+
 
 class W1TempSensor(object):
-	def __init__(self, name):
+	def __init__(self, name, resolution=None, sysfs=None):
 		if name[:3] == "W1_":
 			name = name[3:]
 		self._active_sensor = name
+		self._sysfs = W1Sysfs() if sysfs is None else sysfs
 		
-		sensor_file_path = join(W1_DEVICES_DIR, name, "w1_slave")
-		if not exists(sensor_file_path):
+		if not self._sysfs.exists(name, "w1_slave"):
 			raise ValueError("No sensor connected with this ID.", name)
+		if resolution is not None and resolution not in CONVERSION_TIMES:
+			raise ValueError("Resolution has to be 9, 10, 11 or 12 bit.", resolution)
+		self._master = self._sysfs.master_of(name)
+		self._bulk = False
+		self._future = None
+		self._resolution = resolution
+		self._conversion_time = CONVERSION_TIMES.get(self.read_resolution(), CONVERSION_TIME)
+		if resolution is not None:
+			self.set_resolution(resolution)
 
-	def read(self):
-		sensor_id = self._active_sensor
-		sensor_dir = join(W1_DEVICES_DIR, sensor_id)
-		
-		data = ""
-		sensor_file_path = join(sensor_dir, "w1_slave")
-		if not exists(sensor_file_path):
-			print("Sensor is unavailable: %s" % self.get_sensor_name())
+	def set_resolution(self, resolution):
+		"""Write the resolution in bits (9-12) to the sensor
+
+		Needs a kernel whose w1_therm has the resolution attribute, with
+		older ones the sensor keeps converting at its current resolution.
+		Lower resolutions convert faster, 9 bit (0.5°C) in 94ms instead of
+		750ms for 12 bit (0.0625°C).
+		"""
+		if resolution not in CONVERSION_TIMES:
+			raise ValueError("Resolution has to be 9, 10, 11 or 12 bit.", resolution)
+		self._resolution = resolution
+		try:
+			self._sysfs.write("%i\n" % resolution, self._active_sensor, "resolution")
+		except OSError:
+			pass
+		self._conversion_time = CONVERSION_TIMES.get(self.read_resolution(), CONVERSION_TIME)
+
+	def read_resolution(self):
+		"""The resolution in bits reported by the sensor, None if unknown"""
+		try:
+			return int(self._sysfs.read(self._active_sensor, "resolution"))
+		except (OSError, ValueError):
+			return None
+
+	def start_measurement(self):
+		"""Start a conversion on all sensors of the w1 master at once
+
+		Writing "trigger" to the master's therm_bulk_read makes all its
+		sensors convert simultaneously. The trigger is shared by the
+		sensors of a master: it is only repeated when this sensor already
+		collected the last conversion or the conversion is too old.
+		The sensor is then read by the master's worker thread.
+		Returns the time in seconds until the result should be ready.
+		"""
+		master = self._master
+		self._bulk = master is not None and self._sysfs.exists(master, "therm_bulk_read")
+		now = time.monotonic()
+		trigger = _bulk_triggers.get(master)
+		if self._bulk and (trigger is None or self._active_sensor in trigger[1] or now - trigger[0] > BULK_MAX_AGE):
+			try:
+				self._sysfs.write("trigger\n", master, "therm_bulk_read")
+				trigger = [now, set()]
+				_bulk_triggers[master] = trigger
+			except OSError:
+				self._bulk = False
+		if not self._bulk:
+			# Older kernels: the read converts on its own
+			self._future = _worker(master).submit(self.read)
+			return self._conversion_time
+		ready_time = trigger[0] + self._conversion_time
+		self._future = _worker(master).submit(self._read_bulk, trigger, ready_time)
+		return max(0.0, ready_time - now)
+
+	def _read_bulk(self, trigger, ready_time):
+		"""Wait for the bulk conversion and read the result"""
+		delay = ready_time - time.monotonic()
+		if delay > 0:
+			time.sleep(delay)
+		while time.monotonic() - trigger[0] < 2 * self._conversion_time:
+			try:
+				if self._sysfs.read(self._master, "therm_bulk_read").strip() != "-1":
+					break
+			except OSError:
+				break
+			time.sleep(BULK_POLL_INTERVAL)
+		trigger[1].add(self._active_sensor)
+		return self.read()
+
+	def collect(self):
+		"""Result of the measurement started with start_measurement
+
+		Returns the time to wait instead, if the worker has not read the
+		sensor yet.
+		"""
+		future = self._future
+		if future is None:
+			return self.read()
+		if not future.done():
+			return BULK_POLL_INTERVAL
+		self._future = None
+		try:
+			return future.result()
+		except OSError:
 			return False
+
+	def read(self):
 		try:
-			sensor_file = open(sensor_file_path)
+			data = self._sysfs.read(self._active_sensor, "w1_slave")
 		except FileNotFoundError:
+			print("Sensor is unavailable: %s" % self.get_sensor_name())
+			return False
+		except OSError:
 			return False
-		data = sensor_file.read()
 		match = SENSOR_PAT.match(data)
 		if not match:
 			return False
@@ -52,26 +214,43 @@ class W1TempSensor(object):
 		return ["temp"]
 		
 	def get_sensor_options(self):
-		return (self._active_sensor,)
+		return (self._active_sensor, self._resolution)
 		
 		
 	@staticmethod
-	def detect_sensors():
-		master_dir = join(W1_DEVICES_DIR, "w1_bus_master1")
-
+	def detect_sensors(sysfs=None):
+		"""Sensors on all w1 masters"""
+		sysfs = W1Sysfs() if sysfs is None else sysfs
 		sensors = list()
-		try:
-			with open(join(master_dir, "w1_master_slaves")) as slave_file:
-				for line in slave_file:
-					sensors.append(line[:-1])
-		except FileNotFoundError:
-			pass
-		return [W1TempSensor(name) for name in sensors]
+		for master in sysfs.masters():
+			for name in sysfs.slaves(master):
+				if sysfs.exists(name, "w1_slave"):
+					sensors.append(W1TempSensor(name, sysfs=sysfs))
+		return sensors
 
 def get_sensors():
 	return W1TempSensor.detect_sensors()
 
 if __name__ == "__main__":
-	sensor = W1TempSensor()
-	result = sensor.read()
-	print("valid:%r temperature:%i" % (result.is_valid, result.temp))
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Read all DS18x20 sensors.")
+	parser.add_argument("--resolution", type=int, choices=sorted(CONVERSION_TIMES), help="Resolution in bits. Default: keep the current one")
+	args = parser.parse_args()
+
+	sensors = W1TempSensor.detect_sensors()
+	if args.resolution is not None:
+		for sensor in sensors:
+			sensor.set_resolution(args.resolution)
+	delay = max([sensor.start_measurement() for sensor in sensors] + [0.0])
+	while sensors:
+		time.sleep(delay)
+		pending = list()
+		for sensor in sensors:
+			result = sensor.collect()
+			if isinstance(result, float):
+				pending.append(sensor)
+				delay = result
+			elif result:
+				print("%s valid:%r temperature:%.3f" % (result.sensor_name, result.is_valid, result.temp))
+		sensors = pending